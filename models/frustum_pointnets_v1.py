@@ -13,10 +13,11 @@ sys.path.append(os.path.join(ROOT_DIR, 'utils'))
 import tf_util
 from model_util import NUM_HEADING_BIN, NUM_SIZE_CLUSTER, NUM_OBJECT_POINT
 from model_util import point_cloud_masking, get_center_regression_net
+from model_util import compact_indices, scatter_to_batch
 from model_util import placeholder_inputs, parse_output_to_tensors, get_loss
 
 def get_instance_seg_v1_net(point_cloud, one_hot_vec,
-                            is_training, bn_decay, end_points):
+                            is_training, bn_decay, end_points, pointwise=False):
     ''' 3D instance segmentation PointNet v1 network.
     Input:
         point_cloud: TF tensor in shape (B,N,4)
@@ -27,6 +28,10 @@ def get_instance_seg_v1_net(point_cloud, one_hot_vec,
         is_training: TF boolean scalar
         bn_decay: TF float scalar
         end_points: dict
+        pointwise: bool, if True use tf_util.shared_mlp layers and add the
+            global feature by broadcasting, else 1x1 conv2d layers in the
+            tf_util.LAYOUT data format and a tiled global feature (same
+            variables)
     Output:
         logits: TF tensor in shape (B,N,2), scores for bkg/clutter and object
         end_points: dict
@@ -34,94 +39,147 @@ def get_instance_seg_v1_net(point_cloud, one_hot_vec,
     batch_size = point_cloud.get_shape()[0].value
     num_point = point_cloud.get_shape()[1].value
 
+    if pointwise:
+        net = tf_util.shared_mlp(point_cloud, 64, bn=True,
+                                 is_training=is_training, scope='conv1', bn_decay=bn_decay)
+        net = tf_util.shared_mlp(net, 64, bn=True,
+                                 is_training=is_training, scope='conv2', bn_decay=bn_decay)
+        point_feat = tf_util.shared_mlp(net, 64, bn=True,
+                                        is_training=is_training, scope='conv3', bn_decay=bn_decay)
+        net = tf_util.shared_mlp(point_feat, 128, bn=True,
+                                 is_training=is_training, scope='conv4', bn_decay=bn_decay)
+        net = tf_util.shared_mlp(net, 1024, bn=True,
+                                 is_training=is_training, scope='conv5', bn_decay=bn_decay)
+        global_feat = tf.reduce_max(net, axis=1, name='maxpool') # Bx1024
+        global_feat = tf.concat([global_feat, one_hot_vec], axis=1)
+
+        net = tf_util.shared_mlp(point_feat, 512, global_feat=global_feat, bn=True,
+                                 is_training=is_training, scope='conv6', bn_decay=bn_decay)
+        net = tf_util.shared_mlp(net, 256, bn=True,
+                                 is_training=is_training, scope='conv7', bn_decay=bn_decay)
+        net = tf_util.shared_mlp(net, 128, bn=True,
+                                 is_training=is_training, scope='conv8', bn_decay=bn_decay)
+        net = tf_util.shared_mlp(net, 128, bn=True,
+                                 is_training=is_training, scope='conv9', bn_decay=bn_decay)
+        net = tf_util.dropout(net, is_training, 'dp1', keep_prob=0.5)
+
+        logits = tf_util.shared_mlp(net, 2, activation_fn=None, scope='conv10') # BxNxC
+        return logits, end_points
+
+    data_format = 'NCHW' if tf_util.use_nchw() else 'NHWC'
     net = tf.expand_dims(point_cloud, 2)
+    if data_format == 'NCHW': net = tf.transpose(net, [0,3,1,2]) # BxCxNx1
 
     net = tf_util.conv2d(net, 64, [1,1],
-                         padding='VALID', stride=[1,1],
+                         padding='VALID', stride=[1,1], data_format=data_format,
                          bn=True, is_training=is_training,
                          scope='conv1', bn_decay=bn_decay)
     net = tf_util.conv2d(net, 64, [1,1],
-                         padding='VALID', stride=[1,1],
+                         padding='VALID', stride=[1,1], data_format=data_format,
                          bn=True, is_training=is_training,
                          scope='conv2', bn_decay=bn_decay)
     point_feat = tf_util.conv2d(net, 64, [1,1],
-                         padding='VALID', stride=[1,1],
+                         padding='VALID', stride=[1,1], data_format=data_format,
                          bn=True, is_training=is_training,
                          scope='conv3', bn_decay=bn_decay)
     net = tf_util.conv2d(point_feat, 128, [1,1],
-                         padding='VALID', stride=[1,1],
+                         padding='VALID', stride=[1,1], data_format=data_format,
                          bn=True, is_training=is_training,
                          scope='conv4', bn_decay=bn_decay)
     net = tf_util.conv2d(net, 1024, [1,1],
-                         padding='VALID', stride=[1,1],
+                         padding='VALID', stride=[1,1], data_format=data_format,
                          bn=True, is_training=is_training,
                          scope='conv5', bn_decay=bn_decay)
-    global_feat = tf_util.max_pool2d(net, [num_point,1],
-                                     padding='VALID', scope='maxpool')
+    if data_format == 'NCHW':
+        global_feat = tf.reduce_max(net, axis=2, keep_dims=True, name='maxpool')
+        global_feat = tf.concat([global_feat, tf.expand_dims(tf.expand_dims(one_hot_vec, 2), 2)], axis=1)
+        global_feat_expand = tf.tile(global_feat, [1, 1, num_point, 1])
+        concat_feat = tf.concat(axis=1, values=[point_feat, global_feat_expand])
+    else:
+        global_feat = tf_util.max_pool2d(net, [num_point,1],
+                                         padding='VALID', scope='maxpool')
 
-    global_feat = tf.concat([global_feat, tf.expand_dims(tf.expand_dims(one_hot_vec, 1), 1)], axis=3)
-    global_feat_expand = tf.tile(global_feat, [1, num_point, 1, 1])
-    concat_feat = tf.concat(axis=3, values=[point_feat, global_feat_expand])
+        global_feat = tf.concat([global_feat, tf.expand_dims(tf.expand_dims(one_hot_vec, 1), 1)], axis=3)
+        global_feat_expand = tf.tile(global_feat, [1, num_point, 1, 1])
+        concat_feat = tf.concat(axis=3, values=[point_feat, global_feat_expand])
 
     net = tf_util.conv2d(concat_feat, 512, [1,1],
-                         padding='VALID', stride=[1,1],
+                         padding='VALID', stride=[1,1], data_format=data_format,
                          bn=True, is_training=is_training,
                          scope='conv6', bn_decay=bn_decay)
     net = tf_util.conv2d(net, 256, [1,1],
-                         padding='VALID', stride=[1,1],
+                         padding='VALID', stride=[1,1], data_format=data_format,
                          bn=True, is_training=is_training,
                          scope='conv7', bn_decay=bn_decay)
     net = tf_util.conv2d(net, 128, [1,1],
-                         padding='VALID', stride=[1,1],
+                         padding='VALID', stride=[1,1], data_format=data_format,
                          bn=True, is_training=is_training,
                          scope='conv8', bn_decay=bn_decay)
     net = tf_util.conv2d(net, 128, [1,1],
-                         padding='VALID', stride=[1,1],
+                         padding='VALID', stride=[1,1], data_format=data_format,
                          bn=True, is_training=is_training,
                          scope='conv9', bn_decay=bn_decay)
     net = tf_util.dropout(net, is_training, 'dp1', keep_prob=0.5)
 
     logits = tf_util.conv2d(net, 2, [1,1],
-                         padding='VALID', stride=[1,1], activation_fn=None,
+                         padding='VALID', stride=[1,1], data_format=data_format, activation_fn=None,
                          scope='conv10')
+    if data_format == 'NCHW': logits = tf.transpose(logits, [0,2,3,1])
     logits = tf.squeeze(logits, [2]) # BxNxC
     return logits, end_points
  
 
 def get_3d_box_estimation_v1_net(object_point_cloud, one_hot_vec,
-                                 is_training, bn_decay, end_points):
+                                 is_training, bn_decay, end_points, pointwise=False):
     ''' 3D Box Estimation PointNet v1 network.
     Input:
         object_point_cloud: TF tensor in shape (B,M,C)
             point clouds in object coordinate
         one_hot_vec: TF tensor in shape (B,3)
             length-3 vectors indicating predicted object type
+        pointwise: bool, if True use tf_util.shared_mlp layers
     Output:
         output: TF tensor in shape (B,3+NUM_HEADING_BIN*2+NUM_SIZE_CLUSTER*4)
             including box centers, heading bin class scores and residuals,
             and size cluster scores and residuals
     ''' 
     num_point = object_point_cloud.get_shape()[1].value
-    net = tf.expand_dims(object_point_cloud, 2)
-    net = tf_util.conv2d(net, 128, [1,1],
-                         padding='VALID', stride=[1,1],
-                         bn=True, is_training=is_training,
-                         scope='conv-reg1', bn_decay=bn_decay)
-    net = tf_util.conv2d(net, 128, [1,1],
-                         padding='VALID', stride=[1,1],
-                         bn=True, is_training=is_training,
-                         scope='conv-reg2', bn_decay=bn_decay)
-    net = tf_util.conv2d(net, 256, [1,1],
-                         padding='VALID', stride=[1,1],
-                         bn=True, is_training=is_training,
-                         scope='conv-reg3', bn_decay=bn_decay)
-    net = tf_util.conv2d(net, 512, [1,1],
-                         padding='VALID', stride=[1,1],
-                         bn=True, is_training=is_training,
-                         scope='conv-reg4', bn_decay=bn_decay)
-    net = tf_util.max_pool2d(net, [num_point,1],
-        padding='VALID', scope='maxpool2')
-    net = tf.squeeze(net, axis=[1,2])
+    if pointwise:
+        net = tf_util.shared_mlp(object_point_cloud, 128, bn=True,
+                                 is_training=is_training, scope='conv-reg1', bn_decay=bn_decay)
+        net = tf_util.shared_mlp(net, 128, bn=True,
+                                 is_training=is_training, scope='conv-reg2', bn_decay=bn_decay)
+        net = tf_util.shared_mlp(net, 256, bn=True,
+                                 is_training=is_training, scope='conv-reg3', bn_decay=bn_decay)
+        net = tf_util.shared_mlp(net, 512, bn=True,
+                                 is_training=is_training, scope='conv-reg4', bn_decay=bn_decay)
+        net = tf.reduce_max(net, axis=1, name='maxpool2')
+    else:
+        data_format = 'NCHW' if tf_util.use_nchw() else 'NHWC'
+        net = tf.expand_dims(object_point_cloud, 2)
+        if data_format == 'NCHW': net = tf.transpose(net, [0,3,1,2]) # BxCxMx1
+        net = tf_util.conv2d(net, 128, [1,1],
+                             padding='VALID', stride=[1,1], data_format=data_format,
+                             bn=True, is_training=is_training,
+                             scope='conv-reg1', bn_decay=bn_decay)
+        net = tf_util.conv2d(net, 128, [1,1],
+                             padding='VALID', stride=[1,1], data_format=data_format,
+                             bn=True, is_training=is_training,
+                             scope='conv-reg2', bn_decay=bn_decay)
+        net = tf_util.conv2d(net, 256, [1,1],
+                             padding='VALID', stride=[1,1], data_format=data_format,
+                             bn=True, is_training=is_training,
+                             scope='conv-reg3', bn_decay=bn_decay)
+        net = tf_util.conv2d(net, 512, [1,1],
+                             padding='VALID', stride=[1,1], data_format=data_format,
+                             bn=True, is_training=is_training,
+                             scope='conv-reg4', bn_decay=bn_decay)
+        if data_format == 'NCHW':
+            net = tf.reduce_max(net, axis=[2,3], name='maxpool2')
+        else:
+            net = tf_util.max_pool2d(net, [num_point,1],
+                padding='VALID', scope='maxpool2')
+            net = tf.squeeze(net, axis=[1,2])
     net = tf.concat([net, one_hot_vec], axis=1)
     net = tf_util.fully_connected(net, 512, scope='fc1', bn=True,
         is_training=is_training, bn_decay=bn_decay)
@@ -136,7 +194,14 @@ def get_3d_box_estimation_v1_net(object_point_cloud, one_hot_vec,
     return output, end_points
 
 
-def get_model(point_cloud, one_hot_vec, is_training, bn_decay=None):
+# End points computed by the T-Net and the box estimation net
+BOX_END_POINTS = ['stage1_center', 'center_boxnet', 'heading_scores',
+                  'heading_residuals_normalized', 'heading_residuals',
+                  'size_scores', 'size_residuals_normalized', 'size_residuals',
+                  'center']
+
+def get_model(point_cloud, one_hot_vec, is_training, bn_decay=None,
+              use_py_func=True, pointwise=False, min_mask_points=0):
     ''' Frustum PointNets model. The model predict 3D object masks and
     amodel bounding boxes for objects in frustum point clouds.
 
@@ -148,6 +213,14 @@ def get_model(point_cloud, one_hot_vec, is_training, bn_decay=None):
             length-3 vectors indicating predicted object type
         is_training: TF boolean scalar
         bn_decay: TF float scalar
+        use_py_func: bool, if False the masked points are gathered without
+            tf.py_func, for exported inference graphs
+        pointwise: bool, if True the 1x1 conv2d stacks are run as
+            tf_util.shared_mlp layers (same variables)
+        min_mask_points: int, for inference only. If > 0, the T-Net and
+            the box estimation net only run on the frustums with at least
+            this many points in the predicted mask; the box outputs of
+            the other frustums are zeros and end_points['box_valid'] is 0
     Output:
         end_points: dict (map from name strings to TF tensors)
     '''
@@ -156,18 +229,30 @@ def get_model(point_cloud, one_hot_vec, is_training, bn_decay=None):
     # 3D Instance Segmentation PointNet
     logits, end_points = get_instance_seg_v1_net(\
         point_cloud, one_hot_vec,
-        is_training, bn_decay, end_points)
+        is_training, bn_decay, end_points, pointwise)
     end_points['mask_logits'] = logits
 
     # Masking
     # select masked points and translate to masked points' centroid
     object_point_cloud_xyz, mask_xyz_mean, end_points = \
-        point_cloud_masking(point_cloud, logits, end_points)
+        point_cloud_masking(point_cloud, logits, end_points,
+            use_py_func=use_py_func)
+
+    box_one_hot_vec = one_hot_vec
+    if min_mask_points > 0:
+        # Compact the batch to the frustums with enough object points
+        batch_size = point_cloud.get_shape()[0].value
+        if batch_size is None:
+            batch_size = tf.shape(point_cloud)[0]
+        box_indices = compact_indices(end_points['mask'], min_mask_points)
+        object_point_cloud_xyz = tf.gather(object_point_cloud_xyz, box_indices)
+        mask_xyz_mean = tf.gather(mask_xyz_mean, box_indices)
+        box_one_hot_vec = tf.gather(one_hot_vec, box_indices)
 
     # T-Net and coordinate translation
     center_delta, end_points = get_center_regression_net(\
-        object_point_cloud_xyz, one_hot_vec,
-        is_training, bn_decay, end_points)
+        object_point_cloud_xyz, box_one_hot_vec,
+        is_training, bn_decay, end_points, pointwise)
     stage1_center = center_delta + mask_xyz_mean # Bx3
     end_points['stage1_center'] = stage1_center
     # Get object point cloud in object coordinate
@@ -176,13 +261,20 @@ def get_model(point_cloud, one_hot_vec, is_training, bn_decay=None):
 
     # Amodel Box Estimation PointNet
     output, end_points = get_3d_box_estimation_v1_net(\
-        object_point_cloud_xyz_new, one_hot_vec,
-        is_training, bn_decay, end_points)
+        object_point_cloud_xyz_new, box_one_hot_vec,
+        is_training, bn_decay, end_points, pointwise)
 
     # Parse output to 3D box parameters
     end_points = parse_output_to_tensors(output, end_points)
     end_points['center'] = end_points['center_boxnet'] + stage1_center # Bx3
 
+    if min_mask_points > 0:
+        # Scatter the box outputs back to the full batch
+        for key in BOX_END_POINTS:
+            end_points[key] = scatter_to_batch(end_points[key], box_indices, batch_size)
+        end_points['box_valid'] = scatter_to_batch(
+            tf.ones_like(box_indices, dtype=tf.float32), box_indices, batch_size)
+
     return end_points
 
 if __name__=='__main__':
@@ -62,13 +62,17 @@ def get_instance_seg_v2_net(point_cloud, one_hot_vec,
         [128,128], is_training, bn_decay, scope='fa_layer3')
 
     # FC layers
-    net = tf_util.conv1d(l0_points, 128, 1, padding='VALID', bn=True,
+    data_format = 'NCHW' if tf_util.use_nchw() else 'NHWC'
+    net = l0_points
+    if data_format == 'NCHW': net = tf.transpose(net, [0,2,1]) # BxCxN
+    net = tf_util.conv1d(net, 128, 1, padding='VALID', bn=True, data_format=data_format,
         is_training=is_training, scope='conv1d-fc1', bn_decay=bn_decay)
-    end_points['feats'] = net 
+    end_points['feats'] = tf.transpose(net, [0,2,1]) if data_format == 'NCHW' else net
     net = tf_util.dropout(net, keep_prob=0.7,
         is_training=is_training, scope='dp1')
-    logits = tf_util.conv1d(net, 2, 1,
+    logits = tf_util.conv1d(net, 2, 1, data_format=data_format,
         padding='VALID', activation_fn=None, scope='conv1d-fc2')
+    if data_format == 'NCHW': logits = tf.transpose(logits, [0,2,1]) # BxNxC
 
     return logits, end_points
 
@@ -120,7 +124,8 @@ def get_3d_box_estimation_v2_net(object_point_cloud, one_hot_vec,
     return output, end_points
 
 
-def get_model(point_cloud, one_hot_vec, is_training, bn_decay=None):
+def get_model(point_cloud, one_hot_vec, is_training, bn_decay=None,
+              use_py_func=True, pointwise=False):
     ''' Frustum PointNets model. The model predict 3D object masks and
     amodel bounding boxes for objects in frustum point clouds.
 
@@ -132,6 +137,10 @@ def get_model(point_cloud, one_hot_vec, is_training, bn_decay=None):
             length-3 vectors indicating predicted object type
         is_training: TF boolean scalar
         bn_decay: TF float scalar
+        use_py_func: bool, if False the masked points are gathered without
+            tf.py_func, for exported inference graphs
+        pointwise: bool, if True the 1x1 conv2d stack of the T-Net is run
+            as tf_util.shared_mlp layers (same variables)
     Output:
         end_points: dict (map from name strings to TF tensors)
     '''
@@ -146,12 +155,13 @@ def get_model(point_cloud, one_hot_vec, is_training, bn_decay=None):
     # Masking
     # select masked points and translate to masked points' centroid
     object_point_cloud_xyz, mask_xyz_mean, end_points = \
-        point_cloud_masking(point_cloud, logits, end_points)
+        point_cloud_masking(point_cloud, logits, end_points,
+            use_py_func=use_py_func)
 
     # T-Net and coordinate translation
     center_delta, end_points = get_center_regression_net(\
         object_point_cloud_xyz, one_hot_vec,
-        is_training, bn_decay, end_points)
+        is_training, bn_decay, end_points, pointwise)
     stage1_center = center_delta + mask_xyz_mean # Bx3
     end_points['stage1_center'] = stage1_center
     # Get object point cloud in object coordinate
@@ -33,12 +33,37 @@ for i in range(NUM_SIZE_CLUSTER):
 # TF Functions Helpers
 # -----------------
 
-def tf_gather_object_pc(point_cloud, mask, npoints=512):
+def tf_mask_to_indices(mask, npoints=512):
+    ''' Graph-only version of the mask_to_indices py_func of
+    tf_gather_object_pc, usable in exported graphs.
+    The masked points are taken in random order, repeated cyclically when
+    there are less than npoints of them; point 0 is taken for empty masks.
+    Input:
+        mask: TF tensor in shape (B,N) of 0 (not pick) or 1 (pick)
+        npoints: int scalar, number of points to gather
+    Output:
+        indices: TF int tensor in shape (B,npoints,2)
+    '''
+    num_point = mask.get_shape()[1].value
+    mask = tf.to_float(mask > 0.5)
+    # masked points first, in random order
+    keys = mask * (1.0 + tf.random_uniform(tf.shape(mask)))
+    _, order = tf.nn.top_k(keys, k=num_point) # BxN
+    count = tf.maximum(tf.to_int32(tf.reduce_sum(mask, 1)), 1) # B
+    pick = tf.expand_dims(tf.range(npoints), 0) % tf.expand_dims(count, 1) # Bxnpoints
+    batch_idx = tf.tile(tf.expand_dims(tf.range(tf.shape(mask)[0]), 1), [1, npoints])
+    point_idx = tf.gather_nd(order, tf.stack([batch_idx, pick], 2))
+    return tf.stack([batch_idx, point_idx], 2)
+
+
+def tf_gather_object_pc(point_cloud, mask, npoints=512, use_py_func=True):
     ''' Gather object point clouds according to predicted masks.
     Input:
         point_cloud: TF tensor in shape (B,N,C)
         mask: TF tensor in shape (B,N) of 0 (not pick) or 1 (pick)
         npoints: int scalar, maximum number of points to keep (default: 512)
+        use_py_func: bool, if False the indices are computed in the graph
+            with tf_mask_to_indices (for exported graphs)
     Output:
         object_pc: TF tensor in shape (B,npoint,C)
         indices: TF int tensor in shape (B,npoint,2)
@@ -61,7 +86,10 @@ def tf_gather_object_pc(point_cloud, mask, npoints=512):
             indices[i,:,0] = i
         return indices
 
-    indices = tf.py_func(mask_to_indices, [mask], tf.int32)  
+    if use_py_func:
+        indices = tf.py_func(mask_to_indices, [mask], tf.int32)  
+    else:
+        indices = tf_mask_to_indices(mask, npoints)
     object_pc = tf.gather_nd(point_cloud, indices)
     return object_pc, indices
 
@@ -152,7 +180,7 @@ def parse_output_to_tensors(output, end_points):
     size_residuals_normalized = tf.slice(output,
         [0,3+NUM_HEADING_BIN*2+NUM_SIZE_CLUSTER], [-1,NUM_SIZE_CLUSTER*3])
     size_residuals_normalized = tf.reshape(size_residuals_normalized,
-        [batch_size, NUM_SIZE_CLUSTER, 3]) # BxNUM_SIZE_CLUSTERx3
+        [-1, NUM_SIZE_CLUSTER, 3]) # BxNUM_SIZE_CLUSTERx3
     end_points['size_scores'] = size_scores
     end_points['size_residuals_normalized'] = size_residuals_normalized
     end_points['size_residuals'] = size_residuals_normalized * \
@@ -189,7 +217,8 @@ def placeholder_inputs(batch_size, num_point):
         size_class_label_pl, size_residual_label_pl
 
 
-def point_cloud_masking(point_cloud, logits, end_points, xyz_only=True):
+def point_cloud_masking(point_cloud, logits, end_points, xyz_only=True,
+                        use_py_func=True):
     ''' Select point cloud with predicted 3D mask,
     translate coordinates to the masked points centroid.
     
@@ -198,6 +227,7 @@ def point_cloud_masking(point_cloud, logits, end_points, xyz_only=True):
         logits: TF tensor in shape (B,N,2)
         end_points: dict
         xyz_only: boolean, if True only return XYZ channels
+        use_py_func: boolean, see tf_gather_object_pc
     Output:
         object_point_cloud: TF tensor in shape (B,M,3)
             for simplicity we only keep XYZ here
@@ -231,40 +261,84 @@ def point_cloud_masking(point_cloud, logits, end_points, xyz_only=True):
     num_channels = point_cloud_stage1.get_shape()[2].value
 
     object_point_cloud, _ = tf_gather_object_pc(point_cloud_stage1,
-        mask, NUM_OBJECT_POINT)
+        mask, NUM_OBJECT_POINT, use_py_func)
     object_point_cloud.set_shape([batch_size, NUM_OBJECT_POINT, num_channels])
 
     return object_point_cloud, tf.squeeze(mask_xyz_mean, axis=1), end_points
 
 
+def compact_indices(mask, min_points):
+    ''' Indices of the frustums whose mask has at least min_points points.
+    Input:
+        mask: TF tensor in shape (B,N), 1 for the object points
+        min_points: int scalar
+    Output:
+        indices: TF int32 tensor in shape (K,)
+    '''
+    mask_count = tf.reduce_sum(mask, axis=1) # B
+    return tf.to_int32(tf.reshape(tf.where(mask_count >= min_points), [-1]))
+
+
+def scatter_to_batch(values, indices, batch_size):
+    ''' Inverse of tf.gather(batch, indices): rows of a compacted batch put
+    back at their indices in the full batch, zeros for the other rows.
+    Input:
+        values: TF tensor in shape (K,...)
+        indices: TF int32 tensor in shape (K,)
+        batch_size: int or TF int scalar, B
+    Output:
+        TF tensor in shape (B,...)
+    '''
+    shape = tf.concat([[batch_size], tf.shape(values)[1:]], axis=0)
+    output = tf.scatter_nd(tf.expand_dims(indices, 1), values, shape)
+    static_batch_size = batch_size if isinstance(batch_size, int) else None
+    output.set_shape(tf.TensorShape([static_batch_size]).concatenate(values.get_shape()[1:]))
+    return output
+
+
 def get_center_regression_net(object_point_cloud, one_hot_vec,
-                              is_training, bn_decay, end_points):
+                              is_training, bn_decay, end_points, pointwise=False):
     ''' Regression network for center delta. a.k.a. T-Net.
     Input:
         object_point_cloud: TF tensor in shape (B,M,C)
             point clouds in 3D mask coordinate
         one_hot_vec: TF tensor in shape (B,3)
             length-3 vectors indicating predicted object type
+        pointwise: bool, if True use tf_util.shared_mlp layers
     Output:
         predicted_center: TF tensor in shape (B,3)
     ''' 
     num_point = object_point_cloud.get_shape()[1].value
-    net = tf.expand_dims(object_point_cloud, 2)
-    net = tf_util.conv2d(net, 128, [1,1],
-                         padding='VALID', stride=[1,1],
-                         bn=True, is_training=is_training,
-                         scope='conv-reg1-stage1', bn_decay=bn_decay)
-    net = tf_util.conv2d(net, 128, [1,1],
-                         padding='VALID', stride=[1,1],
-                         bn=True, is_training=is_training,
-                         scope='conv-reg2-stage1', bn_decay=bn_decay)
-    net = tf_util.conv2d(net, 256, [1,1],
-                         padding='VALID', stride=[1,1],
-                         bn=True, is_training=is_training,
-                         scope='conv-reg3-stage1', bn_decay=bn_decay)
-    net = tf_util.max_pool2d(net, [num_point,1],
-        padding='VALID', scope='maxpool-stage1')
-    net = tf.squeeze(net, axis=[1,2])
+    if pointwise:
+        net = tf_util.shared_mlp(object_point_cloud, 128, bn=True,
+                                 is_training=is_training, scope='conv-reg1-stage1', bn_decay=bn_decay)
+        net = tf_util.shared_mlp(net, 128, bn=True,
+                                 is_training=is_training, scope='conv-reg2-stage1', bn_decay=bn_decay)
+        net = tf_util.shared_mlp(net, 256, bn=True,
+                                 is_training=is_training, scope='conv-reg3-stage1', bn_decay=bn_decay)
+        net = tf.reduce_max(net, axis=1, name='maxpool-stage1')
+    else:
+        data_format = 'NCHW' if tf_util.use_nchw() else 'NHWC'
+        net = tf.expand_dims(object_point_cloud, 2)
+        if data_format == 'NCHW': net = tf.transpose(net, [0,3,1,2]) # BxCxMx1
+        net = tf_util.conv2d(net, 128, [1,1],
+                             padding='VALID', stride=[1,1], data_format=data_format,
+                             bn=True, is_training=is_training,
+                             scope='conv-reg1-stage1', bn_decay=bn_decay)
+        net = tf_util.conv2d(net, 128, [1,1],
+                             padding='VALID', stride=[1,1], data_format=data_format,
+                             bn=True, is_training=is_training,
+                             scope='conv-reg2-stage1', bn_decay=bn_decay)
+        net = tf_util.conv2d(net, 256, [1,1],
+                             padding='VALID', stride=[1,1], data_format=data_format,
+                             bn=True, is_training=is_training,
+                             scope='conv-reg3-stage1', bn_decay=bn_decay)
+        if data_format == 'NCHW':
+            net = tf.reduce_max(net, axis=[2,3], name='maxpool-stage1')
+        else:
+            net = tf_util.max_pool2d(net, [num_point,1],
+                padding='VALID', scope='maxpool-stage1')
+            net = tf.squeeze(net, axis=[1,2])
     net = tf.concat([net, one_hot_vec], axis=1)
     net = tf_util.fully_connected(net, 256, scope='fc1-stage1', bn=True,
         is_training=is_training, bn_decay=bn_decay)
@@ -83,7 +83,7 @@ def sample_and_group_all(xyz, points, use_xyz=True):
     return new_xyz, new_points, idx, grouped_xyz
 
 
-def pointnet_sa_module(xyz, points, npoint, radius, nsample, mlp, mlp2, group_all, is_training, bn_decay, scope, bn=True, pooling='max', knn=False, use_xyz=True, use_nchw=False):
+def pointnet_sa_module(xyz, points, npoint, radius, nsample, mlp, mlp2, group_all, is_training, bn_decay, scope, bn=True, pooling='max', knn=False, use_xyz=True, use_nchw=None):
     ''' PointNet Set Abstraction (SA) Module
         Input:
             xyz: (batch_size, ndataset, 3) TF tensor
@@ -96,12 +96,14 @@ def pointnet_sa_module(xyz, points, npoint, radius, nsample, mlp, mlp2, group_al
             group_all: bool -- group all points into one PC if set true, OVERRIDE
                 npoint, radius and nsample settings
             use_xyz: bool, if True concat XYZ with local point features, otherwise just use point features
-            use_nchw: bool, if True, use NCHW data format for conv2d, which is usually faster than NHWC format
+            use_nchw: bool, if True, use NCHW data format for conv2d, which is usually faster than NHWC format on GPU,
+                None for the tf_util.LAYOUT setting
         Return:
             new_xyz: (batch_size, npoint, 3) TF tensor
             new_points: (batch_size, npoint, mlp[-1] or mlp2[-1]) TF tensor
             idx: (batch_size, npoint, nsample) int32 -- indices for local regions
     '''
+    if use_nchw is None: use_nchw = tf_util.use_nchw()
     data_format = 'NCHW' if use_nchw else 'NHWC'
     with tf.variable_scope(scope) as sc:
         # Sample and Grouping
@@ -152,7 +154,7 @@ def pointnet_sa_module(xyz, points, npoint, radius, nsample, mlp, mlp2, group_al
         new_points = tf.squeeze(new_points, [2]) # (batch_size, npoints, mlp2[-1])
         return new_xyz, new_points, idx
 
-def pointnet_sa_module_msg(xyz, points, npoint, radius_list, nsample_list, mlp_list, is_training, bn_decay, scope, bn=True, use_xyz=True, use_nchw=False):
+def pointnet_sa_module_msg(xyz, points, npoint, radius_list, nsample_list, mlp_list, is_training, bn_decay, scope, bn=True, use_xyz=True, use_nchw=None):
     ''' PointNet Set Abstraction (SA) module with Multi-Scale Grouping (MSG)
         Input:
             xyz: (batch_size, ndataset, 3) TF tensor
@@ -162,11 +164,13 @@ def pointnet_sa_module_msg(xyz, points, npoint, radius_list, nsample_list, mlp_l
             nsample: list of int32 -- how many points in each local region
             mlp: list of list of int32 -- output size for MLP on each point
             use_xyz: bool, if True concat XYZ with local point features, otherwise just use point features
-            use_nchw: bool, if True, use NCHW data format for conv2d, which is usually faster than NHWC format
+            use_nchw: bool, if True, use NCHW data format for conv2d, which is usually faster than NHWC format on GPU,
+                None for the tf_util.LAYOUT setting
         Return:
             new_xyz: (batch_size, npoint, 3) TF tensor
             new_points: (batch_size, npoint, \sum_k{mlp[k][-1]}) TF tensor
     '''
+    if use_nchw is None: use_nchw = tf_util.use_nchw()
     data_format = 'NCHW' if use_nchw else 'NHWC'
     with tf.variable_scope(scope) as sc:
         new_xyz = gather_point(xyz, farthest_point_sample(npoint, xyz))
@@ -187,7 +191,8 @@ def pointnet_sa_module_msg(xyz, points, npoint, radius_list, nsample_list, mlp_l
             for j,num_out_channel in enumerate(mlp_list[i]):
                 grouped_points = tf_util.conv2d(grouped_points, num_out_channel, [1,1],
                                                 padding='VALID', stride=[1,1], bn=bn, is_training=is_training,
-                                                scope='conv%d_%d'%(i,j), bn_decay=bn_decay)
+                                                scope='conv%d_%d'%(i,j), bn_decay=bn_decay,
+                                                data_format=data_format)
             if use_nchw: grouped_points = tf.transpose(grouped_points, [0,2,3,1])
             new_points = tf.reduce_max(grouped_points, axis=[2])
             new_points_list.append(new_points)
@@ -195,7 +200,7 @@ def pointnet_sa_module_msg(xyz, points, npoint, radius_list, nsample_list, mlp_l
         return new_xyz, new_points_concat
 
  
-def pointnet_fp_module(xyz1, xyz2, points1, points2, mlp, is_training, bn_decay, scope, bn=True):
+def pointnet_fp_module(xyz1, xyz2, points1, points2, mlp, is_training, bn_decay, scope, bn=True, use_nchw=None):
     ''' PointNet Feature Propogation (FP) Module
         Input:                                                                                                      
             xyz1: (batch_size, ndataset1, 3) TF tensor                                                              
@@ -203,9 +208,12 @@ def pointnet_fp_module(xyz1, xyz2, points1, points2, mlp, is_training, bn_decay,
             points1: (batch_size, ndataset1, nchannel1) TF tensor                                                   
             points2: (batch_size, ndataset2, nchannel2) TF tensor
             mlp: list of int32 -- output size for MLP on each point                                                 
+            use_nchw: bool, if True, use NCHW data format for conv2d, None for the tf_util.LAYOUT setting
         Return:
             new_points: (batch_size, ndataset1, mlp[-1]) TF tensor
     '''
+    if use_nchw is None: use_nchw = tf_util.use_nchw()
+    data_format = 'NCHW' if use_nchw else 'NHWC'
     with tf.variable_scope(scope) as sc:
         dist, idx = three_nn(xyz1, xyz2)
         dist = tf.maximum(dist, 1e-10)
@@ -219,10 +227,13 @@ def pointnet_fp_module(xyz1, xyz2, points1, points2, mlp, is_training, bn_decay,
         else:
             new_points1 = interpolated_points
         new_points1 = tf.expand_dims(new_points1, 2)
+        if use_nchw: new_points1 = tf.transpose(new_points1, [0,3,1,2])
         for i, num_out_channel in enumerate(mlp):
             new_points1 = tf_util.conv2d(new_points1, num_out_channel, [1,1],
                                          padding='VALID', stride=[1,1],
                                          bn=bn, is_training=is_training,
-                                         scope='conv_%d'%(i), bn_decay=bn_decay)
+                                         scope='conv_%d'%(i), bn_decay=bn_decay,
+                                         data_format=data_format)
+        if use_nchw: new_points1 = tf.transpose(new_points1, [0,2,3,1])
         new_points1 = tf.squeeze(new_points1, [2]) # B,ndataset1,mlp[-1]
         return new_points1
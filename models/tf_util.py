@@ -4,9 +4,79 @@ Author: Charles R. Qi
 Date: November 2017
 """
 
+import json
+import contextlib
 import numpy as np
 import tensorflow as tf
 
+# Tensor layout of the conv stacks built by the models ('NHWC' or 'NCHW')
+# and batch norm implementation, see set_layout and load_layout.
+LAYOUT = {'data_format': 'NHWC', 'fused_batch_norm': True}
+
+
+def set_layout(data_format=None, fused_batch_norm=None):
+  """ Set the layout used by the model builders for the graphs built next.
+
+  Args:
+    data_format: 'NHWC' or 'NCHW', None to keep the current one
+    fused_batch_norm: bool, None to keep the current one
+  """
+  if data_format is not None:
+    assert(data_format=='NHWC' or data_format=='NCHW')
+    LAYOUT['data_format'] = data_format
+  if fused_batch_norm is not None:
+    LAYOUT['fused_batch_norm'] = bool(fused_batch_norm)
+
+
+def load_layout(path, device, mode):
+  """ Set the layout recorded for a device and mode by
+  train/benchmark_model.py --autotune.
+
+  Args:
+    path: JSON file written by the autotuning run
+    device: 'cpu' or 'gpu'
+    mode: 'train' or 'forward'
+
+  Returns:
+    the layout dict, the defaults are kept if nothing is recorded
+  """
+  with open(path, 'r') as f:
+    layouts = json.load(f)
+  best = layouts.get(device, {}).get(mode)
+  if best is not None:
+    set_layout(best['data_format'], best['fused_batch_norm'])
+  return dict(LAYOUT)
+
+
+def use_nchw():
+  return LAYOUT['data_format'] == 'NCHW'
+
+
+# Ops without XLA kernels: tf.py_func and the custom ops of models/tf_ops.
+# They stay outside of the XLA clusters.
+NON_XLA_OPS = set(['PyFunc', 'PyFuncStateless', 'EagerPyFunc',
+                   'FarthestPointSample', 'GatherPoint', 'GatherPointGrad',
+                   'GroupPoint', 'GroupPointGrad', 'ProbSample', 'QueryBallPoint',
+                   'SelectionSort', 'ThreeInterpolate', 'ThreeInterpolateGrad', 'ThreeNN'])
+
+
+@contextlib.contextmanager
+def xla_scope(enabled=True):
+  """ Compile the ops created in this scope with XLA (JIT), except
+  NON_XLA_OPS. Their gradients are compiled as well.
+
+  Args:
+    enabled: bool, if False the scope does nothing
+  """
+  if not enabled:
+    yield
+    return
+  from tensorflow.contrib.compiler import jit
+  with jit.experimental_jit_scope(
+      compile_ops=lambda node_def: node_def.op not in NON_XLA_OPS):
+    yield
+
+
 def _variable_on_cpu(name, shape, initializer, use_fp16=False):
   """Helper to create a Variable stored on CPU memory.
   Args:
@@ -66,13 +136,13 @@ def conv1d(inputs,
   """ 1D convolution with non-linear operation.
 
   Args:
-    inputs: 3-D tensor variable BxLxC
+    inputs: 3-D tensor variable BxLxC, or BxCxL if data_format is 'NCHW'
     num_output_channels: int
     kernel_size: int
     scope: string
     stride: int
     padding: 'SAME' or 'VALID'
-    data_format: 'NHWC' or 'NCHW'
+    data_format: 'NHWC' or 'NCHW', see LAYOUT
     use_xavier: bool, use xavier_initializer if true
     stddev: float, stddev for truncated_normal init
     weight_decay: float
@@ -185,6 +255,76 @@ def conv2d(inputs,
       return outputs
 
 
+def shared_mlp(inputs,
+               num_output_channels,
+               scope,
+               global_feat=None,
+               use_xavier=True,
+               stddev=1e-3,
+               weight_decay=None,
+               activation_fn=tf.nn.relu,
+               bn=False,
+               bn_decay=None,
+               is_training=None):
+  """ Shared MLP layer: the same fully connected layer applied to every point,
+  as a single matmul on the (B*N)xC points.
+
+  Same computation and variables as conv2d with a [1,1] kernel on the
+  BxNx1xC expanded inputs, so checkpoints are interchangeable (the weights
+  keep their 1x1xCxC' conv2d shape).
+
+  If global_feat is given, the layer takes the concatenation of the point
+  features and of global_feat copied to every point, without building it:
+  the global part of the weights is applied once per cloud and broadcast.
+
+  Args:
+    inputs: 3-D tensor BxNxC
+    num_output_channels: int
+    scope: string
+    global_feat: optional 2-D tensor BxG, concatenated after the C channels
+    use_xavier: bool, use xavier_initializer if true
+    stddev: float, stddev for truncated_normal init
+    weight_decay: float
+    activation_fn: function
+    bn: bool, whether to use batch norm
+    bn_decay: float or float tensor variable in [0,1]
+    is_training: bool Tensor variable
+
+  Returns:
+    Variable tensor BxNxnum_output_channels
+  """
+  with tf.variable_scope(scope) as sc:
+    num_point = inputs.get_shape()[1].value
+    num_point_channels = inputs.get_shape()[-1].value
+    num_in_channels = num_point_channels
+    if global_feat is not None:
+      num_in_channels += global_feat.get_shape()[-1].value
+    kernel = _variable_with_weight_decay('weights',
+                                         shape=[1, 1, num_in_channels, num_output_channels],
+                                         use_xavier=use_xavier,
+                                         stddev=stddev,
+                                         wd=weight_decay)
+    kernel = tf.reshape(kernel, [num_in_channels, num_output_channels])
+    points = tf.reshape(inputs, [-1, num_point_channels])
+    if global_feat is None:
+      outputs = tf.matmul(points, kernel)
+    else:
+      outputs = tf.matmul(points, kernel[:num_point_channels])
+      outputs = tf.reshape(outputs, [-1, num_point, num_output_channels])
+      outputs += tf.expand_dims(tf.matmul(global_feat, kernel[num_point_channels:]), 1)
+      outputs = tf.reshape(outputs, [-1, num_output_channels])
+    biases = _variable_on_cpu('biases', [num_output_channels],
+                              tf.constant_initializer(0.0))
+    outputs = tf.nn.bias_add(outputs, biases)
+
+    if bn:
+      outputs = batch_norm_for_fc(outputs, is_training, bn_decay, 'bn')
+
+    if activation_fn is not None:
+      outputs = activation_fn(outputs)
+    return tf.reshape(outputs, [-1, num_point, num_output_channels])
+
+
 def conv2d_transpose(inputs,
                      num_output_channels,
                      kernel_size,
@@ -522,12 +662,18 @@ def batch_norm_template(inputs, is_training, scope, moments_dims_unused, bn_deca
       data_format:   'NHWC' or 'NCHW'
   Return:
       normed:        batch-normalized maps
+
+  If LAYOUT['fused_batch_norm'] is set, the fused kernel is used for 2D and
+  4D inputs (the only ranks it supports). The variables are the same
+  either way.
   """
   bn_decay = bn_decay if bn_decay is not None else 0.9
+  fused = LAYOUT['fused_batch_norm'] and inputs.get_shape().ndims in (2, 4)
   return tf.contrib.layers.batch_norm(inputs, 
                                       center=True, scale=True,
                                       is_training=is_training, decay=bn_decay,updates_collections=None,
                                       scope=scope,
+                                      fused=fused,
                                       data_format=data_format)
 
 
@@ -556,8 +702,13 @@ def batch_norm_for_conv1d(inputs, is_training, bn_decay, scope, data_format):
       data_format: 'NHWC' or 'NCHW'
   Return:
       normed:      batch-normalized maps
+
+  Normalized as 4D BL1C (or BCL1) maps, so that the fused kernel applies.
   """
-  return batch_norm_template(inputs, is_training, scope, [0,1], bn_decay, data_format)
+  axis = 2 if data_format == 'NHWC' else 3
+  outputs = batch_norm_template(tf.expand_dims(inputs, axis), is_training,
+                                scope, [0,1,2], bn_decay, data_format)
+  return tf.squeeze(outputs, [axis])
 
 
 
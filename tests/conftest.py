@@ -0,0 +1,19 @@
+''' The training code is imported as flat modules, as the scripts do. '''
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'train'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'models'))
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def synth_dataset(tmpdir_factory):
+    ''' Root and pixel directories of a small benchmark_pipeline dataset
+    (KittiDataset 'SYNTH', split 'train'). '''
+    from benchmark_pipeline import generate_dataset
+    root_dir = str(tmpdir_factory.mktemp('synth'))
+    pixel_dir = generate_dataset(root_dir, num_frames=4, num_point=4000, num_objects=3, seed=0)
+    return root_dir, pixel_dir
@@ -0,0 +1,45 @@
+from checkpoint_util import retained_checkpoints, write_index, resolve_checkpoint
+
+
+def entry(epoch, score=None):
+    return {'name': 'model_%d.ckpt' % epoch, 'step': epoch * 100, 'epoch': epoch,
+            'metrics': None if score is None else {'score': score}}
+
+
+def test_retention_keeps_last_and_best():
+    entries = [entry(1, 0.5), entry(2, 0.9), entry(3, 0.2), entry(4, 0.7),
+               entry(5, 0.1), entry(6, 0.3)]
+    keep, best = retained_checkpoints(entries, keep_last=2, keep_best=2)
+    assert keep == set(['model_5.ckpt', 'model_6.ckpt', 'model_2.ckpt', 'model_4.ckpt'])
+    assert best == 'model_2.ckpt'
+
+
+def test_retention_without_scores():
+    entries = [entry(1), entry(2), entry(3)]
+    keep, best = retained_checkpoints(entries, keep_last=1, keep_best=3)
+    assert keep == set(['model_3.ckpt'])
+    assert best is None
+
+
+def test_retention_awaits_metrics():
+    # unscored checkpoints wait for the evaluation worker
+    entries = [entry(1, 0.4), entry(2), entry(3, 0.8), entry(4)]
+    keep, best = retained_checkpoints(entries, keep_last=1, keep_best=1, await_metrics=True)
+    assert keep == set(['model_2.ckpt', 'model_3.ckpt', 'model_4.ckpt'])
+    assert best == 'model_3.ckpt'
+
+
+def test_retention_keep_last_zero():
+    entries = [entry(1, 0.4), entry(2, 0.8), entry(3)]
+    keep, best = retained_checkpoints(entries, keep_last=0, keep_best=1)
+    assert keep == set(['model_2.ckpt'])
+    assert best == 'model_2.ckpt'
+
+
+def test_resolve_checkpoint(tmpdir):
+    ckpt_dir = str(tmpdir)
+    write_index(ckpt_dir, {'checkpoints': [entry(1, 0.4), entry(2)],
+                           'latest': 'model_2.ckpt', 'best': 'model_1.ckpt'})
+    assert resolve_checkpoint(ckpt_dir) == str(tmpdir.join('model_1.ckpt'))
+    assert resolve_checkpoint(ckpt_dir, 'latest') == str(tmpdir.join('model_2.ckpt'))
+    assert resolve_checkpoint('log/model.ckpt') == 'log/model.ckpt'
@@ -0,0 +1,101 @@
+import numpy as np
+
+import provider
+from eval_util import match_detections, interpolated_ap, FrameIndex, StreamingEvaluator
+from eval_util import mean_interval, selection_interval
+
+
+def test_match_detections_duplicates_and_unmatched():
+    # detection 1 is a duplicate of the GT box of detection 0, detection 3
+    # has no GT box
+    scores = [0.9, 0.8, 0.7, 0.6]
+    ious = [0.6, 0.55, 0.3, 0.45]
+    gt_index = [0, 0, 1, -1]
+    order, tp = match_detections(scores, ious, gt_index, thresholds=(0.5, 0.25))
+    np.testing.assert_array_equal(order, [0, 1, 2, 3])
+    np.testing.assert_array_equal(tp, [[True, False, False, False],
+                                       [True, False, True, False]])
+
+
+def test_match_detections_orders_by_score():
+    # the higher scored duplicate is matched, even with the lower IoU
+    order, tp = match_detections([0.2, 0.9, 0.5], [0.8, 0.6, 0.1], [0, 0, 1],
+                                 thresholds=(0.5,))
+    np.testing.assert_array_equal(order, [1, 2, 0])
+    np.testing.assert_array_equal(tp, [[True, False, False]])
+
+
+def test_interpolated_ap_11_points():
+    # tp of test_match_detections_duplicates_and_unmatched, 2 GT boxes
+    tp = np.array([[1, 0, 0, 0], [1, 0, 1, 0]], dtype=bool)
+    tp_cum = np.cumsum(tp, axis=1)
+    precision = tp_cum / np.arange(1.0, 5.0)
+    recall = tp_cum / 2.0
+    ap = interpolated_ap(precision, recall)
+    # IoU 0.5: precision 1 up to recall 0.5 (6 of the 11 points)
+    # IoU 0.25: precision 1 up to recall 0.5, then 2/3 up to recall 1
+    np.testing.assert_allclose(ap, [6.0 / 11, (6.0 + 5 * 2.0 / 3) / 11])
+
+
+def test_interpolated_ap_without_detections():
+    np.testing.assert_array_equal(interpolated_ap(np.zeros((2, 0)), np.zeros((2, 0))), [0.0, 0.0])
+
+
+def test_frame_index_non_contiguous_frames():
+    index = FrameIndex([7, 3, 7, 5, 3, 7])
+    assert len(index) == 3
+    assert index.num_frustums(7) == 3
+    np.testing.assert_array_equal(index.frustums(3), [1, 4])
+    np.testing.assert_array_equal(index.frustums(7), [0, 2, 5])
+    parts = index.split(['a', 'b', 'c', 'd', 'e', 'f'])
+    np.testing.assert_array_equal(parts[0], ['b', 'e'])
+    np.testing.assert_array_equal(parts[2], ['a', 'c', 'f'])
+
+
+def test_streaming_evaluator_completes_frames_of_the_index(synth_dataset):
+    root_dir, _ = synth_dataset
+    gt_store = provider.GTStore('SYNTH', 'train', root_dir=root_dir)
+    # one detection per GT box (slightly shifted, box3d_iou is unstable on
+    # identical boxes), the frames interleaved
+    frustums = [(frame_id, j) for frame_id in gt_store.frame_ids
+                for j in range(gt_store.num_objects(frame_id))]
+    frustums = frustums[0::2] + frustums[1::2]
+    frame_ids = np.array([f for f, _ in frustums])
+    rows = np.array([gt_store.slices[f].start + j for f, j in frustums])
+    gt = (gt_store.centers[rows], gt_store.angle_class[rows], gt_store.angle_residual[rows],
+          gt_store.size_class[rows], gt_store.size_residual[rows])
+    pred = (gt[0] + [0.05, 0.0, 0.05],) + gt[1:]
+    evaluator = StreamingEvaluator(gt_store, frame_index=FrameIndex(frame_ids))
+    for start in range(0, len(frustums), 2):
+        batch = slice(start, start + 2)
+        evaluator.add_batch(frame_ids[batch], np.array([j + 1 for _, j in frustums[batch]]),
+                            tuple(x[batch] for x in pred), tuple(x[batch] for x in gt),
+                            [100] * 2, [100] * 2, np.ones(2), np.zeros(2))
+        # a frame is finished as soon as its last frustum is received
+        done = set(frame_ids[:start + 2])
+        done = [f for f in done if f not in set(frame_ids[start + 2:])]
+        assert sorted(evaluator.frame_ids) == sorted(done)
+        assert len(evaluator.pending) == len(set(frame_ids[:start + 2])) - len(done)
+    results = evaluator.metrics()
+    assert results['num_frames'] == len(gt_store.frame_ids)
+    np.testing.assert_allclose(results['frame_precision'], 1.0)
+    np.testing.assert_allclose(results['frame_recall'], 1.0)
+
+
+def test_mean_interval():
+    values = np.array([[1.0, 0.0], [0.5, 0.0], [0.0, 0.0], [0.5, 0.0]])
+    low, high = mean_interval(values)
+    half = 1.96 * np.std(values[:, 0], ddof=1) / 2.0
+    np.testing.assert_allclose(low, [0.5 - half, 0.0])
+    np.testing.assert_allclose(high, [0.5 + half, 0.0])
+    # a single frame says nothing
+    np.testing.assert_array_equal(np.stack(mean_interval(values[:1]), 1), [[0, 1], [0, 1]])
+
+
+def test_selection_interval():
+    results = {'frame_precision': [0.6], 'frame_precision_ci': [[0.5, 0.7]],
+               'overall': {'precision': [0.4], 'precision_ci': [[0.3, 0.5]], 'ap': [0.2]}}
+    assert selection_interval(results) == [0.5, 0.7]
+    assert selection_interval(results, 'precision') == [0.3, 0.5]
+    assert selection_interval(results, 'ap') is None
+    assert selection_interval({'frame_precision': [0.6], 'overall': {}}) is None
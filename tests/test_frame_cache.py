@@ -0,0 +1,80 @@
+import numpy as np
+
+import frame_cache
+import profile_util
+from frame_cache import FrameCache
+
+
+def entry_cache(num_entries):
+    # cache holding num_entries arrays of 100 floats
+    return FrameCache(num_entries * profile_util.deep_nbytes(np.zeros(100)))
+
+
+def test_lru_eviction():
+    cache = entry_cache(3)
+    for key in 'abc':
+        cache.get(key, lambda: np.zeros(100))
+    # a hit makes 'a' the most recent, 'b' is evicted by 'd'
+    cache.get('a', lambda: None)
+    cache.get('d', lambda: np.zeros(100))
+    assert list(cache.entries) == ['c', 'a', 'd']
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 4, 1)
+    assert stats['bytes'] <= stats['max_bytes']
+
+
+def test_oversized_and_disabled():
+    cache = entry_cache(1)
+    cache.get('big', lambda: np.zeros(1000))
+    assert len(cache.entries) == 0
+    cache.set_max_bytes(0)
+    loads = []
+    for _ in range(2):
+        cache.get('a', lambda: loads.append(1) or np.zeros(100))
+    assert len(loads) == 2 and len(cache.entries) == 0
+
+
+def test_cached_arrays_are_read_only():
+    cache = entry_cache(3)
+    value = cache.get('a', lambda: np.zeros(100))
+    assert not value.flags.writeable
+    assert cache.get('a', lambda: None) is value
+
+
+def test_set_max_bytes_evicts():
+    cache = entry_cache(3)
+    for key in 'abc':
+        cache.get(key, lambda: np.zeros(100))
+    cache.set_max_bytes(profile_util.deep_nbytes(np.zeros(100)))
+    assert list(cache.entries) == ['c']
+
+
+def test_dataset_roots_do_not_collide(tmpdir):
+    from benchmark_pipeline import generate_dataset
+    from dataset import KittiDataset
+    frame_cache.FRAME_CACHE.clear()
+    datasets = []
+    for seed in range(2):
+        root_dir = str(tmpdir.mkdir('root%d' % seed))
+        generate_dataset(root_dir, num_frames=1, num_point=1000, num_objects=2, seed=seed)
+        datasets.append(KittiDataset(root_dir, dataset='SYNTH', split='train'))
+    idx = datasets[0].sample_id_list[0]
+    assert datasets[1].sample_id_list[0] == idx
+    lidar = [d.get_lidar(idx) for d in datasets]
+    assert not np.array_equal(lidar[0], lidar[1])
+    assert datasets[0].get_lidar(idx) is lidar[0]
+
+
+def test_label_objects_are_copies(synth_dataset):
+    from dataset import KittiDataset
+    root_dir, _ = synth_dataset
+    dataset = KittiDataset(root_dir, dataset='SYNTH', split='train')
+    idx = dataset.sample_id_list[0]
+    labels = dataset.get_label(idx)
+    box2d = labels[0].box2d.copy()
+    labels[0].box2d[:] = -1
+    del labels[1:]
+    again = dataset.get_label(idx)
+    assert again[0] is not labels[0]
+    assert len(again) > 1
+    np.testing.assert_array_equal(again[0].box2d, box2d)
@@ -0,0 +1,212 @@
+import os
+import numpy as np
+import pytest
+
+import kitti_utils
+
+from provider import voxel_downsample, downsampling_stats
+
+
+def voxel_cloud():
+    # voxels of 1 m: points 0, 2 and 3 share a voxel, point 1 is alone
+    return np.array([[0.1, 0.1, 0.1, 1.0],
+                     [5.5, 0.2, 0.3, 2.0],
+                     [0.5, 0.3, 0.9, 3.0],
+                     [0.9, 0.8, 0.2, 8.0]], dtype=np.float32)
+
+
+def test_voxel_downsample_centroid():
+    pc, labels = voxel_downsample(voxel_cloud(), 1.0)
+    assert labels is None
+    # one point per voxel, in order of the first point of each voxel
+    np.testing.assert_allclose(pc, [[0.5, 0.4, 0.4, 4.0],
+                                    [5.5, 0.2, 0.3, 2.0]], rtol=1e-6)
+
+
+def test_voxel_downsample_first():
+    pc, _ = voxel_downsample(voxel_cloud(), 1.0, reduction='first')
+    np.testing.assert_array_equal(pc, voxel_cloud()[[0, 1]])
+
+
+def test_voxel_downsample_labels_majority_and_ties():
+    pc = np.array([[0.1, 0.1, 0.1], [0.2, 0.2, 0.2],
+                   [2.1, 0.1, 0.1], [2.2, 0.2, 0.2], [2.3, 0.3, 0.3]])
+    # a 1/1 voxel (tie, foreground wins) and a 1/2 voxel (background)
+    _, labels = voxel_downsample(pc, 1.0, np.array([0, 1, 1, 0, 0], dtype=np.int32))
+    np.testing.assert_array_equal(labels, [1, 0])
+    assert labels.dtype == np.int32
+
+
+def test_voxel_downsample_unknown_reduction():
+    with pytest.raises(ValueError):
+        voxel_downsample(voxel_cloud(), 1.0, reduction='max')
+
+
+def test_downsampling_stats():
+    stats = downsampling_stats(np.array([10, 30]), np.array([5, 15]), 0.1, 'centroid')
+    assert stats['mean_points_before'] == 20.0
+    assert stats['mean_points_after'] == 10.0
+    assert stats['max_points_after'] == 15
+    assert stats['ratio'] == 0.5
+
+
+def detection_dataset(synth_dataset, monkeypatch, **kwargs):
+    ''' Val FrustumDataset of the synth frames, the 2D detections being the
+    GT boxes, a box lower than 25 pixels and a box with a few background
+    points (both dropped). '''
+    import shutil
+    import provider
+    from dataset import KittiDataset
+    root_dir, pixel_dir = synth_dataset
+    sets_dir = os.path.join(root_dir, 'SYNTH', 'ImageSets5')
+    shutil.copy(os.path.join(sets_dir, 'train.txt'), os.path.join(sets_dir, 'val.txt'))
+    kitti = KittiDataset(root_dir, dataset='SYNTH', split='train')
+
+    def get_2Dboxes_detected(idx, res, split):
+        boxes = [[int(x) for x in obj.box2d] for obj in kitti.get_label_2D(idx)]
+        return boxes + [[100, 100, 200, 110], [0, 0, 30, 30]]
+    monkeypatch.setattr(provider, 'get_2Dboxes_detected', get_2Dboxes_detected)
+    return provider.FrustumDataset(512, 'SYNTH', 'val', '224', root_dir=root_dir,
+                                   pixel_dir=pixel_dir, **kwargs)
+
+
+@pytest.mark.parametrize('voxel_size', [None, 0.1])
+def test_lazy_extract_equals_eager(synth_dataset, monkeypatch, voxel_size):
+    eager = detection_dataset(synth_dataset, monkeypatch, voxel_size=voxel_size)
+    lazy = detection_dataset(synth_dataset, monkeypatch, voxel_size=voxel_size,
+                             lazy_extract=True, memo_size=2)
+    assert len(eager) == len(lazy) > 0
+    assert lazy.id_list == eager.id_list
+    if voxel_size:
+        # the index counts the points before downsampling
+        counts = lazy.get_point_counts()
+        assert np.mean(counts) == eager.voxel_stats['mean_points_before']
+        assert np.max(counts) == eager.voxel_stats['max_points_before']
+    else:
+        np.testing.assert_array_equal(lazy.get_point_counts(), eager.get_point_counts())
+    for i in range(len(eager)):
+        lazy.load_entry(i)
+        np.testing.assert_array_equal(lazy.input_list[i], eager.input_list[i])
+        np.testing.assert_array_equal(lazy.label_list[i], eager.label_list[i])
+        np.testing.assert_array_equal(lazy.box3d_list[i], eager.box3d_list[i])
+        np.testing.assert_array_equal(lazy.box2d_list[i], eager.box2d_list[i])
+        assert lazy.frustum_angle_list[i] == eager.frustum_angle_list[i]
+        assert lazy.indice_box[i] == eager.indice_box[i]
+    # only memo_size frustums keep their points
+    assert sum(pc is not None for pc in lazy.input_list) == 2
+
+
+def test_lazy_extract_index_reads_no_point_cloud(synth_dataset, monkeypatch):
+    import provider
+    from dataset import KittiDataset
+
+    def fail(*args, **kwargs):
+        raise AssertionError('frustum extracted by the index')
+    for name in ['train_frustum', 'detection_frustum']:
+        monkeypatch.setattr(provider, name, fail)
+    monkeypatch.setattr(KittiDataset, 'get_lidar', fail)
+    dataset = detection_dataset(synth_dataset, monkeypatch, lazy_extract=True)
+    assert len(dataset) == 4 * 3
+    monkeypatch.undo()
+    dataset.load_entry(0)
+    assert dataset.input_list[0] is not None
+
+
+def test_lazy_extract_train_entries(synth_dataset):
+    import provider
+    root_dir, pixel_dir = synth_dataset
+    np.random.seed(0)
+    dataset = provider.FrustumDataset(512, 'SYNTH', 'train', None, root_dir=root_dir,
+                                      pixel_dir=pixel_dir, lazy_extract=True)
+    assert len(dataset) == 5 * 4 * 3
+    assert len(dataset.get_point_counts()) == len(dataset)
+    for i in range(len(dataset)):
+        dataset.load_entry(i)
+        assert np.sum(dataset.label_list[i]) > 0
+
+
+def test_lazy_augment_draws_labelled_frustums(synth_dataset):
+    import provider
+    root_dir, pixel_dir = synth_dataset
+    np.random.seed(0)
+    kwargs = dict(root_dir=root_dir, pixel_dir=pixel_dir, voxel_size=0.1)
+    eager = provider.FrustumDataset(512, 'SYNTH', 'train', None, **kwargs)
+    lazy = provider.FrustumDataset(512, 'SYNTH', 'train', None, lazy_augment=True, **kwargs)
+    # every synth object has foreground points, the eager mode may drop
+    # some of its perturbations
+    assert len(lazy) == 5 * 4 * 3 >= len(eager)
+    assert lazy.voxel_stats is not None
+    eager_boxes = set(tuple(np.round(c, 3).ravel()) for c in eager.box3d_list)
+    kitti = eager.dataset_kitti
+    for i in range(len(lazy)):
+        lazy.draw_frustum(i)
+        assert np.sum(lazy.label_list[i]) > 0
+        assert tuple(np.round(lazy.box3d_list[i], 3).ravel()) in eager_boxes
+        # the eager frustum of the drawn box, over the whole frame
+        frame_id = lazy.id_list[i]
+        gt_obj_list = kitti.get_label(frame_id)
+        gt_corners = kitti_utils.boxes3d_to_corners3d(kitti_utils.objs_to_boxes3d(gt_obj_list),
+                                                      transform=False)
+        frustum = provider.train_frustum(kitti.get_lidar(frame_id),
+                                         provider.get_pixels(frame_id, 'train', pixel_dir),
+                                         np.copy(lazy.box2d_list[i]), gt_obj_list, gt_corners)
+        assert frustum['frustum_angle'] == lazy.frustum_angle_list[i]
+    # the angles of the unperturbed boxes are computed on the cropped frames
+    for i in range(0, len(lazy), 5):
+        box2d = np.copy(lazy.gt_box2d_list[i])
+        frame_id = lazy.id_list[i]
+        pc_lidar = kitti.get_lidar(frame_id)
+        pixels = provider.get_pixels(frame_id, 'train', pixel_dir)
+        center = np.array([(box2d[0]+box2d[2])/2.0, (box2d[1]+box2d[2])/2.0])
+        closest = provider.get_closest_pc_to_center(pc_lidar, pixels, center)
+        assert lazy.extract_frustum(frame_id, box2d)['frustum_angle'] == \
+            - np.arctan2(closest[2], closest[0])
+
+
+@pytest.mark.parametrize('voxel_size,reduction', [(None, 'centroid'), (0.1, 'first'), (0.1, 'centroid')])
+def test_frame_views_equal_eager(synth_dataset, voxel_size, reduction):
+    import provider
+    import profile_util
+    root_dir, pixel_dir = synth_dataset
+    datasets = []
+    for frame_views in [False, True]:
+        np.random.seed(0)
+        datasets.append(provider.FrustumDataset(512, 'SYNTH', 'train', None, root_dir=root_dir,
+            pixel_dir=pixel_dir, voxel_size=voxel_size, voxel_reduction=reduction,
+            frame_views=frame_views))
+    eager, views = datasets
+    assert len(eager) == len(views) > 0
+    for i in range(len(eager)):
+        np.testing.assert_array_equal(views.input_list[i], eager.input_list[i])
+        np.testing.assert_array_equal(views.label_list[i], eager.label_list[i])
+    if voxel_size and reduction == 'centroid':
+        # the centroids are new points, frame_views is ignored
+        assert views.frame_buffers is None
+        return
+    assert views.voxel_stats == eager.voxel_stats
+    assert all(isinstance(view, tuple) for view in views.input_list.views)
+    # the frames and the views hold less than the frustum copies
+    views_bytes = sum(n for _, n in profile_util.dataset_memory(views)) + \
+        profile_util.deep_nbytes(views.frame_buffers.frames)
+    assert views_bytes < sum(n for _, n in profile_util.dataset_memory(eager))
+
+
+def test_frustum_center_mask_keeps_the_closest_points():
+    import provider
+    rng = np.random.RandomState(0)
+    pixels = rng.uniform([0, 0], [1280, 720], size=(300, 2))
+    # the y of center_box2d is (ymin + xmax) / 2, far below this box
+    box2d = np.array([600.0, 100.0, 650.0, 200.0])
+    mask = provider.frustum_center_mask(pixels, box2d)
+    assert 0 < np.sum(mask) < len(pixels)
+    # columns reached by the perturbed boxes (see load_train_frames)
+    band = np.abs(pixels[:,0] - 625.0) <= 50 * (0.2 + 1.2 / 2.0)
+    np.random.seed(0)
+    outside_band = 0
+    for _ in range(200):
+        shifted = provider.random_shift_box2d(box2d)
+        center = np.array([(shifted[0]+shifted[2])/2.0, (shifted[1]+shifted[2])/2.0])
+        closest = np.argmin(np.linalg.norm(pixels - center, axis=1))
+        assert mask[closest]
+        outside_band += not band[closest]
+    assert outside_band > 0
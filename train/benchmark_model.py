@@ -0,0 +1,273 @@
+''' End-to-end throughput benchmark of the Frustum PointNets models.
+
+Builds frustum_pointnets_v1/v2 graphs with random weights and times
+forward (inference) and forward+backward (training step) runs on random
+frustums, sweeping the number of points, the batch size and the TF
+intra/inter-op thread pools, the implementation of the 1x1 conv
+layers (--layers pointwise: tf_util.shared_mlp, conv2d: tf_util.conv2d
+with a tiled global feature), the tensor layout of the conv stacks and
+the batch norm kernel (see tf_util.LAYOUT) and XLA compilation
+(--xla 0,1). The first step, which includes the XLA compilation, is
+reported separately (first_step_time) from the steady state. Reports frustums/sec, latency percentiles
+and peak memory per configuration in a JSON file.
+
+Every configuration runs in its own process by default, so that peak
+memory numbers are not polluted by the previous configurations.
+
+With --autotune, the fastest layout (data format and fused batch norm)
+of each mode is recorded for the device in a JSON file, which train.py,
+eval.py, test.py and eval_worker.py load with --layout_config (and
+--layout_device). The layouts are ranked on the --layers conv2d runs
+only, the data format does not change the pointwise graphs. NCHW
+convolutions are usually not available on CPU, those configurations are
+then reported as failed and not selected.
+
+Usage:
+    python train/benchmark_model.py --models frustum_pointnets_v1 \
+        --num_points 1024,2048,3500 --batch_sizes 1,8,32 --threads 0:0,4:1 \
+        --output bench/model.json
+    python train/benchmark_model.py --models frustum_pointnets_v1 \
+        --num_points 3500 --batch_sizes 32 --layers conv2d,pointwise
+    python train/benchmark_model.py --models frustum_pointnets_v1 \
+        --num_points 1024 --batch_sizes 32 --layers conv2d \
+        --data_formats NHWC,NCHW --fused_bn 1,0 --autotune layout.json
+    python train/benchmark_model.py --models frustum_pointnets_v1 \
+        --num_points 1024 --batch_sizes 32 --xla 0,1
+
+Note: the v2 model depends on the custom ops in models/tf_ops, which only
+have GPU kernels. On CPU its configurations are reported as failed.
+'''
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import itertools
+import subprocess
+import numpy as np
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.join(ROOT_DIR, 'models'))
+import profile_util
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--models', default='frustum_pointnets_v1,frustum_pointnets_v2', help='Comma separated model names [default: v1,v2]')
+parser.add_argument('--num_points', default='1024,2048,3500', help='Comma separated point numbers [default: 1024,2048,3500]')
+parser.add_argument('--batch_sizes', default='1,8,32', help='Comma separated batch sizes [default: 1,8,32]')
+parser.add_argument('--threads', default='0:0', help='Comma separated intra:inter op thread counts, 0 is TF default [default: 0:0]')
+parser.add_argument('--modes', default='forward,train', help='forward and/or train (forward+backward) [default: forward,train]')
+parser.add_argument('--layers', default='conv2d', help='Comma separated 1x1 conv layer implementations, pointwise and/or conv2d [default: conv2d]')
+parser.add_argument('--data_formats', default='NHWC', help='Comma separated conv layouts, NHWC and/or NCHW [default: NHWC]')
+parser.add_argument('--fused_bn', default='1', help='Comma separated fused batch norm settings, 1 and/or 0 [default: 1]')
+parser.add_argument('--xla', default='0', help='Comma separated XLA settings, 0 and/or 1 [default: 0]')
+parser.add_argument('--autotune', default=None, help='Record the fastest layout of each mode for --device in this JSON file')
+parser.add_argument('--steps', type=int, default=20, help='Timed steps per configuration [default: 20]')
+parser.add_argument('--warmup', type=int, default=3, help='Untimed steps per configuration [default: 3]')
+parser.add_argument('--device', default='cpu', help='cpu or gpu [default: cpu]')
+parser.add_argument('--output', default='bench_model.json', help='Result JSON file [default: bench_model.json]')
+parser.add_argument('--no_isolate', action='store_true', help='Run all configurations in this process')
+parser.add_argument('--single', default=None, help=argparse.SUPPRESS)
+
+
+def parse_list(value, cast=int):
+    return [cast(v) for v in value.split(',') if v]
+
+
+def get_configs():
+    threads = [tuple(int(x) for x in t.split(':')) for t in FLAGS.threads.split(',') if t]
+    configs = []
+    for model, num_point, batch_size, (intra, inter), mode, layers, data_format, fused_bn, xla in \
+            itertools.product(parse_list(FLAGS.models, str), parse_list(FLAGS.num_points),
+                              parse_list(FLAGS.batch_sizes), threads, parse_list(FLAGS.modes, str),
+                              parse_list(FLAGS.layers, str), parse_list(FLAGS.data_formats, str),
+                              parse_list(FLAGS.fused_bn), parse_list(FLAGS.xla)):
+        configs.append({'model': model, 'num_point': num_point,
+                        'batch_size': batch_size, 'intra_op': intra,
+                        'inter_op': inter, 'mode': mode, 'layers': layers,
+                        'data_format': data_format, 'fused_batch_norm': bool(fused_bn),
+                        'xla': bool(xla)})
+    return configs
+
+
+def config_name(config):
+    return '%s/%s/n%d/b%d/t%d:%d/%s/%s%s%s' % (config['model'], config['mode'],
+        config['num_point'], config['batch_size'], config['intra_op'], config['inter_op'],
+        config.get('layers', 'conv2d'), config.get('data_format', 'NHWC'),
+        '' if config.get('fused_batch_norm', True) else '/unfused_bn',
+        '/xla' if config.get('xla') else '')
+
+
+def run_config(config):
+    ''' Build the graph of one configuration and time it.
+    Output:
+        result: dict with 'time' (per step), 'first_step_time' (with the
+            graph compilation), 'frustums_per_sec',
+            'peak_rss_bytes', 'graph_rss_bytes'
+    '''
+    import tensorflow as tf
+    import tf_util
+    tf_util.set_layout(config.get('data_format', 'NHWC'), config.get('fused_batch_norm', True))
+    MODEL = importlib.import_module(config['model'])
+    batch_size = config['batch_size']
+    num_point = config['num_point']
+    rss_start = profile_util.peak_rss_bytes()
+
+    with tf.Graph().as_default():
+        with tf.device('/%s:0' % FLAGS.device):
+            pointclouds_pl, one_hot_vec_pl, labels_pl, centers_pl, \
+            heading_class_label_pl, heading_residual_label_pl, \
+            size_class_label_pl, size_residual_label_pl = \
+                MODEL.placeholder_inputs(batch_size, num_point)
+            is_training_pl = tf.placeholder(tf.bool, shape=())
+            with tf_util.xla_scope(config.get('xla', False)):
+                end_points = MODEL.get_model(pointclouds_pl, one_hot_vec_pl,
+                    is_training_pl, bn_decay=None,
+                    pointwise=config.get('layers', 'conv2d') == 'pointwise')
+                if config['mode'] == 'train':
+                    loss = MODEL.get_loss(labels_pl, centers_pl,
+                        heading_class_label_pl, heading_residual_label_pl,
+                        size_class_label_pl, size_residual_label_pl, end_points)
+            if config['mode'] == 'train':
+                fetches = tf.train.AdamOptimizer(0.001).minimize(loss)
+            else:
+                fetches = [end_points['mask_logits'], end_points['center'],
+                    end_points['heading_scores'], end_points['heading_residuals'],
+                    end_points['size_scores'], end_points['size_residuals']]
+
+        sess_config = tf.ConfigProto()
+        sess_config.intra_op_parallelism_threads = config['intra_op']
+        sess_config.inter_op_parallelism_threads = config['inter_op']
+        sess_config.allow_soft_placement = True
+        sess_config.gpu_options.allow_growth = True
+        sess = tf.Session(config=sess_config)
+        sess.run(tf.global_variables_initializer())
+
+        feed_dict = {pointclouds_pl: np.random.randn(batch_size, num_point, 4),
+                     one_hot_vec_pl: np.tile([0, 1, 0], (batch_size, 1)),
+                     is_training_pl: config['mode'] == 'train'}
+        if config['mode'] == 'train':
+            feed_dict.update({
+                labels_pl: np.random.randint(0, 2, (batch_size, num_point)),
+                centers_pl: np.random.randn(batch_size, 3),
+                heading_class_label_pl: np.random.randint(0, 12, batch_size),
+                heading_residual_label_pl: np.random.randn(batch_size) * 0.1,
+                size_class_label_pl: np.full(batch_size, 3),
+                size_residual_label_pl: np.random.randn(batch_size, 3) * 0.1})
+
+        start = time.time()
+        sess.run(fetches, feed_dict=feed_dict)
+        first_step_time = time.time() - start
+        for _ in range(FLAGS.warmup - 1):
+            sess.run(fetches, feed_dict=feed_dict)
+        warmup_time = time.time() - start
+        times = []
+        for _ in range(FLAGS.steps):
+            start = time.time()
+            sess.run(fetches, feed_dict=feed_dict)
+            times.append(time.time() - start)
+        sess.close()
+
+    summary = profile_util.summarize_times(times)
+    peak_rss = profile_util.peak_rss_bytes()
+    return {'config': config,
+            'time': summary,
+            'first_step_time': first_step_time,
+            'warmup_time': warmup_time,
+            'frustums_per_sec': batch_size / summary['mean'],
+            'peak_rss_bytes': peak_rss,
+            'graph_rss_bytes': peak_rss - rss_start if rss_start is not None else None}
+
+
+def run_isolated(config):
+    ''' Run one configuration in a child process. '''
+    env = dict(os.environ)
+    if FLAGS.device == 'cpu':
+        env['CUDA_VISIBLE_DEVICES'] = ''
+    cmd = [sys.executable, os.path.abspath(__file__), '--single', json.dumps(config),
+           '--steps', str(FLAGS.steps), '--warmup', str(FLAGS.warmup),
+           '--device', FLAGS.device]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = proc.communicate()
+    out = out.decode('utf-8', 'replace')
+    for line in reversed(out.splitlines()):
+        if line.startswith('RESULT '):
+            return json.loads(line[len('RESULT '):])
+    return {'config': config, 'error': err.decode('utf-8', 'replace').strip().splitlines()[-1:]}
+
+
+def layout_key(config):
+    return config.get('data_format', 'NHWC'), config.get('fused_batch_norm', True)
+
+
+def autotune(results, path):
+    ''' Record the fastest layout of each mode in a JSON file.
+
+    A layout is ranked on the geometric mean of its frustums/sec over the
+    other swept parameters; layouts which failed on any of them are
+    not eligible. Only the --layers conv2d configurations are ranked: the
+    pointwise layers are matmuls, whose graph does not depend on the data
+    format. The file keeps the results of the other devices.
+    '''
+    layouts = profile_util.load_results(path) if os.path.exists(path) else {}
+    best_modes = {'environment': profile_util.environment_info()}
+    for mode in parse_list(FLAGS.modes, str):
+        rates = {}
+        for res in results.values():
+            config = res['config']
+            if config['mode'] != mode or config.get('layers', 'conv2d') != 'conv2d':
+                continue
+            rate = res.get('frustums_per_sec', 0.0)
+            rates.setdefault(layout_key(config), []).append(rate)
+        scores = dict((key, float(np.exp(np.mean(np.log(r)))))
+                      for key, r in rates.items() if min(r) > 0)
+        if not scores:
+            print('%s: no conv2d layout ran' % mode)
+            continue
+        data_format, fused = max(scores, key=scores.get)
+        best_modes[mode] = {'data_format': data_format, 'fused_batch_norm': fused,
+                            'frustums_per_sec': scores[(data_format, fused)]}
+        for (df, fu), score in sorted(scores.items(), key=lambda x: -x[1]):
+            print('%-8s %-5s fused_bn=%d %8.1f frustums/s' % (mode, df, fu, score))
+    layouts[FLAGS.device] = best_modes
+    with open(path, 'w') as f:
+        json.dump(layouts, f, indent=1, sort_keys=True)
+    print('Layouts written to %s' % path)
+
+
+def main():
+    if FLAGS.single is not None:
+        config = json.loads(FLAGS.single)
+        print('RESULT ' + json.dumps(run_config(config)))
+        return
+
+    results = {}
+    for config in get_configs():
+        name = config_name(config)
+        if FLAGS.no_isolate:
+            try:
+                res = run_config(config)
+            except Exception as e:
+                res = {'config': config, 'error': [str(e)]}
+        else:
+            res = run_isolated(config)
+        results[name] = res
+        if 'error' in res:
+            print('%-50s FAILED %s' % (name, ' '.join(res['error'])))
+        else:
+            print('%-50s %8.1f frustums/s  p50 %8.2f ms  p99 %8.2f ms  first %7.2f s  peak %s' % \
+                (name, res['frustums_per_sec'], res['time']['p50']*1000,
+                 res['time']['p99']*1000, res['first_step_time'],
+                 profile_util.format_bytes(res['peak_rss_bytes'])))
+    profile_util.write_results(FLAGS.output, results, dict(vars(FLAGS)))
+    print('Results written to %s' % FLAGS.output)
+    if FLAGS.autotune is not None:
+        autotune(results, FLAGS.autotune)
+
+
+if __name__ == '__main__':
+    FLAGS = parser.parse_args()
+    main()
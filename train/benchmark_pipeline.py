@@ -0,0 +1,320 @@
+''' Microbenchmarks for the stages of the Frustum PointNets data pipeline.
+
+A small synthetic RSC-like dataset (pcd lidar scans, pixel projections,
+3D and 2D labels) is generated in a temporary directory, then every stage
+is timed on it. Results (timing percentiles, throughput and peak memory)
+are written to a JSON file, and can be compared to a previous run to
+catch regressions.
+
+Usage:
+    python train/benchmark_pipeline.py --num_frames 8 --num_point_frame 20000 \
+        --output bench/pipeline.json [--baseline bench/pipeline_old.json]
+'''
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.join(ROOT_DIR, 'models'))
+import provider
+import frame_cache
+import kitti_utils
+from dataset import KittiDataset
+from box_util import box3d_iou
+from train_util import get_batch
+from eval_util import NMS, precision_recall
+import profile_util
+
+STAGES = ['get_lidar', 'get_pixels', 'extract_pc_in_box2d', 'extract_pc_in_rect',
+          'in_hull', 'in_box3d', 'voxel_downsample', 'frustum_getitem', 'get_batch', 'box3d_iou', 'nms', 'precision_recall']
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_frames', type=int, default=8, help='Number of generated frames [default: 8]')
+parser.add_argument('--num_point_frame', type=int, default=20000, help='Lidar points per frame [default: 20000]')
+parser.add_argument('--num_objects', type=int, default=4, help='Pedestrians per frame [default: 4]')
+parser.add_argument('--num_point', type=int, default=3500, help='Frustum point number for __getitem__/get_batch [default: 3500]')
+parser.add_argument('--batch_size', type=int, default=32, help='Batch size for get_batch [default: 32]')
+parser.add_argument('--voxel_size', type=float, default=0.05, help='Voxel size of the voxel_downsample stage in meters [default: 0.05]')
+parser.add_argument('--repeats', type=int, default=5, help='Timed runs per stage [default: 5]')
+parser.add_argument('--warmup', type=int, default=1, help='Untimed runs per stage [default: 1]')
+parser.add_argument('--stages', default=','.join(STAGES), help='Comma separated stages to run [default: all]')
+parser.add_argument('--output', default='bench_pipeline.json', help='Result JSON file [default: bench_pipeline.json]')
+parser.add_argument('--baseline', default=None, help='Result JSON of a previous run to compare to [default: None]')
+parser.add_argument('--tolerance', type=float, default=0.1, help='Relative slowdown reported as regression [default: 0.1]')
+parser.add_argument('--data_dir', default=None, help='Where to generate the data, kept after the run [default: temp dir]')
+parser.add_argument('--frame_cache_mb', type=int, default=0, help='Frame file cache size, 0 so that the loading stages read the files [default: 0]')
+parser.add_argument('--seed', type=int, default=0, help='Random seed [default: 0]')
+
+IMG_WIDTH = 1280
+IMG_HEIGHT = 720
+FOCAL = 700.0
+
+
+class _Quiet(object):
+    ''' Silence the per-frame prints of the pipeline while timing. '''
+    def __enter__(self):
+        self.stdout = sys.stdout
+        self.devnull = open(os.devnull, 'w')
+        sys.stdout = self.devnull
+    def __exit__(self, *args):
+        sys.stdout = self.stdout
+        self.devnull.close()
+
+
+def kitti_to_rsc(pc):
+    ''' Inverse of kitti_utils.trans_RSC_to_Kitti. '''
+    pc = R.from_rotvec(np.pi/2 * np.array([0, 1, 0])).apply(pc)
+    return R.from_rotvec(-np.pi/2 * np.array([1, 0, 0])).apply(pc)
+
+
+def write_pcd(path, xyz, rgb):
+    ''' Write a binary pcd file with x y z rgb float fields, as read by
+    KittiDataset.get_lidar. rgb: (N,3) uint8 '''
+    num = xyz.shape[0]
+    rgb = rgb.astype(np.uint32)
+    packed = (rgb[:,0] << 16) | (rgb[:,1] << 8) | rgb[:,2]
+    data = np.zeros((num, 4), dtype=np.float32)
+    data[:,0:3] = xyz
+    data[:,3] = packed.view(np.float32)
+    header = ('# .PCD v0.7 - Point Cloud Data file format\n'
+              'VERSION 0.7\nFIELDS x y z rgb\nSIZE 4 4 4 4\nTYPE F F F F\n'
+              'COUNT 1 1 1 1\nWIDTH %d\nHEIGHT 1\nVIEWPOINT 0 0 0 1 0 0 0\n'
+              'POINTS %d\nDATA binary\n' % (num, num))
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(data.tobytes())
+
+
+def generate_frame(num_point, num_objects, rng):
+    ''' Random frame in camera (KITTI) coordinates.
+    Output:
+        xyz: (N,3), pixels: (N,2), rgb: (N,3) uint8
+        label_lines: list of KITTI format label strings
+    '''
+    num_fg = num_point // 4
+    pts_per_obj = max(num_fg // max(num_objects, 1), 1)
+    xyz_list = []
+    pixel_list = []
+    label_lines = []
+    for _ in range(num_objects):
+        h, w, l = rng.uniform(1.5, 1.9), rng.uniform(0.5, 0.8), rng.uniform(0.5, 0.9)
+        z = rng.uniform(6.0, 30.0)
+        x = rng.uniform(-0.3, 0.3) * z
+        y = 0.8
+        ry = rng.uniform(-np.pi, np.pi)
+        local = (rng.random_sample((pts_per_obj, 3)) - 0.5) * np.array([w, h, l])
+        pts = R.from_rotvec(ry * np.array([0, 1, 0])).apply(local) + np.array([x, y, z])
+        u, v = IMG_WIDTH/2.0 + FOCAL*x/z, IMG_HEIGHT/2.0 + FOCAL*y/z
+        half_w, half_h = FOCAL*w/z, FOCAL*h/z/2.0
+        box2d = [u-half_w, v-half_h, u+half_w, v+half_h]
+        pix = np.stack([rng.uniform(box2d[0], box2d[2], pts_per_obj),
+                        rng.uniform(box2d[1], box2d[3], pts_per_obj)], axis=1)
+        xyz_list.append(pts)
+        pixel_list.append(pix)
+        label_lines.append('Pedestrian 0.00 0 0.00 %.2f %.2f %.2f %.2f %.2f %.2f %.2f %.2f %.2f %.2f %.2f' % \
+            (box2d[0], box2d[1], box2d[2], box2d[3], w, l, h, x, y, z, ry))
+    num_bg = num_point - pts_per_obj * num_objects
+    bg = np.stack([rng.uniform(-20, 20, num_bg), rng.uniform(-2, 2, num_bg),
+                   rng.uniform(2, 40, num_bg)], axis=1)
+    bg_pix = np.stack([rng.uniform(0, IMG_WIDTH, num_bg),
+                       rng.uniform(0, IMG_HEIGHT, num_bg)], axis=1)
+    xyz = np.concatenate(xyz_list + [bg], axis=0)
+    pixels = np.concatenate(pixel_list + [bg_pix], axis=0)
+    rgb = rng.randint(0, 256, size=(xyz.shape[0], 3))
+    return xyz, pixels, rgb, label_lines
+
+
+def generate_dataset(root_dir, num_frames, num_point, num_objects, seed):
+    ''' Write a synthetic dataset readable by KittiDataset(root_dir, 'SYNTH').
+    Returns the directory of the pixel projection files. '''
+    rng = np.random.RandomState(seed)
+    base = os.path.join(root_dir, 'SYNTH')
+    training = os.path.join(base, 'object', 'training')
+    dirs = {'velodyne': os.path.join(training, 'velodyne'),
+            'label': os.path.join(training, 'label_2_kitti2'),
+            'label2d': os.path.join(training, 'lables2D_rect_all_hand'),
+            'pixels': os.path.join(training, 'pc_to_pixels'),
+            'sets': os.path.join(base, 'ImageSets5')}
+    for d in dirs.values():
+        if not os.path.exists(d):
+            os.makedirs(d)
+    with open(os.path.join(dirs['sets'], 'train.txt'), 'w') as f:
+        for idx in range(num_frames):
+            f.write('%06d\n' % idx)
+    for idx in range(num_frames):
+        xyz, pixels, rgb, label_lines = generate_frame(num_point, num_objects, rng)
+        write_pcd(os.path.join(dirs['velodyne'], '%06d.pcd' % idx), kitti_to_rsc(xyz), rgb)
+        np.savetxt(os.path.join(dirs['pixels'], '%06d.txt' % idx), pixels, delimiter=',', fmt='%.3f')
+        for key in ['label', 'label2d']:
+            with open(os.path.join(dirs[key], '%06d.txt' % idx), 'w') as f:
+                f.write('\n'.join(label_lines) + '\n')
+    return dirs['pixels']
+
+
+def run_benchmarks(root_dir, pixel_dir, stages):
+    kitti = KittiDataset(root_dir=root_dir, dataset='SYNTH', mode='TRAIN', split='train')
+    ids = kitti.sample_id_list
+    with _Quiet():
+        lidar = dict((i, kitti.get_lidar(i)) for i in ids)
+        pixels = dict((i, provider.get_pixels(i, 'train', pixel_dir=pixel_dir)) for i in ids)
+    gt_objs = dict((i, kitti.get_label(i)) for i in ids)
+    gt_boxes = dict((i, kitti_utils.objs_to_boxes3d(gt_objs[i])) for i in ids)
+    gt_corners = dict((i, kitti_utils.boxes3d_to_corners3d(gt_boxes[i], transform=False)) for i in ids)
+    boxes2d = [(i, obj.box2d) for i in ids for obj in kitti.get_label_2D(i)]
+
+    # Reference frustums and labels, used as inputs of the later stages
+    samples = []
+    with _Quiet():
+        for i, box2d in boxes2d:
+            frus_pc, _ = provider.extract_pc_in_box2d(lidar[i], pixels[i], np.copy(box2d))
+            if frus_pc.shape[0] == 0:
+                continue
+            cls_label = np.zeros((frus_pc.shape[0]), dtype=np.int32)
+            for k in range(gt_corners[i].shape[0]):
+                cls_label[kitti_utils.in_hull(frus_pc[:,0:3], gt_corners[i][k])] = k+1
+            k = int(np.argmax(np.bincount(cls_label, minlength=2)[1:]))
+            obj = gt_boxes[i][k]
+            samples.append({'id': i, 'gt': k+1, 'pc': frus_pc,
+                            'seg': np.where(cls_label == k+1, 1.0, 0.0),
+                            'corners': gt_corners[i][k], 'heading': obj[6],
+                            'size': np.array([obj[3], obj[4], obj[5]]),
+                            'frustum_angle': -np.arctan2(obj[2], obj[0])})
+    dataset = provider.FrustumDataset.from_frustums(FLAGS.num_point, samples, random_shift=True,
+                                                    rotate_to_center=True, one_hot=True)
+    dataset_idxs = np.arange(len(dataset))
+
+    # Predictions around the GT boxes for box3d_iou and NMS
+    rng = np.random.RandomState(FLAGS.seed)
+    def jitter_box(sample):
+        center = (sample['corners'][0,:] + sample['corners'][6,:]) / 2.0
+        return provider.get_3d_box(sample['size'] * rng.uniform(0.8, 1.2, 3),
+            sample['heading'] + rng.uniform(-0.3, 0.3), center + rng.normal(0, 0.2, 3))
+    iou_pairs = [(jitter_box(s), s['corners']) for s in samples]
+    nms_input = [[], [], [], [], [], []]
+    for i in ids:
+        frame_samples = [s for s in samples if s['id'] == i]
+        preds = [jitter_box(s) for s in frame_samples for _ in range(5)]
+        nms_input[0].append([i] * len(preds))
+        nms_input[1].append(preds)
+        nms_input[2].append(list(rng.random_sample(len(preds))))
+        nms_input[3].append([100] * len(preds))
+        nms_input[4].append(list(rng.random_sample(len(preds))))
+        nms_input[5].append([s['gt'] for s in frame_samples for _ in range(5)])
+
+    def stage_get_lidar():
+        for i in ids:
+            kitti.get_lidar(i)
+    def stage_get_pixels():
+        for i in ids:
+            provider.get_pixels(i, 'train', pixel_dir=pixel_dir)
+    def stage_extract():
+        for i, box2d in boxes2d:
+            provider.extract_pc_in_box2d(lidar[i], pixels[i], np.copy(box2d))
+    def stage_extract_rect():
+        for i, box2d in boxes2d:
+            provider.extract_pc_in_rect(lidar[i], pixels[i], box2d)
+    def stage_in_hull():
+        for s in samples:
+            for corners in gt_corners[s['id']]:
+                kitti_utils.in_hull(s['pc'][:,0:3], corners)
+    def stage_in_box3d():
+        for s in samples:
+            for corners in gt_corners[s['id']]:
+                kitti_utils.in_box3d(s['pc'][:,0:3], corners)
+    def stage_voxel_downsample():
+        for sample in samples:
+            provider.voxel_downsample(sample['pc'], FLAGS.voxel_size, sample['seg'])
+    def stage_getitem():
+        for k in range(len(dataset)):
+            dataset[k]
+    def stage_get_batch():
+        for start in range(0, len(dataset) - FLAGS.batch_size + 1, FLAGS.batch_size):
+            get_batch(dataset, dataset_idxs, start, start + FLAGS.batch_size, FLAGS.num_point, 4)
+    def stage_box3d_iou():
+        for pred, gt in iou_pairs:
+            box3d_iou(pred, gt)
+    def stage_nms():
+        for corners, scores, indices in zip(nms_input[1], nms_input[4], nms_input[5]):
+            NMS(corners, scores, groups=indices)
+    gt_store = provider.GTStore('SYNTH', 'train', root_dir=root_dir)
+    def stage_precision_recall():
+        precision_recall(ids, nms_input[1], nms_input[4], nms_input[2],
+                         nms_input[5], gt_store)
+
+    num_batches = len(dataset) // FLAGS.batch_size
+    table = {'get_lidar': (stage_get_lidar, len(ids)),
+             'get_pixels': (stage_get_pixels, len(ids)),
+             'extract_pc_in_box2d': (stage_extract, len(boxes2d)),
+             'extract_pc_in_rect': (stage_extract_rect, len(boxes2d)),
+             'in_hull': (stage_in_hull, sum(len(gt_corners[s['id']]) for s in samples)),
+             'in_box3d': (stage_in_box3d, sum(len(gt_corners[s['id']]) for s in samples)),
+             'voxel_downsample': (stage_voxel_downsample, len(samples)),
+             'frustum_getitem': (stage_getitem, len(dataset)),
+             'get_batch': (stage_get_batch, num_batches * FLAGS.batch_size),
+             'box3d_iou': (stage_box3d_iou, len(iou_pairs)),
+             'nms': (stage_nms, sum(len(p) for p in nms_input[1])),
+             'precision_recall': (stage_precision_recall, sum(len(p) for p in nms_input[1]))}
+
+    results = {}
+    for stage in stages:
+        fn, items = table[stage]
+        if items == 0:
+            print('%-20s skipped (no items)' % stage)
+            continue
+        with _Quiet():
+            results[stage] = profile_util.measure(fn, repeats=FLAGS.repeats,
+                warmup=FLAGS.warmup, items=items)
+        res = results[stage]
+        print('%-20s p50 %9.2f ms  p90 %9.2f ms  %10.1f items/s  peak %s' % \
+            (stage, res['time']['p50']*1000, res['time']['p90']*1000,
+             res['items_per_sec'], profile_util.format_bytes(res['peak_mem_bytes'])))
+        if stage == 'voxel_downsample':
+            after = [len(provider.voxel_downsample(sample['pc'], FLAGS.voxel_size)[0])
+                     for sample in samples]
+            res['mean_points_before'] = float(np.mean([len(sample['pc']) for sample in samples]))
+            res['mean_points_after'] = float(np.mean(after))
+            print('%-20s %.1f -> %.1f mean points per frustum' % ('', res['mean_points_before'],
+                                                                 res['mean_points_after']))
+    return results
+
+
+def main():
+    frame_cache.FRAME_CACHE.set_max_bytes(FLAGS.frame_cache_mb * 1024**2)
+    stages = [s for s in FLAGS.stages.split(',') if s]
+    for stage in stages:
+        assert stage in STAGES, 'Unknown stage %s' % stage
+    root_dir = FLAGS.data_dir if FLAGS.data_dir is not None else tempfile.mkdtemp(prefix='frustum_bench_')
+    try:
+        pixel_dir = generate_dataset(root_dir, FLAGS.num_frames, FLAGS.num_point_frame,
+                                     FLAGS.num_objects, FLAGS.seed)
+        results = run_benchmarks(root_dir, pixel_dir, stages)
+    finally:
+        if FLAGS.data_dir is None:
+            shutil.rmtree(root_dir)
+
+    config = dict(vars(FLAGS))
+    profile_util.write_results(FLAGS.output, results, config)
+    print('Results written to %s' % FLAGS.output)
+
+    if FLAGS.baseline is not None:
+        rows = profile_util.compare_results(profile_util.load_results(FLAGS.baseline),
+            profile_util.load_results(FLAGS.output), tolerance=FLAGS.tolerance)
+        regressed = False
+        for stage, base_t, cur_t, ratio, is_regression in rows:
+            print('%-20s %9.2f ms -> %9.2f ms  x%.2f %s' % (stage, base_t*1000, cur_t*1000,
+                ratio, 'REGRESSION' if is_regression else ''))
+            regressed = regressed or is_regression
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    FLAGS = parser.parse_args()
+    main()
@@ -0,0 +1,232 @@
+''' Checkpointing with a background writer and a retention policy.
+
+CheckpointWriter snapshots the variables of the training session (one
+sess.run) and writes the checkpoint from a background thread, through a
+shadow copy of the variables in a separate CPU graph, so training does not
+wait for the disk. After every write the retention policy is applied:
+the last keep_last checkpoints and the keep_best checkpoints with the
+highest score are kept, the others are deleted.
+
+The checkpoints and their metrics are listed in <ckpt_dir>/checkpoints.json:
+    {"checkpoints": [{"name": "model_10.ckpt", "step": 5230, "epoch": 10,
+                      "time": ..., "metrics": {"score": 0.71, ...}}, ...],
+     "latest": "model_10.ckpt", "best": "model_10.ckpt"}
+resolve_checkpoint turns a checkpoint directory into the path of its best
+(or latest) checkpoint, e.g. for eval.py --restore_model_path.
+'''
+from __future__ import print_function
+
+import os
+import glob
+import json
+import time
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import tensorflow as tf
+
+INDEX_FILE = 'checkpoints.json'
+
+
+def read_index(ckpt_dir):
+    ''' Content of the checkpoint index of a directory, empty if missing. '''
+    path = os.path.join(ckpt_dir, INDEX_FILE)
+    if not os.path.exists(path):
+        return {'checkpoints': [], 'latest': None, 'best': None}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_index(ckpt_dir, index):
+    ''' Write the checkpoint index atomically, readers never see a partial file. '''
+    path = os.path.join(ckpt_dir, INDEX_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def resolve_checkpoint(path, which='best'):
+    ''' Checkpoint path to restore.
+    Input:
+        path: checkpoint path (returned as is) or checkpoint directory
+        which: 'best' or 'latest' checkpoint of a directory; 'best' falls
+            back to the latest one when no checkpoint has a score
+    '''
+    if path is None or not os.path.isdir(path):
+        return path
+    index = read_index(path)
+    name = index.get(which) or index.get('latest')
+    if name is None:
+        latest = tf.train.latest_checkpoint(path)
+        if latest is None:
+            raise ValueError('No checkpoint in %s' % path)
+        return latest
+    return os.path.join(path, name)
+
+
+def delete_checkpoint(path):
+    for filename in glob.glob(path + '.*'):
+        os.remove(filename)
+
+
+def checkpoint_score(entry, score_key='score'):
+    ''' Score of an index entry, None if it has no metrics[score_key]. '''
+    if entry['metrics'] is None or score_key not in entry['metrics']:
+        return None
+    return entry['metrics'][score_key]
+
+
+def retained_checkpoints(entries, keep_last, keep_best, score_key='score', await_metrics=False):
+    ''' Retention policy of CheckpointWriter.
+    Input:
+        entries: index entries, oldest first
+    Output:
+        keep: set of the names of the checkpoints to keep
+        best: name of the best kept checkpoint, None if none has a score
+    '''
+    score = lambda e: checkpoint_score(e, score_key)
+    keep = set(e['name'] for e in entries[-keep_last:]) if keep_last > 0 else set()
+    scored = sorted([e for e in entries if score(e) is not None], key=score, reverse=True)
+    keep.update(e['name'] for e in scored[:keep_best])
+    if await_metrics:
+        keep.update(e['name'] for e in entries if score(e) is None)
+    scored = [e for e in scored if e['name'] in keep]
+    return keep, scored[0]['name'] if scored else None
+
+
+class CheckpointWriter(object):
+    ''' Asynchronous checkpoint saving with keep-last-N / keep-best-K retention.
+
+    save() returns once the variable values are copied to host memory;
+    at most max_pending snapshots wait for the writer thread, save() blocks
+    when the writer is further behind. close() waits for the pending writes.
+
+    Checkpoints are ranked on metrics[score_key] (higher is better).
+    Checkpoints saved without metrics only count for keep_last, unless
+    await_metrics is set: they are then kept until their metrics are added
+    with update_metrics (e.g. by an evaluation worker).
+    '''
+    def __init__(self, sess, ckpt_dir, var_list=None, keep_last=5, keep_best=3,
+                 score_key='score', await_metrics=False, background=True, max_pending=2):
+        self.sess = sess
+        self.ckpt_dir = ckpt_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.score_key = score_key
+        self.await_metrics = await_metrics
+        if not os.path.exists(ckpt_dir):
+            os.makedirs(ckpt_dir)
+        self.index = read_index(ckpt_dir)
+        self.lock = threading.Lock()
+        self.error = None
+
+        self.variables = var_list if var_list is not None else tf.global_variables()
+        self._build_shadow_graph()
+        self.queue = None
+        if background:
+            self.queue = queue.Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _build_shadow_graph(self):
+        ''' Variables with the names, shapes and dtypes of the training
+        variables in their own graph and CPU session, and a Saver on them. '''
+        self.graph = tf.Graph()
+        self.placeholders = []
+        assign_ops = []
+        with self.graph.as_default(), tf.device('/cpu:0'):
+            for var in self.variables:
+                dtype = var.dtype.base_dtype
+                shape = var.get_shape()
+                shadow = tf.Variable(tf.zeros(shape, dtype=dtype), name=var.op.name, trainable=False)
+                pl = tf.placeholder(dtype, shape=shape)
+                self.placeholders.append(pl)
+                assign_ops.append(tf.assign(shadow, pl))
+            self.assign_op = tf.group(*assign_ops)
+            self.saver = tf.train.Saver(max_to_keep=None, save_relative_paths=True)
+        self.shadow_sess = tf.Session(graph=self.graph,
+                                      config=tf.ConfigProto(device_count={'GPU': 0}))
+
+    def save(self, name, step=None, metrics=None, **info):
+        ''' Snapshot the variables and write <ckpt_dir>/<name> (in the background).
+        Input:
+            name: checkpoint file name, e.g. model_10.ckpt
+            step: global step of the checkpoint
+            metrics: optional dict of evaluation results, with score_key
+            info: extra fields of the index entry (e.g. epoch)
+        Output:
+            path: path of the checkpoint
+        '''
+        self._check_error()
+        values = self.sess.run(self.variables)
+        entry = dict(info)
+        entry.update({'name': name, 'step': step, 'time': time.time(), 'metrics': metrics})
+        if self.queue is None:
+            self._write(values, entry)
+        else:
+            self.queue.put((values, entry))
+        return os.path.join(self.ckpt_dir, name)
+
+    def update_metrics(self, path, metrics):
+        ''' Add the metrics of a saved checkpoint and apply the retention policy. '''
+        name = os.path.basename(path)
+        with self.lock:
+            for entry in self.index['checkpoints']:
+                if entry['name'] == name:
+                    entry['metrics'] = dict(entry['metrics'] or {}, **metrics)
+            self._apply_retention()
+
+    def best(self):
+        ''' Path of the best checkpoint written so far, None if none has a score. '''
+        with self.lock:
+            name = self.index['best']
+        return os.path.join(self.ckpt_dir, name) if name is not None else None
+
+    def close(self):
+        ''' Wait for the pending checkpoints and stop the writer thread. '''
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+        self.shadow_sess.close()
+        self._check_error()
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, values, entry):
+        self.shadow_sess.run(self.assign_op, feed_dict=dict(zip(self.placeholders, values)))
+        self.saver.save(self.shadow_sess, os.path.join(self.ckpt_dir, entry['name']),
+                        write_meta_graph=False, write_state=False)
+        with self.lock:
+            self.index['checkpoints'] = [e for e in self.index['checkpoints']
+                                         if e['name'] != entry['name']] + [entry]
+            self.index['latest'] = entry['name']
+            self._apply_retention()
+
+    def _apply_retention(self):
+        entries = self.index['checkpoints']
+        keep, best = retained_checkpoints(entries, self.keep_last, self.keep_best,
+                                          self.score_key, self.await_metrics)
+        for e in entries:
+            if e['name'] not in keep:
+                delete_checkpoint(os.path.join(self.ckpt_dir, e['name']))
+        self.index['checkpoints'] = [e for e in entries if e['name'] in keep]
+        self.index['best'] = best
+        write_index(self.ckpt_dir, self.index)
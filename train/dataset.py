@@ -2,6 +2,7 @@ import os
 import numpy as np
 #import torch.utils.data as torch_data
 import kitti_utils
+import frame_cache
 import cv2
 from PIL import Image
 from pypcd import pypcd
@@ -36,19 +37,35 @@ class KittiDataset():
         self.plane_dir = os.path.join(self.imageset_dir, 'planes')
         self.radar_dir = os.path.join(self.imageset_dir, 'pc_radar_2')
 
+    def _cached(self, idx, artifact, load):
+        ''' Frame file through the process-wide frame_cache.FRAME_CACHE.
+        Arrays are shared with the cache and read-only, the label objects
+        and the calibration are copied by their accessors. '''
+        return frame_cache.FRAME_CACHE.get((self.imageset_dir, idx, artifact),
+                                           lambda: load(idx))
+
     def get_image(self, idx):
+        return self._cached(idx, 'image', self._load_image)
+
+    def _load_image(self, idx):
 
         img_file = os.path.join(self.image_dir, '%06d.png' % idx)
         assert os.path.exists(img_file)
         return cv2.imread(img_file)  # (H, W, 3) BGR mode
 
     def get_image_shape(self, idx):
+        return self._cached(idx, 'image_shape', self._load_image_shape)
+
+    def _load_image_shape(self, idx):
         img_file = os.path.join(self.image_dir, '%06d.png' % idx)
         assert os.path.exists(img_file)
         im = Image.open(img_file)
         width, height = im.size
         return height, width, 3
     def get_radar(self, idx):
+        return self._cached(idx, 'radar', self._load_radar)
+
+    def _load_radar(self, idx):
         radar_file = os.path.join(self.radar_dir,'%06d.pcd' % idx)
         assert os.path.exists(radar_file)
         cloud = pypcd.PointCloud.from_path(radar_file)
@@ -59,6 +76,9 @@ class KittiDataset():
         return pc_rot
 
     def get_lidar(self, idx):
+        return self._cached(idx, 'lidar', self._load_lidar)
+
+    def _load_lidar(self, idx):
 
         lidar_file = os.path.join(self.lidar_dir, '%06d.pcd' % idx)
         print(lidar_file)
@@ -73,17 +93,27 @@ class KittiDataset():
         return pts_input
 
     def get_calib(self, idx):
+        return copy.deepcopy(self._cached(idx, 'calib', self._load_calib))
+
+    def _load_calib(self, idx):
         calib_file = os.path.join(self.calib_dir, '%06d.txt' % idx)
         assert os.path.exists(calib_file)
         return kitti_utils.Calibration(calib_file)
 
     def get_label_2D(self, idx):
+        # new objects, callers may filter the list or modify them
+        return copy.deepcopy(self._cached(idx, 'label_2D', self._load_label_2D))
+
+    def _load_label_2D(self, idx):
 
         label_file = os.path.join(self.label_dir_2D, '%06d.txt' % idx)
         #print(label_file)
         assert os.path.exists(label_file)
         return kitti_utils.get_objects_from_label(label_file)
     def get_label(self, idx):
+        return copy.deepcopy(self._cached(idx, 'label', self._load_label))
+
+    def _load_label(self, idx):
         label_file = os.path.join(self.label_dir, '%06d.txt' % idx)
         #print(label_file)
         assert os.path.exists(label_file)
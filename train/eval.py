@@ -17,7 +17,12 @@ ROOT_DIR = os.path.dirname(BASE_DIR)
 sys.path.append(BASE_DIR)
 sys.path.append(os.path.join(ROOT_DIR, 'models'))
 import provider
+import frame_cache
+import checkpoint_util
+import profile_util
+import tf_util
 from train_util import get_batch
+from eval_util import StreamingEvaluator, evaluate_dataset
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--gpu', type=int, default=0, help='GPU to use [default: GPU 0]')
@@ -32,7 +37,19 @@ parser.add_argument('--optimizer', default='adam', help='adam or momentum [defau
 parser.add_argument('--decay_step', type=int, default=200000, help='Decay step for lr decay [default: 200000]')
 parser.add_argument('--decay_rate', type=float, default=0.7, help='Decay rate for lr decay [default: 0.7]')
 parser.add_argument('--no_intensity', action='store_true', help='Only use XYZ for training')
-parser.add_argument('--restore_model_path', default=None, help='Restore model path e.g. log/model.ckpt [default: None]')
+parser.add_argument('--restore_model_path', default=None, help='Restore model path e.g. log/model.ckpt, or a checkpoint directory for its best model [default: None]')
+parser.add_argument('--trace_steps', default=None, help='Capture a full TF trace of steps start:end, e.g. 10:13 [default: None]')
+parser.add_argument('--memory_report', action='store_true', help='Log memory used by the datasets, evaluation buffers and stages')
+parser.add_argument('--memory_trace', action='store_true', help='With --memory_report, also trace the top python allocators (slow)')
+parser.add_argument('--layout_config', default=None, help='Layouts recorded by benchmark_model.py --autotune, default NHWC with fused batch norm [default: None]')
+parser.add_argument('--layout_device', default='gpu', help='Device whose layout is loaded from --layout_config, cpu or gpu [default: gpu]')
+parser.add_argument('--voxel_size', type=float, default=0, help='Downsample the frustums to one point per voxel of this size in meters, 0 to disable [default: 0]')
+parser.add_argument('--voxel_reduction', default='centroid', help='Point kept per voxel: centroid or first [default: centroid]')
+parser.add_argument('--frame_views', action='store_true', help='Store every frame once and the frustums as point indices into it, see provider.FrustumViews')
+parser.add_argument('--frame_cache_mb', type=int, default=1024, help='Size of the cache of frame files shared by the datasets, 0 to disable [default: 1024]')
+parser.add_argument('--single_pass_build', action='store_true', help='Build the 224 and 704 datasets of a split in one pass over the frames')
+parser.add_argument('--xla', action='store_true', help='Compile the model and loss with XLA (JIT)')
+parser.add_argument('--pointwise', action='store_true', help='Run the 1x1 conv stacks of the model as tf_util.shared_mlp layers (same variables)')
 FLAGS = parser.parse_args()
 
 # Set training configurations
@@ -50,6 +67,8 @@ NUM_CHANNEL = 3 if FLAGS.no_intensity else 4 # point feature channel
 NUM_CLASSES = 2 # segmentation has two classes
 
 MODEL = importlib.import_module(FLAGS.model) # import network module
+if FLAGS.layout_config is not None:
+    tf_util.load_layout(FLAGS.layout_config, FLAGS.layout_device, 'forward')
 MODEL_FILE = os.path.join(ROOT_DIR, 'models', FLAGS.model+'.py')
 #LOG_DIR = FLAGS.log_dir
 datum = datetime.now()
@@ -62,32 +81,77 @@ datum = datum.strftime("%d-%m-%Y-%H:%M:%S")
 #os.system('cp %s %s' % (os.path.join(BASE_DIR, 'train.py'), LOG_DIR))
 #LOG_FOUT = open(os.path.join(LOG_DIR, 'log_train.txt'), 'w')
 #LOG_FOUT.write(str(FLAGS)+'\n')
+FLAGS.restore_model_path = checkpoint_util.resolve_checkpoint(FLAGS.restore_model_path)
 pathsplit = FLAGS.restore_model_path.split('/')
 print(pathsplit)
 OUTPUT_FILE = os.path.join('/', pathsplit[1], pathsplit[2], pathsplit[3], pathsplit[4], pathsplit[5],
                            'results_train_eval_190/')
 if not os.path.exists(OUTPUT_FILE):
     os.mkdir(OUTPUT_FILE)
+TRACER = profile_util.TraceCapture(profile_util.parse_step_window(FLAGS.trace_steps),
+                                   os.path.join(OUTPUT_FILE, 'trace'), prefix='eval')
 BN_INIT_DECAY = 0.5
 BN_DECAY_DECAY_RATE = 0.5
 BN_DECAY_DECAY_STEP = float(DECAY_STEP)
 BN_DECAY_CLIP = 0.99
 
 # Load Frustum Datasets. Use default data paths.
+MEMORY = profile_util.MemoryTracker(enabled=FLAGS.memory_report, trace=FLAGS.memory_trace)
+frame_cache.FRAME_CACHE.set_max_bytes(FLAGS.frame_cache_mb * 1024**2)
 #TRAIN_DATASET = provider.FrustumDataset(npoints=NUM_POINT, split='train',res=0,
     #rotate_to_center=False, random_flip=False, random_shift=True, one_hot=True)
 
-EVAL_DATASET_224 = provider.FrustumDataset(npoints=NUM_POINT,database="KITTI", split='val',res="224",
-    rotate_to_center=True, one_hot=True)
-
-EVAL_DATASET_704 = provider.FrustumDataset(npoints=NUM_POINT,database="KITTI", split='val',res="704",rotate_to_center=True, one_hot=True)
-
-#TEST_DATASET_224 =  provider.FrustumDataset('pc_radar_2','KITTI_2',npoints=NUM_POINT, split='test',rotate_to_center=False, one_hot=True,all_batches = True, translate_radar_center=False, store_data=True, proposals_3 =False ,no_color=True)
-
-TEST_DATASET_224 = provider.FrustumDataset(npoints=NUM_POINT,database="KITTI_2", split='test',res="224", rotate_to_center=True, one_hot=True)
-
-TEST_DATASET_704 = provider.FrustumDataset(npoints=NUM_POINT,database="KITTI_2", split='test',res="704",
-    rotate_to_center=True, one_hot=True)
+if FLAGS.single_pass_build:
+    with MEMORY.stage('build EVAL_DATASET_224+704'):
+        EVAL_DATASET_224, EVAL_DATASET_704 = provider.FrustumDataset.for_resolutions(
+            NUM_POINT, 'KITTI', 'val', ['224', '704'], rotate_to_center=True, one_hot=True,
+            voxel_size=FLAGS.voxel_size, voxel_reduction=FLAGS.voxel_reduction,
+            frame_views=FLAGS.frame_views)
+    MEMORY.add_dataset('EVAL_DATASET_224', EVAL_DATASET_224)
+    MEMORY.add_dataset('EVAL_DATASET_704', EVAL_DATASET_704)
+    with MEMORY.stage('build TEST_DATASET_224+704'):
+        TEST_DATASET_224, TEST_DATASET_704 = provider.FrustumDataset.for_resolutions(
+            NUM_POINT, 'KITTI_2', 'test', ['224', '704'], rotate_to_center=True, one_hot=True,
+            voxel_size=FLAGS.voxel_size, voxel_reduction=FLAGS.voxel_reduction,
+            frame_views=FLAGS.frame_views)
+    MEMORY.add_dataset('TEST_DATASET_224', TEST_DATASET_224)
+    MEMORY.add_dataset('TEST_DATASET_704', TEST_DATASET_704)
+else:
+    with MEMORY.stage('build EVAL_DATASET_224'):
+        EVAL_DATASET_224 = provider.FrustumDataset(npoints=NUM_POINT,database="KITTI", split='val',res="224",
+            rotate_to_center=True, one_hot=True,
+            voxel_size=FLAGS.voxel_size, voxel_reduction=FLAGS.voxel_reduction,
+            frame_views=FLAGS.frame_views)
+    MEMORY.add_dataset('EVAL_DATASET_224', EVAL_DATASET_224)
+
+    with MEMORY.stage('build EVAL_DATASET_704'):
+        EVAL_DATASET_704 = provider.FrustumDataset(npoints=NUM_POINT,database="KITTI", split='val',res="704",rotate_to_center=True, one_hot=True,
+            voxel_size=FLAGS.voxel_size, voxel_reduction=FLAGS.voxel_reduction,
+            frame_views=FLAGS.frame_views)
+    MEMORY.add_dataset('EVAL_DATASET_704', EVAL_DATASET_704)
+
+    #TEST_DATASET_224 =  provider.FrustumDataset('pc_radar_2','KITTI_2',npoints=NUM_POINT, split='test',rotate_to_center=False, one_hot=True,all_batches = True, translate_radar_center=False, store_data=True, proposals_3 =False ,no_color=True)
+
+    with MEMORY.stage('build TEST_DATASET_224'):
+        TEST_DATASET_224 = provider.FrustumDataset(npoints=NUM_POINT,database="KITTI_2", split='test',res="224", rotate_to_center=True, one_hot=True,
+            voxel_size=FLAGS.voxel_size, voxel_reduction=FLAGS.voxel_reduction,
+            frame_views=FLAGS.frame_views)
+    MEMORY.add_dataset('TEST_DATASET_224', TEST_DATASET_224)
+
+    with MEMORY.stage('build TEST_DATASET_704'):
+        TEST_DATASET_704 = provider.FrustumDataset(npoints=NUM_POINT,database="KITTI_2", split='test',res="704",
+            rotate_to_center=True, one_hot=True,
+            voxel_size=FLAGS.voxel_size, voxel_reduction=FLAGS.voxel_reduction,
+            frame_views=FLAGS.frame_views)
+    MEMORY.add_dataset('TEST_DATASET_704', TEST_DATASET_704)
+DATASETS = [('EVAL_DATASET_224', EVAL_DATASET_224), ('EVAL_DATASET_704', EVAL_DATASET_704),
+            ('TEST_DATASET_224', TEST_DATASET_224), ('TEST_DATASET_704', TEST_DATASET_704)]
+if FLAGS.frame_views:
+    # the datasets built in one pass share their frames, counted once
+    MEMORY.add_buffers('frame buffers', dict((name, dataset.frame_buffers.frames)
+                                             for name, dataset in DATASETS
+                                             if dataset.frame_buffers is not None))
+print(frame_cache.FRAME_CACHE.report())
 
 
 def log_string(out_str):
@@ -95,6 +159,10 @@ def log_string(out_str):
   #  LOG_FOUT.flush()
     print(out_str)
 
+for name, dataset in DATASETS:
+    if dataset.voxel_stats is not None:
+        log_string(name + ' ' + provider.format_downsampling_stats(dataset.voxel_stats))
+
 def get_learning_rate(batch):
     learning_rate = tf.train.exponential_decay(
                         BASE_LEARNING_RATE,  # Base learning rate.
@@ -135,11 +203,12 @@ def train():
             tf.summary.scalar('bn_decay', bn_decay)
 
             # Get model and losses 
-            end_points = MODEL.get_model(pointclouds_pl, one_hot_vec_pl,
-                is_training_pl, bn_decay=bn_decay)
-            loss = MODEL.get_loss(labels_pl, centers_pl,
-                heading_class_label_pl, heading_residual_label_pl,
-                size_class_label_pl, size_residual_label_pl, end_points)
+            with tf_util.xla_scope(FLAGS.xla):
+                end_points = MODEL.get_model(pointclouds_pl, one_hot_vec_pl,
+                    is_training_pl, bn_decay=bn_decay, pointwise=FLAGS.pointwise)
+                loss = MODEL.get_loss(labels_pl, centers_pl,
+                    heading_class_label_pl, heading_residual_label_pl,
+                    size_class_label_pl, size_residual_label_pl, end_points)
             tf.summary.scalar('loss', loss)
 
             losses = tf.get_collection('losses')
@@ -222,10 +291,14 @@ def train():
             sys.stdout.flush()
              
            # train_one_epoch(sess, ops, train_writer)
-            eval_one_epoch(sess, ops, EVAL_DATASET_224,"224",'val')
-            eval_one_epoch(sess, ops,TEST_DATASET_224,"224",'test')
-            eval_one_epoch(sess, ops, EVAL_DATASET_704,"704",'val')
-            eval_one_epoch(sess, ops, TEST_DATASET_704, "704",'test')
+            with MEMORY.stage('evaluation'):
+                eval_one_epoch(sess, ops, EVAL_DATASET_224,"224",'val')
+                eval_one_epoch(sess, ops,TEST_DATASET_224,"224",'test')
+                eval_one_epoch(sess, ops, EVAL_DATASET_704,"704",'val')
+                eval_one_epoch(sess, ops, TEST_DATASET_704, "704",'test')
+            if MEMORY.enabled:
+                for line in MEMORY.report_lines():
+                    log_string(line)
             # Save the variables to disk.
             #if epoch % 10 == 0:
             #    save_path = saver.save(sess, os.path.join(LOG_DIR, "ckpt", "model_" + str(epoch) + ".ckpt"))
@@ -308,530 +381,26 @@ def train_one_epoch(sess, ops, train_writer):
             iou3ds_sum = 0
             iou3d_correct_cnt = 0
         
-def softmax(x):
-    ''' Numpy function for softmax'''
-    shape = x.shape
-    probs = np.exp(x - np.max(x, axis=len(shape) - 1, keepdims=True))
-    probs /= np.sum(probs, axis=len(shape) - 1, keepdims=True)
-    return probs
-def eval_one_epoch(sess, ops, test_dataset,res,split):
+def eval_one_epoch(sess, ops, test_dataset, res, split):
     ''' Simple evaluation for one epoch on the frustum dataset.
-    ops is dict mapping from string to tf ops """
+    ops is dict mapping from string to tf ops
     '''
     global EPOCH_CNT
-    is_training = False
     log_string(str(datetime.now()))
-    log_string(res+'---- EPOCH %03d EVALUATION ----'%(EPOCH_CNT))
-    test_idxs = np.arange(0, len(test_dataset))
-    num_batches = len(test_dataset)/BATCH_SIZE
-
-    # To collect statistics
-    total_correct = 0
-    total_seen = 0
-    loss_sum = 0
-    total_seen_class = [0 for _ in range(NUM_CLASSES)]
-    total_correct_class = [0 for _ in range(NUM_CLASSES)]
-    iou2ds_sum = 0
-    iou3ds_sum = 0
-    iou3d_correct_cnt = 0
-    box_pred_nbr_sum = 0
-
-    ps_list = []
-    seg_list = []
-    segp_list = []
-    center_list = []
-    heading_cls_list = []
-    heading_res_list = []
-    size_cls_list = []
-    size_res_list = []
-    rot_angle_list = []
-    score_list = []
-    center_GT=[]
-    heading_class_GT=[]
-    heading_res_GT=[]
-    size_class_GT=[]
-    size_residual_GT=[]
-
-    # Simple evaluation with batches 
-    for batch_idx in range(num_batches):
-        start_idx = batch_idx * BATCH_SIZE
-        end_idx = (batch_idx+1) * BATCH_SIZE
-
-        batch_data, batch_label, batch_center, \
-        batch_hclass, batch_hres, \
-        batch_sclass, batch_sres, \
-        batch_rot_angle, batch_one_hot_vec = \
-            get_batch(test_dataset, test_idxs, start_idx, end_idx,
-                NUM_POINT, NUM_CHANNEL)
-
-        feed_dict = {ops['pointclouds_pl']: batch_data,
-                     ops['one_hot_vec_pl']: batch_one_hot_vec,
-                     ops['labels_pl']: batch_label,
-                     ops['centers_pl']: batch_center,
-                     ops['heading_class_label_pl']: batch_hclass,
-                     ops['heading_residual_label_pl']: batch_hres,
-                     ops['size_class_label_pl']: batch_sclass,
-                     ops['size_residual_label_pl']: batch_sres,
-                     ops['is_training_pl']: is_training}
-
-        summary, step, loss_val, logits_val, \
-        centers_pred_val,heading_scores, heading_residuals, size_scores, size_residuals,\
-        iou2ds, iou3ds, box_pred_nbr  = \
-            sess.run([ops['merged'], ops['step'],
-                ops['loss'], ops['logits'], 
-                ops['end_points']['center'],ops['end_points']['heading_scores'],
-                ops['end_points']['heading_residuals'],ops['end_points']['size_scores'],
-                ops['end_points']['size_residuals'],
-                ops['end_points']['iou2ds'], ops['end_points']['iou3ds'],ops['end_points']['box_pred_nbr']],
-                     
-                feed_dict=feed_dict)
-        #test_writer.add_summary(summary, step)
-        batch_seg_prob = softmax(logits_val)[:, :, 1]  # BxN
-        batch_seg_mask = np.argmax(logits_val, 2)  # BxN
-        mask_mean_prob = np.sum(batch_seg_prob * batch_seg_mask, 1)  # B,
-        mask_mean_prob = mask_mean_prob / np.sum(batch_seg_mask, 1)
-        heading_prob = np.max(softmax(heading_scores), 1)  # B
-        size_prob = np.max(softmax(size_scores), 1)  # B,
-        batch_scores = np.log(mask_mean_prob) + np.log(heading_prob) + np.log(size_prob)
-
-        heading_cls = np.argmax(heading_scores, 1)  # B
-        size_cls = np.argmax(size_scores, 1)  # B
-        heading_res = np.array([heading_residuals[i, heading_cls[i]] \
-                                for i in range(batch_data.shape[0])])
-        size_res = np.vstack([size_residuals[i, size_cls[i], :] \
-                              for i in range(batch_data.shape[0])])
-
-
-
-
-        preds_val = np.argmax(logits_val, 2)
-        correct = np.sum(preds_val == batch_label)
-        total_correct += correct
-        total_seen += (BATCH_SIZE*NUM_POINT)
-        loss_sum += loss_val
-
-
-        for i in range(batch_data.shape[0]):
-            ps_list.append(batch_data[i, ...])
-            seg_list.append(batch_label[i, ...])
-            segp_list.append(preds_val[i, ...])
-            center_list.append(centers_pred_val[i, :])
-            heading_cls_list.append(heading_cls[i])
-            heading_res_list.append(heading_res[i])
-            size_cls_list.append(size_cls[i])
-            size_res_list.append(size_res[i, :])
-            rot_angle_list.append(batch_rot_angle[i])
-            score_list.append(batch_scores[i])
-            center_GT.append(batch_center[i])
-            heading_class_GT.append(batch_hclass[i])
-            heading_res_GT.append(batch_hres[i])
-            size_class_GT.append(batch_sclass[i])
-            size_residual_GT.append(batch_sres[i])
-            correct = np.sum(preds_val == batch_label)
-
-
-
-
-
-
-        for l in range(NUM_CLASSES):
-            total_seen_class[l] += np.sum(batch_label==l)
-            total_correct_class[l] += (np.sum((preds_val==l) & (batch_label==l)))
-        iou2ds_sum += np.sum(iou2ds)
-        iou3ds_sum += np.sum(iou3ds)
-        iou3d_correct_cnt += np.sum(iou3ds>=0.5)
-        box_pred_nbr_sum += np.sum(box_pred_nbr)
-
-        for i in range(BATCH_SIZE):
-            segp = preds_val[i,:]
-            segl = batch_label[i,:]
-
-            part_ious = [0.0 for _ in range(NUM_CLASSES)]
-            for l in range(NUM_CLASSES):
-                if (np.sum(segl==l) == 0) and (np.sum(segp==l) == 0): 
-                    part_ious[l] = 1.0 # class not present
-                else:
-                    part_ious[l] = np.sum((segl==l) & (segp==l)) / \
-                        float(np.sum((segl==l) | (segp==l)))
-
-
-    print("num_batches",num_batches)
-    log_string(res+'eval mean loss: %f' % (loss_sum / float(num_batches)))
-    log_string(res+'eval segmentation accuracy: %f'% \
-        (total_correct / float(total_seen)))
-    log_string(res+'eval segmentation avg class acc: %f' % \
-        (np.mean(np.array(total_correct_class) / \
-            np.array(total_seen_class,dtype=np.float))))
-    log_string(res+'eval box IoU (ground/3D): %f / %f' % \
-        (iou2ds_sum / max(float(box_pred_nbr_sum),1.0), iou3ds_sum / \
-            max(float(box_pred_nbr_sum),1.0)))
-    log_string(res+'eval box estimation accuracy (IoU=0.5): %f' % \
-        (float(iou3d_correct_cnt)/max(float(box_pred_nbr_sum),1.0)))
-    IOU3d, GT_box_list, pred_box_list = compare_box_iou(res,split, test_dataset.id_list, test_dataset.indice_box,
-                                                        size_residual_GT, size_class_GT, heading_res_GT,
-                                                        heading_class_GT, center_GT, score_list,
-                                                        size_res_list, size_cls_list, heading_res_list,
-                                                        heading_cls_list,
-                                                        center_list,
-                                                        segp_list, seg_list)
-    eval_per_frame(test_dataset.id_list, test_dataset.indice_box, ps_list, seg_list, segp_list, GT_box_list,
-                   pred_box_list, IOU3d, score_list)
-
-    write_detection_results_test(res,split, test_dataset.id_list,
-                                 center_list,
-                                 heading_cls_list, heading_res_list,
-                                 size_cls_list, size_res_list, rot_angle_list, segp_list,score_list)
-def compare_box_iou(res,split,id_list,indice_box,size_residual_GT,size_class_GT,heading_res_GT,heading_class_GT,center_GT,
-                    score_list,size_res_list,size_cls_list,heading_res_list, heading_cls_list,center_list,segp_list,seg_list,):
-    file1 = open(OUTPUT_FILE+"/"+split+"_"+res+ ".txt" , "w")
-    IoU=[]
-    GT_box_list=[]
-    pred_box_list=[]
-    for i in range(len(size_residual_GT)):
-
-        GT_box = provider.get_3d_box(provider.class2size(size_class_GT[i], size_residual_GT[i]), provider.class2angle(heading_class_GT[i], heading_res_GT[i], 12), center_GT[i])
-        pred_box = provider.get_3d_box(provider.class2size(size_cls_list[i],size_res_list[i]),provider.class2angle(heading_cls_list[i],heading_res_list[i],12),center_list[i])
-        GT_box_list.append(GT_box)
-        pred_box_list.append(pred_box)
-        iou_3d, iou_2d=provider.box3d_iou(pred_box,GT_box)
-        IoU.append(iou_3d)
-        file1.write("3D box %f \n" % id_list[i])
-        file1.write("iou %f  ,score %f \n "% (float(iou_3d) ,score_list[i]))
-        file1.write("label seg number: %f \n" % np.count_nonzero(seg_list[i] == 1))
-        file1.write("det seg number: %f\n" % np.count_nonzero(segp_list[i] == 1))
-        #file1.write("correct per seen: %d" %np.sum(seg_list[i] == segp_list[i] )/len(seg_list[i])[0])
-        file1.write("center: %f , %f, %f\n" % (center_list[i][0],center_list[i][1],center_list[i][2]))
-        file1.write("center_GT: %f , %f , %f\n" % (center_GT[i][0], center_GT[i][1], center_GT[i][2]))
-        size_pred =  provider.class2size(size_cls_list[i], size_res_list[i])
-        file1.write("size pred: %f , %f , %f\n" % (size_pred[0],size_pred[1],size_pred[2]))
-        size_GT = provider.class2size(size_class_GT[i], size_residual_GT[i])
-        file1.write("size GT: %f, %f , %f\n" %(size_GT[0],size_GT[1],size_GT[2]))
-        file1.write("rotation pred %f\n" % provider.class2angle(heading_cls_list[i],heading_res_list[i],12))
-        file1.write("rotation GT %f\n" % provider.class2angle(heading_class_GT[i], heading_res_GT[i], 12))
-
-    file1.close()
-    return IoU,GT_box_list,pred_box_list
-
-
-
-def eval_per_frame(id_list,indice_box_list ,ps_list, seg_list, segp_list,GT_box_list,pred_box_list,IOU3d,score_list):
-    seg_list_frame=[]
-    segp_list_frame=[]
-    IoU_frame = []
-    GT_box_frame = []
-    pred_box_frame = []
-    score_frame =[]
-    segp_sum_frame = []
-    seg_sum_GT_frame =[]
-    indice_box_frame=[]
-    id = id_list[0]
-    m = 1
-    id_list_frame = []
-
-    for i in range(1, len(seg_list)):
-        if id == id_list[i]:
-            m = m + 1
-        if id != id_list[i] or i == len(id_list) - 1:
-            seg_prov = []
-            segp_prov = []
-            score_prov = []
-            GT_box_prov = []
-            pred_box_prov = []
-            segp_sum=[]
-            seg_sum=[]
-            iou_prov=[]
-            indice_box_prov=[]
-            for j in range(i-m,i):
-                if np.count_nonzero(segp_list[j] == 1)>50:
-
-                    indice_box_prov.append(indice_box_list[j])
-                    seg_prov.append(seg_list[j])
-                    segp_prov.append(segp_list[j])
-                    score_prov.append(score_list[j])
-                    segp_sum.append(np.count_nonzero(segp_list[j] == 1))
-                    seg_sum.append(np.count_nonzero(seg_list[j] == 1))#
-                    GT_box_prov.append(GT_box_list[j])
-                    pred_box_prov.append(pred_box_list[j])
-                    iou_prov.append(IOU3d[j])
-            id_list_frame.append(id)
-            seg_list_frame.append(seg_prov)
-            segp_list_frame.append(segp_prov)
-            score_frame.append(score_prov)
-            IoU_frame.append(iou_prov)
-            GT_box_frame.append(GT_box_prov)
-            pred_box_frame.append(pred_box_prov)
-            indice_box_frame.append(indice_box_prov)
-            segp_sum_frame.append(segp_sum)
-            seg_sum_GT_frame.append(seg_sum)
-            m = 1
-            id = id_list[i]
-
-
-    #score_list_frame, \
-    #bboxes_frame,score_new_frame,id_new_frame,indices_frame,iou_new_frame = NMS(id_list_frame,pred_box_frame,IoU_frame,segp_sum_frame,score_frame,indice_box_frame)
-    #load_GT
-    #print(len(id_list_frame))
-    #print("id_list_frame[len(id_list_frame)-1]",id_list_frame[len(id_list_frame)-1])
-    corners_GT_frame,id_list_GT =provider.load_GT_eval(id_list_frame[len(id_list_frame)-1],'KITTI','val')
-    #print("****************************************************************")
-    #print(len(id_list_frame),len(id_list_GT))
-    #print(id_list_frame[len(id_list_frame)-1],id_list_GT[len(id_list_GT)-1])
-    precision_recall(id_list_frame,pred_box_frame,corners_GT_frame,score_frame,IoU_frame,indice_box_frame,id_list_GT)
-
-def NMS(id_list_frame,pred_box_frame,IoU_frame,segp_sum_frame,score_list_frame,indice_box_frame):
-    bboxes_frame=[]
-    score_new_frame=[]
-    iou_new_frame=[]
-    id_new_frame=[]
-    indices_frame=[]
-
-
-    # estimate corners for all detections in box
-    for j in range(len(id_list_frame)):
-    # estimate 3DIoU for a box with other boxes for a batch
-
-        #print("len(corners3d)",len(pred_box_frame[j]))
-        #print("len(score_list_frame[j])",len(score_list_frame[j]))
-        bboxes = []
-        score_list = []
-        id_list=[]
-        indice=[]
-        iou_prov=[]
-
-
-        ind_sort = np.argsort([x*-1.0 for x in score_list_frame[j]])
-
-        #print("ind_sort",ind_sort)
-        for i in range(len(pred_box_frame[j])):
-            bbox = pred_box_frame[j][ind_sort[i]]
-            flag = 1
-            for k in range(i+1,len(pred_box_frame[j])):
-                if(np.array_equal(bbox, pred_box_frame[j][ind_sort[k]])):
-                    flag = -1
-                    break
-                #print("index ",ind_sort[i],score_list_frame[j][ind_sort[i]], "index _comp: ", ind_sort[k], score_list_frame[j][ind_sort[k]],"IoU: ",provider.box3d_iou(bbox,pred_box_frame[j][ind_sort[k]]))
-                if provider.box3d_iou(bbox,pred_box_frame[j][ind_sort[k]])[1] > 0.3:
-                    flag = -1
-                    break
-            if flag == 1:
-                bboxes.append(bbox)
-                id_list.append(id_list_frame[j][ind_sort[i]])
-                indice.append(ind_sort[i])
-                iou_prov.append(IoU_frame[j][ind_sort[i]])
-                score_list.append(score_list_frame[j][ind_sort[i]])
-
-            #print("boxes size:", len(bboxes))
-        bboxes_frame.append(bboxes)
-        indices_frame.append(indice)
-        score_new_frame.append(score_list)
-        iou_new_frame.append(iou_prov)
-        id_new_frame.append(id_list)
-
-    return bboxes_frame,score_new_frame,id_new_frame,indices_frame,iou_new_frame
-        #rot_angle_list_frame,
-
-def NMS_unique(iou,corners_unique,scores_unique):
-    ind_sort = np.argsort([x for x in scores_unique])
-    bboxes = []
-    score_list = []
-    id_list = []
-    indice = []
-    iou_prov = []
-    for i in range(len(corners_unique)):
-        bbox = corners_unique[ind_sort[i]]
-        flag = 1
-        for k in range(i + 1, len(corners_unique)):
-            #print("index ", ind_sort[i], scores_unique[ind_sort[i]], "index _comp: ", ind_sort[k],
-            #      scores_unique[ind_sort[k]], "IoU: ", provider.box3d_iou(bbox, corners_unique[ind_sort[k]]))
-            if provider.box3d_iou(bbox, corners_unique[ind_sort[k]])[1] > 0.25:
-                flag = -1
-                break
-        if flag == 1:
-            bboxes.append(bbox)
-            indice.append(ind_sort[i])
-
-            iou_prov.append(iou[ind_sort[i]])
-            score_list.append(scores_unique[ind_sort[i]])
-
-    for i in range(len(iou_prov)-1):
-        iou_prov[i]=0.0
-    return iou_prov
-
-def precision_recall(id_list_frame,corners_frame,corners_GT_frame,scores,iou_frame,indice_box_frame,id_list_GT):
-    IoU = []
-    gt_box_num = []
-    iou_3d_frame = []
-    iou_2d_frame = []
-    accuracy_5 = 0.0
-    recall_5 = 0.0
-    accuracy_4 = 0.0
-    recall_4 = 0.0
-    accuracy_35 = 0.0
-    recall_35 = 0.0
-    accuracy_3 = 0.0
-    recall_3 = 0.0
-    accuracy_25 = 0.0
-    recall_25 = 0.0
-
-    corners_GT_orig = corners_GT_frame
-    corners_orig = corners_frame
-    id_list_frame = np.asarray(id_list_frame)
-    for i in range(len(id_list_GT)):
-        frame = np.where(id_list_frame == id_list_GT[i])
-
-        #print("*******************id*************: ", id_list_GT[i])
-        #print("indices", frame[0])
-        #print("nbr of GT boxes", len(corners_GT_frame[i]))
-        if (frame[0].size == 0):
-            accuracy_frame = 0
-            recall_frame = 0
-        else:
-            frame_id = frame[0][0]
-            #print("nbr of predicted boxes: ", len(corners_frame[frame_id]))
-            #print("nbr of GT boxes", len(corners_GT_frame[frame_id]))
-            #print("indices", indice_box_frame[frame_id])
-            #print("iou_frame", iou_frame[frame_id])
-            old_iou = []
-            indices = []
-            scores_ = []
-            corners_=[]
-            iou = []
-            for j in range(len(indice_box_frame[frame_id])):
-                if (indice_box_frame[frame_id][j] == 0):
-                    iou.append(0.0)
-                else:
-
-                    old_iou.append(iou_frame[frame_id][j])
-                    indices.append(indice_box_frame[frame_id][j])
-                    scores_.append(scores[frame_id][j])
-                    corners_.append(corners_frame[frame_id][j])
-
-            unique = np.unique(indices)
-            #print("old_iou", old_iou)
-            for j in range(len(unique)):
-                indices_unique = np.argwhere(indices == unique[j])
-
-                #print("indice_unique", indices_unique[0])
-                # max_iou=np.max(old_iou[indices_unique[0]])
-
-                abs = [old_iou[x] for x in indices_unique[:, 0]]
-                corners_unique=[corners_[x] for x in indices_unique[:, 0]]
-                scores_unique=[scores_[x] for x in indices_unique[:, 0]]
-                #print("scores_unique", scores_unique)
-                #print("iou unique", abs)
-                iou_nms= NMS_unique(abs,corners_unique,scores_unique)
-                #print("iou nms",iou_nms)
-                #max_iou = np.max(abs)
-                #iou.append(max_iou)
-                for c in range(len(iou_nms)):
-                    iou.append(iou_nms[c])
-            #print("new iou", iou)
-            #print(iou)
-            TP_5 = 0
-            for m in range(len(iou)):
-                if (iou[m] > 0.5):
-                    TP_5 += 1.0
-            TP_4 = 0
-            for m in range(len(iou)):
-                if (iou[m] > 0.4):
-                    TP_4 += 1.0
-
-            TP_35 = 0
-            for m in range(len(iou)):
-                if (iou[m] > 0.35):
-                    TP_35 += 1.0
-            TP_3 = 0
-            for m in range(len(iou)):
-                if (iou[m] > 0.4):
-                    TP_3 += 1.0
-
-            TP_25 = 0
-            for m in range(len(iou)):
-                if (iou[m] > 0.25):
-                    TP_25 += 1.0
-
-            accuracy_frame_5 = TP_5 / float(max(1.0, float(len(iou))))
-            recall_frame_5 = TP_5 / float(len(corners_GT_orig[i]))
-
-            accuracy_frame_4 = TP_4 / float(max(1.0, float(len(iou))))
-            recall_frame_4 = TP_4 / float(len(corners_GT_orig[i]))
-
-            accuracy_frame_35 = TP_35 / float(max(1.0, float(len(iou))))
-            recall_frame_35 = TP_35 / float(len(corners_GT_orig[i]))
-
-            accuracy_frame_3 = TP_3 / float(max(1.0, float(len(iou))))
-            recall_frame_3 = TP_3 / float(len(corners_GT_orig[i]))
-
-            accuracy_frame_25 = TP_25 / float(max(1.0, float(len(iou))))
-            recall_frame_25 = TP_25 / float(len(corners_GT_orig[i]))
-
-            accuracy_5 += accuracy_frame_5
-            recall_5 += recall_frame_5
-            accuracy_4 += accuracy_frame_4
-            recall_4 += recall_frame_4
-            accuracy_35 += accuracy_frame_35
-            recall_35 += recall_frame_35
-            accuracy_3 += accuracy_frame_3
-            recall_3 += recall_frame_3
-            accuracy_25 += accuracy_frame_25
-            recall_25 += recall_frame_25
-
-        # iou_3d_frame.append(iou_3d_prov)
-
-    print("accuracy_5", accuracy_5 / max(len(corners_frame), 1))
-    print("recall_5", recall_5 / max(len(corners_GT_orig), 1))
-    print("accuracy_4", accuracy_4 / max(len(corners_frame), 1))
-    print("recall_4", recall_4 / max(len(corners_GT_orig), 1))
-    print("accuracy_35", accuracy_35 / max(len(corners_frame), 1))
-    print("recall_35", recall_35 / max(len(corners_GT_orig), 1))
-    print("accuracy_3", accuracy_3 / max(len(corners_frame), 1))
-    print("recall_3", recall_3 / max(len(corners_GT_orig), 1))
-    print("accuracy_25", accuracy_25 / max(len(corners_frame), 1))
-    print("recall_25", recall_25 / max(len(corners_GT_orig), 1))
-
-
-
-
-
-
-
-def write_detection_results_test(result_dir,split, id_list, center_list, \
-                                 heading_cls_list, heading_res_list, \
-                                 size_cls_list, size_res_list, \
-                                 rot_angle_list, segp_list,score_list):
-    ''' Write frustum pointnets results to KITTI format label files. '''
-    result_dir = OUTPUT_FILE+split+"/"+result_dir+"/"
-    if not os.path.exists(result_dir):
-        os.makedirs(result_dir)
-    if result_dir is None: return
-    results = {}  # map from idx to list of strings, each string is a line (without \n)
-
-    for i in range(len(segp_list)):
-        if np.count_nonzero(segp_list[i] == 1) < 50:
-            continue
-        idx = id_list[i]
-
-        output_str = "Pedestrian -1 -1 -10 "
-        output_str += "0.0 0.0 0.0 0.0 "
-        h, w, l, tx, ty, tz, ry = provider.from_prediction_to_label_format(center_list[i],
-                                                                           heading_cls_list[i], heading_res_list[i],
-                                                                           size_cls_list[i], size_res_list[i], rot_angle_list[i])
-        score = 0.0
-        output_str += "%f %f %f %f %f %f %f %f" % (h, w, l, tx, ty, tz, ry, score_list[i])
-        if idx not in results: results[idx] = []
-        results[idx].append(output_str)
-
-    # Write TXT files
-    if not os.path.exists(result_dir): os.mkdir(result_dir)
-    output_dir = os.path.join(result_dir, 'data')
-
-    if not os.path.exists(output_dir): os.mkdir(output_dir)
-    for idx in results:
-        pred_filename = os.path.join(output_dir, '%06d.txt' % (idx))
-        fout = open(pred_filename, 'w')
-        for line in results[idx]:
-            fout.write(line + '\n')
-        fout.close()
+    log_string(res + '---- EPOCH %03d EVALUATION ----' % (EPOCH_CNT))
+    evaluator = StreamingEvaluator(provider.get_gt_store('KITTI', 'val'),
+                                   result_dir=os.path.join(OUTPUT_FILE, split, res),
+                                   detail_path=os.path.join(OUTPUT_FILE, split + "_" + res + ".txt"))
+    results = evaluate_dataset(sess, ops, test_dataset, evaluator, BATCH_SIZE, NUM_POINT,
+                               NUM_CHANNEL, log_fn=log_string, prefix=res + ' ', tracer=TRACER)
+    MEMORY.add_buffers(res + ' ' + split + ' eval buffers', evaluator.buffers())
+    EPOCH_CNT += 1
+
+    accuracy_5 = results['frame_precision'][0]
+    recall_5 = results['frame_recall'][0]
+    log_string(res + " " + split + ' accuracy(0.5): %f' % accuracy_5)
+    log_string(res + " " + split + ' reca(0.5): %f' % recall_5)
+    return accuracy_5
 
 
 if __name__ == "__main__":
@@ -0,0 +1,763 @@
+''' Helper functions for per-frame evaluation of Frustum PointNets
+detections (non maximum suppression, matching, precision/recall).
+
+Shared by train.py, eval.py and the benchmarks, which cannot import the
+training scripts without running them.
+'''
+from __future__ import print_function
+
+import os
+import json
+import numpy as np
+import provider
+from box_util import box3d_iou
+from train_util import get_batch
+
+
+def NMS(corners, scores, threshold=0.25, groups=None):
+    ''' Frame level non maximum suppression of predicted 3D boxes.
+
+    A detection is suppressed if a higher scored detection (of the same
+    group if groups is given) overlaps it with a bird's eye view IoU above
+    threshold, whether or not that one is suppressed itself, as the former
+    NMS_unique of eval_per_frame.
+    Input:
+        corners: (P,8,3) predicted corners of the detections of a frame
+        scores: (P,) detection scores
+        threshold: bird's eye view IoU threshold
+        groups: (P,) int, only the detections of a group suppress each
+            other, the detections of negative groups are always kept
+    Output:
+        keep: (P,) bool
+    '''
+    scores = np.asarray(scores, dtype=np.float64)
+    keep = np.ones(len(scores), dtype=bool)
+    order = np.argsort(-scores, kind='mergesort')
+    for a in range(1, len(order)):
+        i = order[a]
+        if groups is not None and groups[i] < 0:
+            continue
+        for j in order[:a]:
+            if groups is not None and groups[j] != groups[i]:
+                continue
+            if box3d_iou(corners[i], corners[j])[1] > threshold:
+                keep[i] = False
+                break
+    return keep
+
+
+# IoU thresholds reported by the evaluation
+IOU_THRESHOLDS = (0.5, 0.4, 0.35, 0.3, 0.25)
+# Distance bins (m) of the breakdown, bin i is [bins[i], bins[i+1])
+DISTANCE_BINS = (0.0, 10.0, 20.0, 30.0, np.inf)
+LEVEL_NAMES = {1: 'easy', 2: 'moderate', 3: 'hard', 4: 'unknown'}
+
+
+# Model selection scores, see selection_score
+SELECTION_METRICS = ('frame_precision', 'precision', 'ap')
+
+
+def match_detections(scores, ious, gt_index, thresholds=IOU_THRESHOLDS):
+    ''' Greedy matching of scored detections to GT boxes at several IoU
+    thresholds at once.
+
+    A detection is a true positive at threshold t if its IoU with its GT
+    box is above t and no higher scored detection was matched to the same
+    GT box at t. Duplicates and unmatched detections are false positives.
+
+    Input:
+        scores: (P,) detection scores
+        ious: (P,) 3D IoU of each detection with its GT box
+        gt_index: (P,) int, index of the GT box of each detection, -1 if none
+        thresholds: sequence of T IoU thresholds
+    Output:
+        order: (P,) detection indices by decreasing score
+        tp: (T,P) bool, true positive flags in that order
+    '''
+    scores = np.asarray(scores, dtype=np.float64)
+    order = np.argsort(-scores, kind='mergesort')
+    ious = np.asarray(ious, dtype=np.float64)[order]
+    gt_index = np.asarray(gt_index, dtype=np.int64)[order]
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    hit = (ious[None, :] > thresholds[:, None]) & (gt_index[None, :] >= 0)
+    tp = np.zeros(hit.shape, dtype=bool)
+    # nonzero is row major: per threshold, hits come by decreasing score,
+    # so the first (threshold, gt) occurrence is the matched detection
+    t_idx, p_idx = np.nonzero(hit)
+    if t_idx.size > 0:
+        key = t_idx * (gt_index.max() + 1) + gt_index[p_idx]
+        _, first = np.unique(key, return_index=True)
+        tp[t_idx[first], p_idx[first]] = True
+    return order, tp
+
+
+def interpolated_ap(precision, recall, num_points=11):
+    ''' Interpolated average precision of (T,P) precision/recall curves
+    (detections sorted by decreasing score), sampled at num_points
+    recall values in [0,1] (11 for PASCAL, 41 for KITTI R40). '''
+    if precision.shape[1] == 0:
+        return np.zeros(precision.shape[0])
+    # precision envelope: best precision at any higher recall
+    envelope = np.maximum.accumulate(precision[:, ::-1], axis=1)[:, ::-1]
+    recall_points = np.linspace(0.0, 1.0, num_points)
+    reached = recall[:, :, None] >= recall_points[None, None, :]  # T,P,R
+    first = np.argmax(reached, axis=1)  # T,R
+    values = np.take_along_axis(envelope, first, axis=1) * np.any(reached, axis=1)
+    return np.mean(values, axis=1)
+
+
+def _subset_metrics(tp, num_gt, num_points):
+    num_det = tp.shape[1]
+    tp_cum = np.cumsum(tp, axis=1)
+    fp_cum = np.arange(1, num_det + 1)[None, :] - tp_cum
+    precision = tp_cum / np.maximum(tp_cum + fp_cum, 1).astype(np.float64)
+    recall = tp_cum / float(max(num_gt, 1))
+    num_tp = tp_cum[:, -1] if num_det > 0 else np.zeros(tp.shape[0], dtype=np.int64)
+    return {'num_gt': int(num_gt),
+            'num_det': int(num_det),
+            'tp': num_tp.tolist(),
+            'precision': (num_tp / float(max(num_det, 1))).tolist(),
+            'recall': (num_tp / float(max(num_gt, 1))).tolist(),
+            'ap': interpolated_ap(precision, recall, num_points).tolist()}
+
+
+def evaluate_detections(scores, ious, gt_index, pred_distances, gt_levels, gt_distances,
+                        thresholds=IOU_THRESHOLDS, distance_bins=DISTANCE_BINS,
+                        num_ap_points=11):
+    ''' Precision, recall and interpolated AP of the detections of a whole
+    split at every IoU threshold, overall and per difficulty level and
+    distance bin.
+
+    For a level or distance bin, detections matched to GT boxes outside the
+    bin are ignored, unmatched detections are false positives of the bin of
+    their predicted distance (and of every level).
+
+    Input:
+        scores, ious, gt_index: (P,) see match_detections, gt_index indexes
+            the GT arrays below
+        pred_distances: (P,) distance of the predicted box centers
+        gt_levels: (G,) int, difficulty level (Object3d.level) of the GT boxes
+        gt_distances: (G,) distance of the GT boxes
+        thresholds: T IoU thresholds
+        distance_bins: distance bin edges
+        num_ap_points: number of recall points of the AP
+    Output:
+        results: dict with 'thresholds', 'overall', 'level' and 'distance';
+            'overall' and each level/bin entry hold num_gt, num_det and the
+            per threshold lists tp, precision, recall and ap
+    '''
+    gt_index = np.asarray(gt_index, dtype=np.int64)
+    gt_levels = np.asarray(gt_levels)
+    gt_distances = np.asarray(gt_distances)
+    order, tp = match_detections(scores, ious, gt_index, thresholds)
+    matched = gt_index[order]
+    det_distances = np.asarray(pred_distances, dtype=np.float64)[order]
+    # matched detections are binned with their GT box
+    det_distances[matched >= 0] = gt_distances[matched[matched >= 0]]
+    det_levels = np.zeros(len(order), dtype=gt_levels.dtype)
+    det_levels[matched >= 0] = gt_levels[matched[matched >= 0]]
+
+    results = {'thresholds': list(thresholds),
+               'overall': _subset_metrics(tp, len(gt_levels), num_ap_points),
+               'level': {}, 'distance': {}}
+    for level, name in sorted(LEVEL_NAMES.items()):
+        keep = (matched < 0) | (det_levels == level)
+        results['level'][name] = _subset_metrics(tp[:, keep], np.sum(gt_levels == level),
+                                                 num_ap_points)
+    for low, high in zip(distance_bins[:-1], distance_bins[1:]):
+        keep = (det_distances >= low) & (det_distances < high)
+        num_gt = np.sum((gt_distances >= low) & (gt_distances < high))
+        results['distance']['%g-%g' % (low, high)] = _subset_metrics(tp[:, keep], num_gt, num_ap_points)
+    return results
+
+
+def selection_score(results, metric='frame_precision'):
+    ''' Model selection score of an evaluation (StreamingEvaluator.metrics)
+    at the first IoU threshold (0.5). frame_precision is the precision
+    averaged per frame that train.py selected the best model on before
+    evaluate_detections, precision and ap are computed over the split. '''
+    if metric == 'frame_precision':
+        return results['frame_precision'][0]
+    return results['overall'][metric][0]
+
+
+def selection_interval(results, metric='frame_precision'):
+    ''' Confidence interval [low, high] of selection_score, for the
+    evaluations on a subset of the frames (see stratified_frames). None for
+    ap, or if the results have no intervals. '''
+    if metric == 'frame_precision':
+        intervals = results.get('frame_precision_ci')
+    else:
+        intervals = results['overall'].get(metric + '_ci')
+    return None if intervals is None else intervals[0]
+
+
+def format_evaluation(results, prefix=''):
+    ''' Lines of text summarizing the output of evaluate_detections. '''
+    thresholds = results['thresholds']
+    header = '%-18s %6s %6s ' % ('', 'gt', 'det') + ' '.join(
+        ['P@%-5g R@%-5g AP@%-4g' % (t, t, t) for t in thresholds])
+    lines = [prefix + header]
+    rows = [('overall', results['overall'])]
+    rows += [('level ' + name, results['level'][name]) for name in
+             [LEVEL_NAMES[k] for k in sorted(LEVEL_NAMES)]]
+    rows += [('dist ' + name, results['distance'][name]) for name in
+             sorted(results['distance'], key=lambda x: float(x.split('-')[0]))]
+    for name, m in rows:
+        values = ' '.join(['%7.4f %7.4f %7.4f' % (m['precision'][i], m['recall'][i], m['ap'][i])
+                           for i in range(len(thresholds))])
+        lines.append(prefix + '%-18s %6d %6d ' % (name, m['num_gt'], m['num_det']) + values)
+    overall = results['overall']
+    if 'precision_ci' in overall:
+        for i, t in enumerate(thresholds):
+            lines.append(prefix + '95%% CI @%g: precision [%.4f, %.4f] recall [%.4f, %.4f]' % (
+                t, overall['precision_ci'][i][0], overall['precision_ci'][i][1],
+                overall['recall_ci'][i][0], overall['recall_ci'][i][1]))
+    return lines
+
+
+def binomial_interval(successes, trials, z=1.96):
+    ''' Wilson score interval of binomial proportions.
+    Input:
+        successes, trials: (T,) counts
+        z: normal quantile of the confidence level (1.96 for 95%)
+    Output:
+        low, high: (T,) interval bounds, (0, 1) when trials is 0
+    '''
+    successes = np.asarray(successes, dtype=np.float64)
+    trials = np.asarray(trials, dtype=np.float64)
+    n = np.maximum(trials, 1.0)
+    p = successes / n
+    denom = 1.0 + z * z / n
+    center = (p + z * z / (2 * n)) / denom
+    half = z * np.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denom
+    low = np.where(trials > 0, center - half, 0.0)
+    high = np.where(trials > 0, center + half, 1.0)
+    return np.clip(low, 0.0, 1.0), np.clip(high, 0.0, 1.0)
+
+
+def mean_interval(values, z=1.96):
+    ''' Normal confidence interval of the mean of per frame values.
+    Input:
+        values: (N,T) values of N frames
+    Output:
+        low, high: (T,) interval bounds, clipped to [0, 1], (0, 1) with
+            fewer than 2 frames
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) < 2:
+        ones = np.ones(values.shape[1:])
+        return 0.0 * ones, ones
+    mean = np.mean(values, axis=0)
+    half = z * np.std(values, axis=0, ddof=1) / np.sqrt(len(values))
+    return np.clip(mean - half, 0.0, 1.0), np.clip(mean + half, 0.0, 1.0)
+
+
+def add_confidence_intervals(results, z=1.96):
+    ''' Add the 'precision_ci' and 'recall_ci' lists of [low, high] per
+    threshold to results['overall'] (output of evaluate_detections). '''
+    overall = results['overall']
+    tp = np.asarray(overall['tp'])
+    for key, trials in [('precision_ci', overall['num_det']), ('recall_ci', overall['num_gt'])]:
+        low, high = binomial_interval(tp, np.full(len(tp), trials), z)
+        overall[key] = np.stack([low, high], 1).tolist()
+    return results
+
+
+def stratified_frames(frame_ids, gt_store, fraction, seed=0):
+    ''' Fixed random subset of the frames of an evaluation dataset for fast
+    evaluations, stratified by difficulty.
+
+    The candidates are the frames of the dataset and the GT frames up to its
+    last frame (the frames a full evaluation counts). They are grouped by
+    the hardest difficulty level of their GT boxes (0 without GT) and the
+    same fraction of each group is drawn.
+    Input:
+        frame_ids: frame id of each frustum of the dataset
+        gt_store: provider.GTStore
+        fraction: float in (0, 1]
+    Output:
+        frames: (F,) sorted frame ids
+    '''
+    frame_ids = np.unique(np.asarray(frame_ids, dtype=np.int64))
+    if len(frame_ids) == 0:
+        return frame_ids
+    candidates = np.union1d(frame_ids, gt_store.frames_up_to(frame_ids[-1]))
+    strata = np.zeros(len(candidates), dtype=np.int32)
+    for i, frame_id in enumerate(candidates):
+        if frame_id in gt_store.slices and gt_store.num_objects(frame_id) > 0:
+            strata[i] = np.max(gt_store.levels[gt_store.slices[frame_id]])
+    rng = np.random.RandomState(seed)
+    frames = []
+    for stratum in np.unique(strata):
+        members = candidates[strata == stratum]
+        count = int(np.ceil(fraction * len(members)))
+        frames.append(rng.choice(members, count, replace=False))
+    return np.sort(np.concatenate(frames))
+
+
+def gt_subset(gt_store, gt_frame_ids=None):
+    ''' Rows of the GT boxes of some frames of a GTStore.
+    Output:
+        gt_rows: (G,) store rows of the GT boxes of the frames
+        gt_map: (N,) store row -> index in gt_rows, -1 for other frames
+    '''
+    if gt_frame_ids is None:
+        gt_rows = np.arange(len(gt_store.levels))
+    else:
+        gt_rows = [np.arange(gt_store.slices[i].start, gt_store.slices[i].stop)
+                   for i in gt_frame_ids if i in gt_store.slices]
+        gt_rows = np.concatenate(gt_rows) if gt_rows else np.zeros(0, dtype=np.int64)
+    gt_map = np.full(len(gt_store.levels), -1, dtype=np.int64)
+    gt_map[gt_rows] = np.arange(len(gt_rows))
+    return gt_rows, gt_map
+
+
+def precision_recall(id_list_frame, corners_frame, scores, iou_frame, indice_box_frame,
+                     gt_store, gt_frame_ids=None, thresholds=IOU_THRESHOLDS):
+    ''' Evaluate per frame detections against the GT boxes of a GTStore.
+
+    Input:
+        id_list_frame: list of frame ids
+        corners_frame: per frame lists of (8,3) predicted corners
+        scores: per frame lists of detection scores
+        iou_frame: per frame lists of 3D IoU with the matched GT box
+        indice_box_frame: per frame lists of 1-based index of the matched GT
+            box in the frame, 0 if the detection matches no GT box
+        gt_store: provider.GTStore of the split
+        gt_frame_ids: ids of the frames whose GT boxes are evaluated,
+            None for all frames of the store
+    Output:
+        results: dict, see evaluate_detections
+    '''
+    gt_rows, gt_map = gt_subset(gt_store, gt_frame_ids)
+    flat_scores, flat_ious, flat_gt, flat_dist = [], [], [], []
+    for j, frame_id in enumerate(id_list_frame):
+        if len(scores[j]) == 0:
+            continue
+        indices = np.asarray(indice_box_frame[j], dtype=np.int64)
+        if frame_id in gt_store.slices:
+            rows = gt_store.slices[frame_id].start + np.maximum(indices, 1) - 1
+            gt_index = np.where(indices > 0, gt_map[rows], -1)
+        else:
+            gt_index = np.full(len(indices), -1, dtype=np.int64)
+        flat_scores.append(np.asarray(scores[j], dtype=np.float64))
+        flat_ious.append(np.where(indices > 0, np.asarray(iou_frame[j], dtype=np.float64), 0.0))
+        flat_gt.append(gt_index)
+        flat_dist.append(np.linalg.norm(np.mean(np.asarray(corners_frame[j]), axis=1), axis=1))
+    if flat_scores:
+        flat_scores, flat_ious, flat_gt, flat_dist = [np.concatenate(x) for x in
+                                                      [flat_scores, flat_ious, flat_gt, flat_dist]]
+    else:
+        flat_scores, flat_ious, flat_dist = np.zeros(0), np.zeros(0), np.zeros(0)
+        flat_gt = np.zeros(0, dtype=np.int64)
+    return evaluate_detections(flat_scores, flat_ious, flat_gt, flat_dist,
+                               gt_store.levels[gt_rows], gt_store.distances[gt_rows], thresholds)
+
+
+def softmax(x):
+    ''' Numpy function for softmax'''
+    shape = x.shape
+    probs = np.exp(x - np.max(x, axis=len(shape) - 1, keepdims=True))
+    probs /= np.sum(probs, axis=len(shape) - 1, keepdims=True)
+    return probs
+
+
+class FrameIndex(object):
+    ''' Grouping of the frustums of a dataset by frame.
+
+    Built once from the frame id of every frustum with np.unique, it does
+    not assume the frustums of a frame to be contiguous. The frustums of
+    frame frames[k] are order[starts[k]:starts[k+1]].
+    '''
+    def __init__(self, frame_ids):
+        frame_ids = np.asarray(frame_ids)
+        self.frames, self.frame_of, self.counts = np.unique(frame_ids, return_inverse=True,
+                                                            return_counts=True)
+        self.order = np.argsort(self.frame_of, kind='mergesort')
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)])
+        self.position = dict((frame_id, k) for k, frame_id in enumerate(self.frames.tolist()))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def num_frustums(self, frame_id):
+        return int(self.counts[self.position[frame_id]])
+
+    def frustums(self, frame_id):
+        ''' Indices of the frustums of a frame. '''
+        k = self.position[frame_id]
+        return self.order[self.starts[k]:self.starts[k + 1]]
+
+    def split(self, values):
+        ''' Per frame slices of an array with one entry per frustum. '''
+        values = np.asarray(values)[self.order]
+        return np.split(values, self.starts[1:-1])
+
+
+class StreamingEvaluator(object):
+    ''' Frame by frame evaluation of frustum detections.
+
+    Frustums are added batch by batch with add_batch. Only the frustums of
+    the frames being received are kept; when a frame is complete (all its
+    frustums of frame_index were received, or at finish()) its KITTI label
+    file is written and its detections are reduced to scores, IoUs and
+    matched GT rows, which is all the precision/recall accumulators need.
+    Without frame_index the frustums of a frame must be contiguous, a frame
+    is complete when a frustum of another frame arrives.
+    metrics() can be called at any time and evaluates the completed frames.
+
+    Frustums with more than min_mask_points predicted object points are
+    evaluated, with at least min_mask_points they are written to the label
+    files, like the former eval_per_frame/write_detection_results_test.
+    Before the evaluated detections of a completed frame are accumulated,
+    the ones matched to the same GT box go through NMS (bird's eye view IoU
+    above nms_threshold, None to disable).
+
+    gt_frame_ids restricts the GT boxes to a subset of the frames (see
+    stratified_frames); the metrics then also hold confidence intervals
+    (precision_ci, recall_ci and frame_precision_ci, see selection_interval).
+
+    The metrics also hold the precision and recall averaged per frame
+    (frame_precision, frame_recall) of the former eval_per_frame, the
+    default model selection score (see selection_score).
+    '''
+    def __init__(self, gt_store, result_dir=None, detail_path=None,
+                 min_mask_points=50, thresholds=IOU_THRESHOLDS, frame_index=None,
+                 gt_frame_ids=None, nms_threshold=0.25):
+        self.gt_store = gt_store
+        self.nms_threshold = nms_threshold
+        self.frame_index = frame_index
+        self.gt_frame_ids = gt_frame_ids
+        self.result_dir = result_dir
+        self.min_mask_points = min_mask_points
+        self.thresholds = thresholds
+        self.detail_file = None
+        if detail_path is not None:
+            if not os.path.exists(os.path.dirname(detail_path)):
+                os.makedirs(os.path.dirname(detail_path))
+            self.detail_file = open(detail_path, 'w')
+        if result_dir is not None and not os.path.exists(os.path.join(result_dir, 'data')):
+            os.makedirs(os.path.join(result_dir, 'data'))
+        # frame id -> list of (score, iou, indice_box, distance, mask count, label, corners)
+        self.pending = {}
+        self.last_id = None
+        self.frame_ids = []
+        self.num_frustums = 0
+        self.max_frame_id = None
+        # per evaluated detection
+        self.scores = []
+        self.ious = []
+        self.gt_rows = []
+        self.distances = []
+        # per completed frame, see frame_metrics
+        self.frame_tp = []
+        self.frame_num_det = []
+
+    def add_batch(self, frame_ids, indice_box, pred, gt, mask_counts, label_counts,
+                  scores, rot_angles):
+        ''' Add the outputs of one batch.
+
+        Input:
+            frame_ids: (B,) frame id of each frustum
+            indice_box: (B,) 1-based index of the GT box of each frustum in its
+                frame, 0 if none
+            pred, gt: tuples (center (B,3), heading_class (B,), heading_residual (B,),
+                size_class (B,), size_residual (B,3)) of the predicted and GT boxes
+            mask_counts, label_counts: (B,) predicted and GT object points
+            scores: (B,) detection scores
+            rot_angles: (B,) frustum rotation angles
+        '''
+        center, hclass, hres, sclass, sres = pred
+        center_GT, hclass_GT, hres_GT, sclass_GT, sres_GT = gt
+        for i in range(len(frame_ids)):
+            size_pred = provider.class2size(sclass[i], sres[i])
+            angle_pred = provider.class2angle(hclass[i], hres[i], 12)
+            size_GT = provider.class2size(sclass_GT[i], sres_GT[i])
+            angle_GT = provider.class2angle(hclass_GT[i], hres_GT[i], 12)
+            pred_box = provider.get_3d_box(size_pred, angle_pred, center[i])
+            GT_box = provider.get_3d_box(size_GT, angle_GT, center_GT[i])
+            iou_3d, iou_2d = box3d_iou(pred_box, GT_box)
+            if self.detail_file is not None:
+                f = self.detail_file
+                f.write("3D box %f \n" % frame_ids[i])
+                f.write("iou %f  ,score %f \n "% (float(iou_3d), scores[i]))
+                f.write("label seg number: %f \n" % label_counts[i])
+                f.write("det seg number: %f\n" % mask_counts[i])
+                f.write("center: %f , %f, %f\n" % (center[i][0], center[i][1], center[i][2]))
+                f.write("center_GT: %f , %f , %f\n" % (center_GT[i][0], center_GT[i][1], center_GT[i][2]))
+                f.write("size pred: %f , %f , %f\n" % (size_pred[0], size_pred[1], size_pred[2]))
+                f.write("size GT: %f, %f , %f\n" % (size_GT[0], size_GT[1], size_GT[2]))
+                f.write("rotation pred %f\n" % angle_pred)
+                f.write("rotation GT %f\n" % angle_GT)
+
+            frame_id = frame_ids[i]
+            if self.frame_index is None and frame_id != self.last_id and self.last_id is not None:
+                self._finish_frame(self.last_id)
+            self.last_id = frame_id
+            label = None
+            if mask_counts[i] >= self.min_mask_points:
+                h, w, l, tx, ty, tz, ry = provider.from_prediction_to_label_format(center[i],
+                    hclass[i], hres[i], sclass[i], sres[i], rot_angles[i])
+                label = "Pedestrian -1 -1 -10 0.0 0.0 0.0 0.0 %f %f %f %f %f %f %f %f" % \
+                    (h, w, l, tx, ty, tz, ry, scores[i])
+            if frame_id not in self.pending:
+                self.pending[frame_id] = []
+            self.pending[frame_id].append((scores[i], iou_3d, indice_box[i], np.linalg.norm(center[i]),
+                                           mask_counts[i], label, pred_box))
+            self.num_frustums += 1
+            if self.frame_index is not None and \
+                    len(self.pending[frame_id]) == self.frame_index.num_frustums(frame_id):
+                self._finish_frame(frame_id)
+
+    def _finish_frame(self, frame_id):
+        records = self.pending.pop(frame_id)
+        labels = [x[5] for x in records if x[5] is not None]
+        if self.result_dir is not None and labels:
+            with open(os.path.join(self.result_dir, 'data', '%06d.txt' % frame_id), 'w') as fout:
+                for line in labels:
+                    fout.write(line + '\n')
+
+        scores, ious, indices, distances, mask_counts, _, corners = zip(*records)
+        keep = np.flatnonzero(np.asarray(mask_counts) > self.min_mask_points)
+        indices = np.asarray(indices, dtype=np.int64)[keep]
+        if self.nms_threshold is not None and len(keep) > 1:
+            # duplicates of a GT box, the detections without GT box are kept
+            suppress = NMS([corners[k] for k in keep], np.asarray(scores)[keep],
+                           self.nms_threshold, groups=np.where(indices > 0, indices, -1))
+            keep, indices = keep[suppress], indices[suppress]
+        if frame_id in self.gt_store.slices:
+            rows = np.where(indices > 0, self.gt_store.slices[frame_id].start + indices - 1, -1)
+        else:
+            rows = np.full(len(indices), -1, dtype=np.int64)
+        self.scores.extend(np.asarray(scores, dtype=np.float64)[keep])
+        self.ious.extend(np.where(indices > 0, np.asarray(ious, dtype=np.float64)[keep], 0.0))
+        self.gt_rows.extend(rows)
+        self.distances.extend(np.asarray(distances, dtype=np.float64)[keep])
+
+        # as eval_per_frame, only the best scored remaining detection of a
+        # GT box keeps its IoU, the others count as false positives
+        frame_scores = np.asarray(scores, dtype=np.float64)[keep]
+        frame_ious = np.where(indices > 0, np.asarray(ious, dtype=np.float64)[keep], 0.0)
+        for index in np.unique(indices[indices > 0]):
+            group = np.flatnonzero(indices == index)
+            frame_ious[group[group != group[np.argmax(frame_scores[group])]]] = 0.0
+        self.frame_tp.append(np.sum(frame_ious[None, :] > np.asarray(self.thresholds)[:, None], axis=1))
+        self.frame_num_det.append(len(keep))
+        self.frame_ids.append(frame_id)
+        self.max_frame_id = frame_id if self.max_frame_id is None else max(self.max_frame_id, frame_id)
+
+    def metrics(self):
+        ''' Evaluation of the completed frames against the GT boxes of the
+        frames with id up to the last completed one (or of gt_frame_ids),
+        see evaluate_detections. '''
+        if self.gt_frame_ids is not None:
+            gt_frame_ids = self.gt_frame_ids
+        elif self.max_frame_id is None:
+            gt_frame_ids = []
+        else:
+            gt_frame_ids = self.gt_store.frames_up_to(self.max_frame_id)
+        gt_rows, gt_map = gt_subset(self.gt_store, gt_frame_ids)
+        rows = np.asarray(self.gt_rows, dtype=np.int64)
+        gt_index = np.where(rows >= 0, gt_map[np.maximum(rows, 0)], -1)
+        results = evaluate_detections(np.asarray(self.scores), np.asarray(self.ious), gt_index,
+                                      np.asarray(self.distances), self.gt_store.levels[gt_rows],
+                                      self.gt_store.distances[gt_rows], self.thresholds)
+        results.update(self.frame_metrics(gt_frame_ids))
+        results['num_frames'] = len(self.frame_ids)
+        results['num_frustums'] = self.num_frustums
+        if self.gt_frame_ids is not None:
+            add_confidence_intervals(results)
+        return results
+
+    def frame_metrics(self, gt_frame_ids):
+        ''' Precision and recall averaged per frame, as the former
+        eval_per_frame/precision_recall of train.py: the precisions of the
+        completed frames with GT boxes are summed and divided by the number
+        of completed frames, the recalls by the number of GT frames.
+        Output:
+            dict with the per threshold lists frame_precision, frame_recall,
+            and with gt_frame_ids frame_precision_ci ([low, high] of the
+            mean of the per frame precisions, see mean_interval)
+        '''
+        gt_frame_ids = set(int(i) for i in gt_frame_ids)
+        # precision of each completed frame, 0 for the frames without GT box
+        precisions = np.zeros((len(self.frame_ids), len(self.thresholds)))
+        recall = np.zeros(len(self.thresholds))
+        for i, (frame_id, tp, num_det) in enumerate(zip(self.frame_ids, self.frame_tp,
+                                                        self.frame_num_det)):
+            if int(frame_id) not in gt_frame_ids:
+                continue
+            precisions[i] = tp / float(max(num_det, 1))
+            recall += tp / float(max(self.gt_store.num_objects(frame_id), 1))
+        metrics = {'frame_precision': (np.sum(precisions, axis=0) / max(len(self.frame_ids), 1)).tolist(),
+                   'frame_recall': (recall / max(len(gt_frame_ids), 1)).tolist()}
+        if self.gt_frame_ids is not None:
+            low, high = mean_interval(precisions)
+            metrics['frame_precision_ci'] = np.stack([low, high], 1).tolist()
+        return metrics
+
+    def finish(self):
+        for frame_id in sorted(self.pending):
+            self._finish_frame(frame_id)
+        if self.detail_file is not None:
+            self.detail_file.close()
+            self.detail_file = None
+        return self.metrics()
+
+    def buffers(self):
+        ''' The accumulated buffers, for memory accounting. '''
+        return {'pending': self.pending, 'frame_ids': self.frame_ids, 'scores': self.scores,
+                'ious': self.ious, 'gt_rows': self.gt_rows, 'distances': self.distances,
+                'frame_tp': self.frame_tp}
+
+
+def evaluate_dataset(sess, ops, dataset, evaluator, batch_size, num_point, num_channel,
+                     log_fn=print, prefix='', tracer=None, frames=None):
+    ''' Run the model on a frustum dataset and evaluate it with a
+    StreamingEvaluator. Shared by train.py and eval.py.
+
+    ops is dict mapping from string to tf ops, as built in train.py.
+    tracer is an optional profile_util.TraceCapture. If the evaluator has no
+    frame_index, the FrameIndex of the evaluated frustums is set.
+    frames optionally restricts the evaluation to the frustums and GT boxes
+    of these frame ids (fast evaluation, see stratified_frames).
+    Output:
+        results: dict, StreamingEvaluator.finish() output with the
+            segmentation and box estimation statistics ('loss',
+            'seg_accuracy', 'seg_class_accuracy', 'iou2d', 'iou3d',
+            'box_accuracy')
+    '''
+    num_classes = 2
+    frame_ids = np.asarray(dataset.id_list[:len(dataset)])
+    if frames is None:
+        test_idxs = np.arange(0, len(dataset))
+    else:
+        test_idxs = np.where(np.isin(frame_ids, frames))[0]
+        evaluator.gt_frame_ids = frames
+    num_batches = len(test_idxs) // batch_size
+    if evaluator.frame_index is None:
+        evaluator.frame_index = FrameIndex(frame_ids[test_idxs[:num_batches * batch_size]])
+
+    total_correct = 0
+    total_seen = 0
+    loss_sum = 0
+    total_seen_class = [0 for _ in range(num_classes)]
+    total_correct_class = [0 for _ in range(num_classes)]
+    iou2ds_sum = 0
+    iou3ds_sum = 0
+    iou3d_correct_cnt = 0
+    box_pred_nbr_sum = 0
+
+    for batch_idx in range(num_batches):
+        start_idx = batch_idx * batch_size
+        end_idx = (batch_idx + 1) * batch_size
+
+        batch_data, batch_label, batch_center, \
+        batch_hclass, batch_hres, \
+        batch_sclass, batch_sres, \
+        batch_rot_angle, batch_one_hot_vec = \
+            get_batch(dataset, test_idxs, start_idx, end_idx,
+                      num_point, num_channel)
+
+        feed_dict = {ops['pointclouds_pl']: batch_data,
+                     ops['one_hot_vec_pl']: batch_one_hot_vec,
+                     ops['labels_pl']: batch_label,
+                     ops['centers_pl']: batch_center,
+                     ops['heading_class_label_pl']: batch_hclass,
+                     ops['heading_residual_label_pl']: batch_hres,
+                     ops['size_class_label_pl']: batch_sclass,
+                     ops['size_residual_label_pl']: batch_sres,
+                     ops['is_training_pl']: False}
+
+        run_kwargs = tracer.begin_step() if tracer is not None else {}
+        loss_val, logits_val, centers_pred_val, heading_scores, heading_residuals, \
+        size_scores, size_residuals, iou2ds, iou3ds, box_pred_nbr = \
+            sess.run([ops['loss'], ops['logits'],
+                      ops['end_points']['center'], ops['end_points']['heading_scores'],
+                      ops['end_points']['heading_residuals'], ops['end_points']['size_scores'],
+                      ops['end_points']['size_residuals'],
+                      ops['end_points']['iou2ds'], ops['end_points']['iou3ds'],
+                      ops['end_points']['box_pred_nbr']],
+                     feed_dict=feed_dict, **run_kwargs)
+        if tracer is not None:
+            tracer.end_step()
+            if tracer.finished():
+                for line in tracer.summary_lines():
+                    log_fn(line)
+
+        batch_seg_prob = softmax(logits_val)[:, :, 1]  # BxN
+        batch_seg_mask = np.argmax(logits_val, 2)  # BxN
+        mask_mean_prob = np.sum(batch_seg_prob * batch_seg_mask, 1)  # B,
+        mask_mean_prob = mask_mean_prob / np.sum(batch_seg_mask, 1)
+        heading_prob = np.max(softmax(heading_scores), 1)  # B
+        size_prob = np.max(softmax(size_scores), 1)  # B,
+        batch_scores = np.log(mask_mean_prob) + np.log(heading_prob) + np.log(size_prob)
+
+        heading_cls = np.argmax(heading_scores, 1)  # B
+        size_cls = np.argmax(size_scores, 1)  # B
+        rows = np.arange(batch_data.shape[0])
+        heading_res = heading_residuals[rows, heading_cls]
+        size_res = size_residuals[rows, size_cls, :]
+
+        preds_val = batch_seg_mask
+        total_correct += np.sum(preds_val == batch_label)
+        total_seen += (batch_size * num_point)
+        loss_sum += loss_val
+        for l in range(num_classes):
+            total_seen_class[l] += np.sum(batch_label == l)
+            total_correct_class[l] += (np.sum((preds_val == l) & (batch_label == l)))
+        iou2ds_sum += np.sum(iou2ds)
+        iou3ds_sum += np.sum(iou3ds)
+        iou3d_correct_cnt += np.sum(iou3ds >= 0.5)
+        box_pred_nbr_sum += np.sum(box_pred_nbr)
+
+        batch_idxs = test_idxs[start_idx:end_idx]
+        evaluator.add_batch(frame_ids[batch_idxs],
+                            [dataset.indice_box[i] for i in batch_idxs],
+                            (centers_pred_val, heading_cls, heading_res, size_cls, size_res),
+                            (batch_center, batch_hclass, batch_hres, batch_sclass, batch_sres),
+                            np.sum(preds_val == 1, 1), np.sum(batch_label == 1, 1),
+                            batch_scores, batch_rot_angle)
+
+    results = evaluator.finish()
+    results['loss'] = loss_sum / float(max(num_batches, 1))
+    results['seg_accuracy'] = total_correct / float(max(total_seen, 1))
+    results['seg_class_accuracy'] = np.mean(np.array(total_correct_class) / \
+        np.maximum(np.array(total_seen_class, dtype=np.float64), 1.0))
+    results['iou2d'] = iou2ds_sum / max(float(box_pred_nbr_sum), 1.0)
+    results['iou3d'] = iou3ds_sum / max(float(box_pred_nbr_sum), 1.0)
+    results['box_accuracy'] = float(iou3d_correct_cnt) / max(float(box_pred_nbr_sum), 1.0)
+
+    log_fn(prefix + 'eval mean loss: %f' % results['loss'])
+    log_fn(prefix + 'eval segmentation accuracy: %f' % results['seg_accuracy'])
+    log_fn(prefix + 'eval segmentation avg class acc: %f' % results['seg_class_accuracy'])
+    log_fn(prefix + 'eval box IoU (ground/3D): %f / %f' % (results['iou2d'], results['iou3d']))
+    log_fn(prefix + 'eval box estimation accuracy (IoU=0.5): %f' % results['box_accuracy'])
+    for line in format_evaluation(results, prefix):
+        log_fn(line)
+    return results
+
+
+def read_metrics(path, offset=0):
+    ''' Read the records appended to a JSON lines metrics file (as written
+    by eval_worker.py) since byte offset.
+    Output:
+        records: list of dicts
+        offset: new offset, to pass to the next call
+    '''
+    if not os.path.exists(path):
+        return [], offset
+    records = []
+    with open(path, 'r') as f:
+        f.seek(offset)
+        while True:
+            line = f.readline()
+            if not line.endswith('\n'):
+                # incomplete line, read again at the next call
+                break
+            if line.strip():
+                records.append(json.loads(line))
+            offset = f.tell()
+    return records, offset
@@ -0,0 +1,249 @@
+''' Evaluation worker for Frustum PointNets training runs.
+
+Watches LOG_DIR/ckpt for checkpoints written by train.py --async_eval,
+restores every new checkpoint into its own inference session, evaluates
+the configured datasets and writes the metrics to TensorBoard
+(LOG_DIR/eval) and to LOG_DIR/eval_metrics.jsonl, which the trainer polls
+to track the best model. Training never waits for evaluation.
+
+The worker stops once train.py has written LOG_DIR/ckpt/TRAINING_DONE and
+all checkpoints are evaluated. Checkpoints already in the metrics file are
+skipped, so a worker can be restarted.
+
+Usage:
+    python train/eval_worker.py --log_dir log/<run> --model frustum_pointnets_v1
+'''
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import importlib
+import tensorflow as tf
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.join(ROOT_DIR, 'models'))
+import provider
+import frame_cache
+import tf_util
+from eval_util import StreamingEvaluator, evaluate_dataset, SELECTION_METRICS, selection_score
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--log_dir', required=True, help='Log dir of the training run (with ckpt/)')
+parser.add_argument('--model', default='frustum_pointnets_v1', help='Model name [default: frustum_pointnets_v1]')
+parser.add_argument('--gpu', type=int, default=-1, help='GPU to use, -1 for CPU [default: -1]')
+parser.add_argument('--num_point', type=int, default=2048, help='Point Number [default: 2048]')
+parser.add_argument('--batch_size', type=int, default=32, help='Batch Size during evaluation [default: 32]')
+parser.add_argument('--no_intensity', action='store_true', help='Only use XYZ for evaluation')
+parser.add_argument('--datasets', default='val:224,test:224,val:704,test:704', help='Comma separated split:res to evaluate, the last one is used for model selection [default: val:224,test:224,val:704,test:704]')
+parser.add_argument('--poll_interval', type=float, default=30, help='Seconds between checkpoint directory scans [default: 30]')
+parser.add_argument('--write_results', action='store_true', help='Write KITTI label files of every checkpoint')
+parser.add_argument('--once', action='store_true', help='Evaluate the pending checkpoints and exit')
+parser.add_argument('--layout_config', default=None, help='Layouts recorded by benchmark_model.py --autotune, default NHWC with fused batch norm [default: None]')
+parser.add_argument('--voxel_size', type=float, default=0, help='Downsample the frustums to one point per voxel of this size in meters, 0 to disable [default: 0]')
+parser.add_argument('--voxel_reduction', default='centroid', help='Point kept per voxel: centroid or first [default: centroid]')
+parser.add_argument('--frame_views', action='store_true', help='Store every frame once and the frustums as point indices into it, see provider.FrustumViews')
+parser.add_argument('--frame_cache_mb', type=int, default=1024, help='Size of the cache of frame files shared by the datasets, 0 to disable [default: 1024]')
+parser.add_argument('--selection_metric', default='frame_precision', choices=SELECTION_METRICS, help='Score of the best model selection at IoU 0.5, see train.py [default: frame_precision]')
+parser.add_argument('--single_pass_build', action='store_true', help='Build the datasets of the resolutions of a split in one pass over the frames')
+parser.add_argument('--pointwise', action='store_true', help='Run the 1x1 conv stacks of the model as tf_util.shared_mlp layers (same variables)')
+
+DONE_FILE = 'TRAINING_DONE'
+METRICS_FILE = 'eval_metrics.jsonl'
+# Database of the FrustumDataset of each split, as in train.py
+DATABASES = {'val': 'KITTI', 'test': 'KITTI_2'}
+
+
+def log_string(out_str):
+    print(out_str)
+    sys.stdout.flush()
+
+
+def list_checkpoints(ckpt_dir):
+    ''' Complete checkpoints (with their .index file) of the directory,
+    oldest first. Copies of the best model are skipped. '''
+    paths = [p[:-len('.index')] for p in glob.glob(os.path.join(ckpt_dir, '*.ckpt.index'))]
+    paths = [p for p in paths if not p.endswith('_best.ckpt')]
+    return sorted(paths, key=lambda p: os.path.getmtime(p + '.index'))
+
+
+def evaluated_checkpoints(metrics_path):
+    done = set()
+    if os.path.exists(metrics_path):
+        with open(metrics_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    done.add(json.loads(line)['checkpoint'])
+    return done
+
+
+def build_graph(model, batch_size, num_point):
+    ''' Inference graph with the same variables as the training graph.
+    Output:
+        ops: dict of tensors as used by eval_util.evaluate_dataset
+        saver: tf.train.Saver of the graph variables
+    '''
+    pointclouds_pl, one_hot_vec_pl, labels_pl, centers_pl, \
+    heading_class_label_pl, heading_residual_label_pl, \
+    size_class_label_pl, size_residual_label_pl = \
+        model.placeholder_inputs(batch_size, num_point)
+    is_training_pl = tf.placeholder(tf.bool, shape=())
+    batch = tf.get_variable('batch', [],
+                            initializer=tf.constant_initializer(0), trainable=False)
+
+    end_points = model.get_model(pointclouds_pl, one_hot_vec_pl,
+                                 is_training_pl, bn_decay=None,
+                                 pointwise=FLAGS.pointwise)
+    loss = model.get_loss(labels_pl, centers_pl,
+                          heading_class_label_pl, heading_residual_label_pl,
+                          size_class_label_pl, size_residual_label_pl, end_points)
+    iou2ds, iou3ds, box_det_nbr = tf.py_func(provider.compute_box3d_iou_batch,
+        [end_points['mask_logits'], end_points['center'],
+         end_points['heading_scores'], end_points['heading_residuals'],
+         end_points['size_scores'], end_points['size_residuals'],
+         centers_pl, heading_class_label_pl, heading_residual_label_pl,
+         size_class_label_pl, size_residual_label_pl],
+        [tf.float32, tf.float32, tf.float32])
+    end_points['iou2ds'] = iou2ds
+    end_points['iou3ds'] = iou3ds
+    end_points['box_pred_nbr'] = box_det_nbr
+
+    ops = {'pointclouds_pl': pointclouds_pl,
+           'one_hot_vec_pl': one_hot_vec_pl,
+           'labels_pl': labels_pl,
+           'centers_pl': centers_pl,
+           'heading_class_label_pl': heading_class_label_pl,
+           'heading_residual_label_pl': heading_residual_label_pl,
+           'size_class_label_pl': size_class_label_pl,
+           'size_residual_label_pl': size_residual_label_pl,
+           'is_training_pl': is_training_pl,
+           'logits': end_points['mask_logits'],
+           'loss': loss,
+           'step': batch,
+           'end_points': end_points}
+    return ops, tf.train.Saver()
+
+
+def summarize(results):
+    ''' JSON friendly summary of the output of evaluate_dataset. '''
+    summary = {'thresholds': results['thresholds'],
+               'precision': results['overall']['precision'],
+               'recall': results['overall']['recall'],
+               'ap': results['overall']['ap'],
+               'frame_precision': results['frame_precision'],
+               'frame_recall': results['frame_recall'],
+               'score': selection_score(results, FLAGS.selection_metric),
+               'level_ap': dict((k, v['ap']) for k, v in results['level'].items())}
+    for key in ['loss', 'seg_accuracy', 'iou2d', 'iou3d', 'box_accuracy', 'num_frames']:
+        summary[key] = float(results[key])
+    return summary
+
+
+def evaluate_checkpoint(sess, ops, saver, ckpt, datasets, writer):
+    saver.restore(sess, ckpt)
+    step = int(sess.run(ops['step']))
+    start = time.time()
+    record = {'checkpoint': ckpt, 'step': step, 'datasets': {}}
+    values = []
+    for name, dataset in datasets:
+        split, res = name.split(':')
+        result_dir = None
+        if FLAGS.write_results:
+            result_dir = os.path.join(FLAGS.log_dir, 'eval', os.path.basename(ckpt), split, res)
+        evaluator = StreamingEvaluator(provider.get_gt_store('KITTI', 'val'), result_dir=result_dir)
+        results = evaluate_dataset(sess, ops, dataset, evaluator, FLAGS.batch_size,
+                                   FLAGS.num_point, NUM_CHANNEL, log_fn=log_string,
+                                   prefix='%s %s ' % (res, split))
+        summary = summarize(results)
+        record['datasets'][name] = summary
+        tag = '%s_%s' % (split, res)
+        values += [tf.Summary.Value(tag=tag + '/precision_0.5', simple_value=summary['precision'][0]),
+                   tf.Summary.Value(tag=tag + '/recall_0.5', simple_value=summary['recall'][0]),
+                   tf.Summary.Value(tag=tag + '/ap_0.5', simple_value=summary['ap'][0]),
+                   tf.Summary.Value(tag=tag + '/frame_precision_0.5', simple_value=summary['frame_precision'][0]),
+                   tf.Summary.Value(tag=tag + '/loss', simple_value=summary['loss']),
+                   tf.Summary.Value(tag=tag + '/segmentation_accuracy', simple_value=summary['seg_accuracy'])]
+    writer.add_summary(tf.Summary(value=values), step)
+    writer.flush()
+    # Like train.py, the model is selected on the last evaluated dataset
+    record['score'] = record['datasets'][datasets[-1][0]]['score']
+    record['eval_time'] = time.time() - start
+    record['time'] = time.time()
+    return record
+
+
+def main():
+    ckpt_dir = os.path.join(FLAGS.log_dir, 'ckpt')
+    metrics_path = os.path.join(FLAGS.log_dir, METRICS_FILE)
+    frame_cache.FRAME_CACHE.set_max_bytes(FLAGS.frame_cache_mb * 1024**2)
+    names = [d for d in FLAGS.datasets.split(',') if d]
+    kwargs = {'rotate_to_center': True, 'one_hot': True, 'voxel_size': FLAGS.voxel_size,
+              'voxel_reduction': FLAGS.voxel_reduction, 'frame_views': FLAGS.frame_views}
+    built = {}
+    if FLAGS.single_pass_build:
+        # one pass over the frames of each split for all its resolutions
+        splits = []
+        for name in names:
+            if name.split(':')[0] not in splits:
+                splits.append(name.split(':')[0])
+        for split in splits:
+            res_list = [name.split(':')[1] for name in names if name.split(':')[0] == split]
+            for res, dataset in zip(res_list, provider.FrustumDataset.for_resolutions(
+                    FLAGS.num_point, DATABASES[split], split, res_list, **kwargs)):
+                built[split + ':' + res] = dataset
+    else:
+        for name in names:
+            split, res = name.split(':')
+            built[name] = provider.FrustumDataset(npoints=FLAGS.num_point,
+                database=DATABASES[split], split=split, res=res, **kwargs)
+    datasets = [(name, built[name]) for name in names]
+    log_string(frame_cache.FRAME_CACHE.report())
+    for name, dataset in datasets:
+        if dataset.voxel_stats is not None:
+            log_string(name + ' ' + provider.format_downsampling_stats(dataset.voxel_stats))
+
+    with tf.Graph().as_default():
+        device = '/cpu:0' if FLAGS.gpu < 0 else '/gpu:' + str(FLAGS.gpu)
+        with tf.device(device):
+            ops, saver = build_graph(MODEL, FLAGS.batch_size, FLAGS.num_point)
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth = True
+        config.allow_soft_placement = True
+        sess = tf.Session(config=config)
+        writer = tf.summary.FileWriter(os.path.join(FLAGS.log_dir, 'eval'))
+
+        done = evaluated_checkpoints(metrics_path)
+        while True:
+            training_done = os.path.exists(os.path.join(ckpt_dir, DONE_FILE))
+            pending = [c for c in list_checkpoints(ckpt_dir) if c not in done]
+            for ckpt in pending:
+                if not os.path.exists(ckpt + '.index'):
+                    # removed by the trainer's retention policy in the meantime
+                    continue
+                log_string('**** EVALUATING %s ****' % ckpt)
+                record = evaluate_checkpoint(sess, ops, saver, ckpt, datasets, writer)
+                with open(metrics_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+                done.add(ckpt)
+                log_string('%s: score %f (%.1fs)' % (ckpt, record['score'], record['eval_time']))
+            if FLAGS.once or (training_done and not pending):
+                break
+            if not pending:
+                time.sleep(FLAGS.poll_interval)
+        writer.close()
+
+
+if __name__ == '__main__':
+    FLAGS = parser.parse_args()
+    if FLAGS.gpu < 0:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    NUM_CHANNEL = 3 if FLAGS.no_intensity else 4
+    MODEL = importlib.import_module(FLAGS.model)
+    if FLAGS.layout_config is not None:
+        tf_util.load_layout(FLAGS.layout_config, 'cpu' if FLAGS.gpu < 0 else 'gpu', 'forward')
+    main()
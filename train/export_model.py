@@ -0,0 +1,204 @@
+''' Export a trained Frustum PointNets model for inference.
+
+Builds the inference part of the model only: point cloud and one hot
+vector inputs, no labels, no loss and no tf.py_func (the masked points are
+gathered in the graph, see model_util.tf_mask_to_indices). Batch norm uses
+the moving statistics and dropout is disabled (is_training is a constant).
+The checkpoint variables are turned into constants and the graph is
+written as a frozen GraphDef (.pb) or as a SavedModel.
+
+Outputs (tensor names of the exported graph):
+    seg_logits (B,N,2), center (B,3), heading_scores (B,NH),
+    heading_residuals (B,NH), size_scores (B,NS), size_residuals (B,NS,3),
+    heading_class (B,), heading_residual (B,), size_class (B,),
+    size_residual (B,3) of the best bins, score (B,) the detection
+    score of test.py, and box_valid (B,) 1 for the frustums with a box
+    estimate, 0 for those skipped with --min_mask_points (their box
+    outputs are zeros and must be dropped).
+
+Usage:
+    python train/export_model.py --model frustum_pointnets_v1 \
+        --model_path log/ckpt --num_point 1024 --output export/fpointnet.pb
+    python train/test.py --frozen_graph export/fpointnet.pb ...
+'''
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import importlib
+import numpy as np
+import tensorflow as tf
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.join(ROOT_DIR, 'models'))
+import profile_util
+import checkpoint_util
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', default='frustum_pointnets_v1', help='Model name [default: frustum_pointnets_v1]')
+parser.add_argument('--model_path', required=True, help='Checkpoint path, or checkpoint directory for its best model')
+parser.add_argument('--num_point', type=int, default=1024, help='Point Number [default: 1024]')
+parser.add_argument('--batch_size', type=int, default=0, help='Batch size of the inputs, 0 for a variable batch size (v1 only) [default: 0]')
+parser.add_argument('--format', default='frozen', help='frozen (GraphDef .pb) or saved_model [default: frozen]')
+parser.add_argument('--output', default='fpointnet.pb', help='Output .pb file or SavedModel directory [default: fpointnet.pb]')
+parser.add_argument('--min_mask_points', type=int, default=0, help='Skip the box estimation of the frustums with fewer mask points, v1 only [default: 0]')
+parser.add_argument('--optimize', action='store_true', help='Fold the batch norms and remove dropout and identities, see optimize_graph.py')
+parser.add_argument('--pointwise', action='store_true', help='Run the 1x1 conv stacks of the model as tf_util.shared_mlp layers (same variables)')
+parser.add_argument('--benchmark', type=int, default=0, help='Time this many calls of the exported graph [default: 0]')
+
+INPUT_NAMES = ['pointclouds', 'one_hot_vec']
+OUTPUT_NAMES = ['seg_logits', 'center', 'heading_scores', 'heading_residuals',
+                'size_scores', 'size_residuals', 'heading_class', 'heading_residual',
+                'size_class', 'size_residual', 'score', 'box_valid']
+
+
+def build_inference_graph(model, batch_size, num_point, min_mask_points=0, pointwise=False):
+    ''' Inference graph of a model in the default graph.
+    Input:
+        model: frustum_pointnets_v1/v2 module
+        batch_size: int or None for a variable batch size
+        num_point: int
+        min_mask_points: int, see frustum_pointnets_v1.get_model
+        pointwise: bool, see frustum_pointnets_v1.get_model
+    Output:
+        inputs, outputs: dicts of tensors named as INPUT_NAMES, OUTPUT_NAMES
+    '''
+    pointclouds = tf.placeholder(tf.float32, shape=(batch_size, num_point, 4), name='pointclouds')
+    one_hot_vec = tf.placeholder(tf.float32, shape=(batch_size, 3), name='one_hot_vec')
+    kwargs = {'min_mask_points': min_mask_points} if min_mask_points > 0 else {}
+    end_points = model.get_model(pointclouds, one_hot_vec, tf.constant(False),
+                                 bn_decay=None, use_py_func=False,
+                                 pointwise=pointwise, **kwargs)
+
+    logits = end_points['mask_logits']
+    # Detection score, as computed in numpy by test.inference
+    seg_prob = tf.nn.softmax(logits)[:, :, 1] # BxN
+    seg_mask = tf.to_float(tf.argmax(logits, 2)) # BxN
+    mask_mean_prob = tf.reduce_sum(seg_prob * seg_mask, 1) / tf.reduce_sum(seg_mask, 1) # B
+    heading_prob = tf.reduce_max(tf.nn.softmax(end_points['heading_scores']), 1) # B
+    size_prob = tf.reduce_max(tf.nn.softmax(end_points['size_scores']), 1) # B
+    score = tf.log(mask_mean_prob) + tf.log(heading_prob) + tf.log(size_prob)
+
+    heading_class = tf.to_int32(tf.argmax(end_points['heading_scores'], 1))
+    size_class = tf.to_int32(tf.argmax(end_points['size_scores'], 1))
+    rows = tf.range(tf.shape(logits)[0])
+    heading_residual = tf.gather_nd(end_points['heading_residuals'],
+                                    tf.stack([rows, heading_class], 1))
+    size_residual = tf.gather_nd(end_points['size_residuals'],
+                                 tf.stack([rows, size_class], 1))
+
+    box_valid = end_points.get('box_valid', tf.ones_like(score))
+
+    tensors = [logits, end_points['center'], end_points['heading_scores'],
+               end_points['heading_residuals'], end_points['size_scores'],
+               end_points['size_residuals'], heading_class, heading_residual,
+               size_class, size_residual, score, box_valid]
+    outputs = dict((name, tf.identity(t, name=name)) for name, t in zip(OUTPUT_NAMES, tensors))
+    inputs = {'pointclouds': pointclouds, 'one_hot_vec': one_hot_vec}
+    return inputs, outputs
+
+
+def freeze(model, model_path, batch_size, num_point, min_mask_points=0, pointwise=False):
+    ''' Frozen GraphDef of the inference graph with the variables of a checkpoint. '''
+    with tf.Graph().as_default() as graph:
+        with tf.device('/cpu:0'):
+            build_inference_graph(model, batch_size, num_point, min_mask_points, pointwise)
+        saver = tf.train.Saver()
+        with tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+            saver.restore(sess, model_path)
+            graph_def = tf.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), OUTPUT_NAMES)
+    for node in graph_def.node:
+        node.device = ''
+    return graph_def
+
+
+def write_saved_model(graph_def, export_dir):
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        inputs = dict((n, graph.get_tensor_by_name(n + ':0')) for n in INPUT_NAMES)
+        outputs = dict((n, graph.get_tensor_by_name(n + ':0')) for n in OUTPUT_NAMES)
+        signature = tf.saved_model.signature_def_utils.predict_signature_def(inputs, outputs)
+        builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+        with tf.Session() as sess:
+            builder.add_meta_graph_and_variables(sess, [tf.saved_model.tag_constants.SERVING],
+                signature_def_map={tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY:
+                                   signature})
+        builder.save()
+
+
+def load_frozen_graph(path, config=None):
+    ''' Session and ops of an exported graph (frozen .pb file or SavedModel
+    directory).
+    Output:
+        sess: tf.Session
+        ops: dict with the input placeholders 'pointclouds_pl' and
+            'one_hot_vec_pl' and the OUTPUT_NAMES tensors
+    '''
+    graph = tf.Graph()
+    sess = tf.Session(graph=graph, config=config)
+    with graph.as_default():
+        if os.path.isdir(path):
+            tf.saved_model.loader.load(sess, [tf.saved_model.tag_constants.SERVING], path)
+        else:
+            graph_def = tf.GraphDef()
+            with tf.gfile.GFile(path, 'rb') as f:
+                graph_def.ParseFromString(f.read())
+            tf.import_graph_def(graph_def, name='')
+    ops = dict((n, graph.get_tensor_by_name(n + ':0')) for n in OUTPUT_NAMES)
+    ops['pointclouds_pl'] = graph.get_tensor_by_name('pointclouds:0')
+    ops['one_hot_vec_pl'] = graph.get_tensor_by_name('one_hot_vec:0')
+    return sess, ops
+
+
+def benchmark(path, num_calls, batch_size, num_point):
+    ''' Load time, memory and per call latency of an exported graph. '''
+    rss_start = profile_util.peak_rss_bytes()
+    start = time.time()
+    sess, ops = load_frozen_graph(path)
+    load_time = time.time() - start
+    batch_size = batch_size or 1
+    feed_dict = {ops['pointclouds_pl']: np.random.randn(batch_size, num_point, 4),
+                 ops['one_hot_vec_pl']: np.tile([0, 1, 0], (batch_size, 1))}
+    fetches = [ops[n] for n in OUTPUT_NAMES]
+    sess.run(fetches, feed_dict=feed_dict)
+    times = []
+    for _ in range(num_calls):
+        start = time.time()
+        sess.run(fetches, feed_dict=feed_dict)
+        times.append(time.time() - start)
+    sess.close()
+    summary = profile_util.summarize_times(times)
+    print('load time: %.3f s' % load_time)
+    print('call latency (batch %d): p50 %.2f ms  p99 %.2f ms' % (batch_size,
+        summary['p50'] * 1000, summary['p99'] * 1000))
+    if rss_start is not None:
+        print('memory: %s' % profile_util.format_bytes(profile_util.peak_rss_bytes() - rss_start))
+
+
+def main():
+    model = importlib.import_module(FLAGS.model)
+    model_path = checkpoint_util.resolve_checkpoint(FLAGS.model_path)
+    batch_size = FLAGS.batch_size if FLAGS.batch_size > 0 else None
+    graph_def = freeze(model, model_path, batch_size, FLAGS.num_point,
+                       FLAGS.min_mask_points, FLAGS.pointwise)
+    print('Exported %s: %d nodes' % (model_path, len(graph_def.node)))
+    if FLAGS.optimize:
+        import optimize_graph
+        graph_def = optimize_graph.optimize(graph_def)
+    if FLAGS.format == 'saved_model':
+        write_saved_model(graph_def, FLAGS.output)
+    else:
+        output_dir = os.path.dirname(os.path.abspath(FLAGS.output))
+        tf.train.write_graph(graph_def, output_dir, os.path.basename(FLAGS.output), as_text=False)
+    print('Written to %s' % FLAGS.output)
+    if FLAGS.benchmark > 0:
+        benchmark(FLAGS.output, FLAGS.benchmark, FLAGS.batch_size, FLAGS.num_point)
+
+
+if __name__ == '__main__':
+    FLAGS = parser.parse_args()
+    main()
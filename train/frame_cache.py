@@ -0,0 +1,105 @@
+''' Process-wide LRU cache of the per-frame files.
+
+Every KittiDataset accessor (lidar scan, radar scan, labels, calibration,
+image) and provider.get_pixels read their file through FRAME_CACHE, so the
+datasets of a process built on the same frames (e.g. the 224 and 704
+detections of the val split) read every file once. Entries are keyed by
+(frame directory, frame id, artifact), the directory being the one the
+file is read from (root dir, database and training/testing), and the
+least recently used entries are evicted when the cached values exceed
+max_bytes.
+
+Cached numpy arrays are returned as is (no copy) and are read-only:
+callers must copy them before writing; the code of train/ only reads
+them (the frustums are gathered with masks or index arrays). Mutable
+python objects cannot be protected this way, their accessors return
+copies (see KittiDataset.get_label and get_calib).
+
+Usage:
+    import frame_cache
+    frame_cache.FRAME_CACHE.set_max_bytes(512 * 1024**2)
+    ...
+    print(frame_cache.FRAME_CACHE.report())
+'''
+from __future__ import print_function
+
+import threading
+from collections import OrderedDict
+import numpy as np
+import profile_util
+
+DEFAULT_MAX_BYTES = 1024**3
+
+
+class FrameCache(object):
+    ''' Byte bounded LRU cache, with hit and eviction statistics.
+    max_bytes 0 disables the cache (every get loads). '''
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key -> (value, nbytes), least recent first
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def get(self, key, load):
+        ''' Cached value of key, loaded with load() on a miss. '''
+        with self.lock:
+            if key in self.entries:
+                entry = self.entries.pop(key)
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        value = load()
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+        nbytes = profile_util.deep_nbytes(value)
+        with self.lock:
+            if nbytes <= self.max_bytes and key not in self.entries:
+                self.entries[key] = (value, nbytes)
+                self.nbytes += nbytes
+                self._evict()
+        return value
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self.entries:
+            _, (_, nbytes) = self.entries.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+            self.evicted_bytes += nbytes
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / float(lookups) if lookups else 0.0,
+                    'evictions': self.evictions, 'evicted_bytes': self.evicted_bytes,
+                    'entries': len(self.entries), 'bytes': self.nbytes,
+                    'max_bytes': self.max_bytes}
+
+    def report(self):
+        stats = self.stats()
+        return 'frame cache: %d entries, %s / %s, hit rate %.3f (%d hits, %d misses), %d evictions (%s)' % (
+            stats['entries'], profile_util.format_bytes(stats['bytes']),
+            profile_util.format_bytes(stats['max_bytes']), stats['hit_rate'],
+            stats['hits'], stats['misses'], stats['evictions'],
+            profile_util.format_bytes(stats['evicted_bytes']))
+
+
+FRAME_CACHE = FrameCache()
@@ -227,3 +227,18 @@ def in_hull(p, hull):
         flag = np.zeros(p.shape[0], dtype=np.bool)
 
     return flag
+
+
+def in_box3d(p, corners):
+    """
+    Vectorized in_hull for the boxes of boxes3d_to_corners3d: the points are
+    projected on the three edges of the box from corner 0.
+    :param p: (N, 3) test points
+    :param corners: (8, 3) corners of a box, as ordered by boxes3d_to_corners3d
+    :return (N) bool
+    """
+    origin = corners[0]
+    edges = np.stack([corners[1] - origin, corners[3] - origin, corners[4] - origin])  # (3, 3)
+    proj = np.dot(p - origin, edges.T)  # (N, 3)
+    lengths = np.sum(edges ** 2, axis=1)
+    return np.all((proj >= 0) & (proj <= lengths), axis=1)
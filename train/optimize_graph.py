@@ -0,0 +1,400 @@
+''' Inference optimization of the graphs written by export_model.py.
+
+Passes on the frozen GraphDef:
+    fold_batch_norms: every (conv1d|conv2d|fully_connected) + bias + batch
+        norm of tf_util becomes a single conv/matmul + bias, the batch norm
+        scale and shift are folded into the weight and bias constants
+    remove_dead_branches: the tf.cond of the dropout layers (and of any
+        cond on a constant predicate) is replaced by its live branch
+    strip_identities: Identity nodes (variable reads, cond outputs) are
+        bypassed, the exported input and output names are kept
+
+check_equivalence runs the original and optimized graphs on the same
+random frustums and compares all outputs (with --check every batch norm of
+the graph must be folded), benchmark_graphs reports their latencies.
+
+Usage:
+    python train/optimize_graph.py --input export/fpointnet.pb \
+        --output export/fpointnet_opt.pb --check --benchmark 50
+'''
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import collections
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import tensor_util
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+import profile_util
+from export_model import INPUT_NAMES, OUTPUT_NAMES
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input', required=True, help='Frozen graph written by export_model.py')
+parser.add_argument('--output', required=True, help='Optimized frozen graph')
+parser.add_argument('--check', action='store_true', help='Compare the outputs of the original and optimized graphs')
+parser.add_argument('--benchmark', type=int, default=0, help='Time this many calls of both graphs [default: 0]')
+parser.add_argument('--batch_size', type=int, default=8, help='Batch size of the check and benchmark if the graph has a variable batch size [default: 8]')
+
+BATCH_NORM_OPS = ('FusedBatchNorm', 'FusedBatchNormV2', 'FusedBatchNormV3')
+# ops that only change the shape of a tensor, between the layers of tf_util
+# and their batch norm (2D and conv1d batch norms, tf.nn.conv1d)
+SHAPE_OPS = ('Reshape', 'ExpandDims', 'Squeeze')
+
+
+def node_name(tensor_name):
+    ''' Node name of an input string ('^node', 'node:1', 'node'). '''
+    name = tensor_name[1:] if tensor_name.startswith('^') else tensor_name
+    return name.split(':')[0]
+
+
+def output_index(tensor_name):
+    parts = tensor_name.split(':')
+    return int(parts[1]) if len(parts) > 1 else 0
+
+
+class GraphNodes(object):
+    ''' Name -> node map of a GraphDef with the consumers of each node. '''
+    def __init__(self, graph_def):
+        self.nodes = collections.OrderedDict((n.name, n) for n in graph_def.node)
+        self.consumers = collections.defaultdict(list)
+        for n in graph_def.node:
+            for inp in n.input:
+                self.consumers[node_name(inp)].append(n.name)
+
+    def resolve(self, tensor_name):
+        ''' Node producing a tensor, skipping Identity nodes. '''
+        node = self.nodes[node_name(tensor_name)]
+        while node.op == 'Identity':
+            node = self.nodes[node_name(node.input[0])]
+        return node
+
+    def resolve_shape(self, tensor_name):
+        ''' Node producing a tensor, skipping Identity nodes and the shape
+        only ops (SHAPE_OPS). '''
+        node = self.resolve(tensor_name)
+        while node.op in SHAPE_OPS:
+            node = self.resolve(node.input[0])
+        return node
+
+    def resolve_weight(self, tensor_name):
+        ''' Node producing a layer weight, also skipping the Reshape of the
+        1x1xCxC' kernels of tf_util.shared_mlp and the ExpandDims of the
+        conv1d kernels. '''
+        return self.resolve_shape(tensor_name)
+
+    def const_value(self, tensor_name):
+        node = self.resolve(tensor_name)
+        if node.op != 'Const':
+            return None
+        return tensor_util.MakeNdarray(node.attr['value'].tensor)
+
+    def to_graph_def(self, graph_def):
+        out = tf.GraphDef()
+        out.versions.CopyFrom(graph_def.versions)
+        out.library.CopyFrom(graph_def.library)
+        out.node.extend(self.nodes.values())
+        return out
+
+
+def _set_const(node, value):
+    node.attr['value'].tensor.CopyFrom(tensor_util.make_tensor_proto(value))
+
+
+def fold_batch_norms(graph_def):
+    ''' Fold inference mode batch norms into the preceding layer.
+
+    Matches FusedBatchNorm(BiasAdd(Conv2D|MatMul(x, W), b)), optionally with
+    shape only ops in between (the Reshape of the 2D batch norms, the
+    ExpandDims of the conv1d batch norms, the Squeeze of tf.nn.conv1d),
+    where W and b are constants only used by this layer:
+        W' = W * gamma / sqrt(var + eps)
+        b' = (b - mean) * gamma / sqrt(var + eps) + beta
+    and the batch norm becomes an Identity of its input.
+    Output:
+        graph_def: new GraphDef
+        folded, skipped: number of folded and not foldable batch norms
+    '''
+    g = GraphNodes(graph_def)
+    folded = 0
+    skipped = 0
+    for node in list(g.nodes.values()):
+        if node.op not in BATCH_NORM_OPS:
+            continue
+        if node.attr['is_training'].b:
+            skipped += 1
+            continue
+        x = g.resolve_shape(node.input[0])
+        layer = g.resolve_shape(x.input[0]) if x.op == 'BiasAdd' else None
+        if layer is None or layer.op not in ('Conv2D', 'MatMul') or \
+                (layer.op == 'MatMul' and layer.attr['transpose_b'].b):
+            skipped += 1
+            continue
+        weight_node = g.resolve_weight(layer.input[1])
+        bias_node = g.resolve(x.input[1])
+        params = [g.const_value(name) for name in node.input[1:5]]
+        if weight_node.op != 'Const' or bias_node.op != 'Const' or \
+                any(p is None for p in params) or \
+                len(g.consumers[weight_node.name]) > 1 or len(g.consumers[bias_node.name]) > 1:
+            skipped += 1
+            continue
+        gamma, beta, mean, var = params
+        scale = gamma / np.sqrt(var + node.attr['epsilon'].f)
+        weights = g.const_value(weight_node.name)
+        bias = g.const_value(bias_node.name)
+        _set_const(weight_node, (weights * scale).astype(weights.dtype))
+        _set_const(bias_node, ((bias - mean) * scale + beta).astype(bias.dtype))
+
+        identity = tf.NodeDef()
+        identity.name = node.name
+        identity.op = 'Identity'
+        identity.input.append(node.input[0])
+        identity.attr['T'].CopyFrom(node.attr['T'])
+        g.nodes[node.name] = identity
+        folded += 1
+    return g.to_graph_def(graph_def), folded, skipped
+
+
+def remove_dead_branches(graph_def):
+    ''' Replace the conds on constant predicates by their live branch.
+
+    The non live output of a Switch with a constant predicate is dead, so
+    are the nodes with a dead data input; a Merge is dead when all its
+    inputs are. Live Switch and Merge nodes become Identity nodes.
+    Output:
+        graph_def: new GraphDef
+        removed: number of removed nodes
+    '''
+    g = GraphNodes(graph_def)
+    live_port = {}
+    for node in g.nodes.values():
+        if node.op == 'Switch':
+            pred = g.const_value(node.input[1])
+            if pred is not None:
+                live_port[node.name] = 1 if bool(pred) else 0
+    if not live_port:
+        return graph_def, 0
+
+    def is_dead_input(inp):
+        name = node_name(inp)
+        if inp.startswith('^'):
+            return name in dead
+        if name in live_port:
+            return output_index(inp) != live_port[name]
+        return name in dead
+
+    dead = set()
+    changed = True
+    while changed:
+        changed = False
+        for node in g.nodes.values():
+            if node.name in dead:
+                continue
+            inputs = list(node.input)
+            if node.op == 'Merge':
+                data = [inp for inp in inputs if not inp.startswith('^')]
+                is_dead = all(is_dead_input(inp) for inp in data)
+            else:
+                is_dead = any(is_dead_input(inp) for inp in inputs)
+            if is_dead:
+                dead.add(node.name)
+                changed = True
+
+    for name in dead:
+        del g.nodes[name]
+    for node in g.nodes.values():
+        if node.op == 'Switch' and node.name in live_port:
+            data = node.input[0]
+            node.op = 'Identity'
+            del node.input[:]
+            node.input.append(data)
+            for key in list(node.attr.keys()):
+                if key != 'T':
+                    del node.attr[key]
+        elif node.op == 'Merge':
+            data = [inp for inp in node.input if not inp.startswith('^') and not is_dead_input(inp)]
+            if len(data) == 1:
+                node.op = 'Identity'
+                del node.input[:]
+                node.input.append(data[0])
+                for key in list(node.attr.keys()):
+                    if key != 'T':
+                        del node.attr[key]
+        # The live output of a Switch is now output 0 of the Identity
+        inputs = [inp for inp in node.input if not (inp.startswith('^') and node_name(inp) in dead)]
+        inputs = [node_name(inp) if node_name(inp) in live_port and not inp.startswith('^') else inp
+                  for inp in inputs]
+        del node.input[:]
+        node.input.extend(inputs)
+    return g.to_graph_def(graph_def), len(dead)
+
+
+def strip_identities(graph_def, keep=()):
+    ''' Bypass the Identity nodes, except the ones named in keep.
+    Output:
+        graph_def: new GraphDef
+        removed: number of removed nodes
+    '''
+    g = GraphNodes(graph_def)
+    removed = [n.name for n in g.nodes.values() if n.op == 'Identity' and n.name not in keep
+               and not any(inp.startswith('^') for inp in n.input)]
+    source = {}
+    for name in removed:
+        source[name] = g.nodes[name].input[0]
+
+    def resolve(inp):
+        while node_name(inp) in source and not inp.startswith('^'):
+            inp = source[node_name(inp)]
+        return inp
+
+    for name in removed:
+        del g.nodes[name]
+    for node in g.nodes.values():
+        inputs = []
+        for inp in node.input:
+            if inp.startswith('^'):
+                name = node_name(inp)
+                while name in source:
+                    name = node_name(source[name])
+                inp = '^' + name
+                if inp in inputs:
+                    continue
+            else:
+                inp = resolve(inp)
+            inputs.append(inp)
+        del node.input[:]
+        node.input.extend(inputs)
+    return g.to_graph_def(graph_def), len(removed)
+
+
+def optimize(graph_def, log_fn=print, fold_all=False):
+    ''' All the passes, followed by the removal of the unused nodes.
+    With fold_all, a batch norm that cannot be folded is an error (every
+    batch norm of the exported v1 and v2 models follows a layer). '''
+    num_nodes = len(graph_def.node)
+    graph_def, removed = remove_dead_branches(graph_def)
+    log_fn('dead cond branches: %d nodes removed' % removed)
+    graph_def, folded, skipped = fold_batch_norms(graph_def)
+    log_fn('batch norms: %d folded, %d not foldable' % (folded, skipped))
+    if fold_all and skipped > 0:
+        raise ValueError('%d batch norms could not be folded' % skipped)
+    graph_def, removed = strip_identities(graph_def, keep=OUTPUT_NAMES)
+    log_fn('identities: %d removed' % removed)
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, OUTPUT_NAMES)
+    log_fn('nodes: %d -> %d' % (num_nodes, len(graph_def.node)))
+    return graph_def
+
+
+def op_counts(graph_def):
+    return collections.Counter(n.op for n in graph_def.node)
+
+
+def graph_session(graph_def, seed=None):
+    ''' Session on a GraphDef. With seed, the random ops are seeded, so that
+    two graphs draw the same masked points. '''
+    if seed is not None:
+        graph_def_copy = tf.GraphDef()
+        graph_def_copy.CopyFrom(graph_def)
+        for node in graph_def_copy.node:
+            if 'seed' in node.attr and 'seed2' in node.attr:
+                node.attr['seed'].i = seed
+                node.attr['seed2'].i = seed
+        graph_def = graph_def_copy
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    sess = tf.Session(graph=graph)
+    inputs = [graph.get_tensor_by_name(n + ':0') for n in INPUT_NAMES]
+    outputs = [graph.get_tensor_by_name(n + ':0') for n in OUTPUT_NAMES]
+    return sess, inputs, outputs
+
+
+def random_inputs(graph_def, batch_size, seed=0):
+    ''' Random frustums and one hot vectors fitting the graph inputs. '''
+    shapes = {}
+    for node in graph_def.node:
+        if node.name in INPUT_NAMES:
+            shapes[node.name] = [d.size for d in node.attr['shape'].shape.dim]
+    num_point = shapes['pointclouds'][1]
+    if shapes['pointclouds'][0] > 0:
+        batch_size = shapes['pointclouds'][0]
+    rng = np.random.RandomState(seed)
+    pc = rng.randn(batch_size, num_point, 4).astype(np.float32)
+    one_hot = np.zeros((batch_size, 3), dtype=np.float32)
+    one_hot[np.arange(batch_size), rng.randint(0, 3, batch_size)] = 1
+    return [pc, one_hot]
+
+
+def check_equivalence(original, optimized, batch_size, rtol=1e-3, atol=1e-4, log_fn=print):
+    ''' Run both graphs on the same inputs and compare the outputs.
+    Output:
+        ok: bool, all outputs are close
+    '''
+    values = random_inputs(original, batch_size)
+    results = []
+    for graph_def in [original, optimized]:
+        sess, inputs, outputs = graph_session(graph_def, seed=1)
+        results.append(sess.run(outputs, feed_dict=dict(zip(inputs, values))))
+        sess.close()
+    ok = True
+    for name, a, b in zip(OUTPUT_NAMES, results[0], results[1]):
+        finite = np.isfinite(a) & np.isfinite(b)
+        close = np.allclose(a[finite], b[finite], rtol=rtol, atol=atol) and \
+            np.array_equal(np.isfinite(a), np.isfinite(b))
+        diff = np.max(np.abs(a[finite] - b[finite])) if np.any(finite) else 0.0
+        log_fn('%-18s max abs diff %.3g %s' % (name, diff, 'ok' if close else 'MISMATCH'))
+        ok = ok and close
+    return ok
+
+
+def benchmark_graphs(graph_defs, num_calls, batch_size, log_fn=print):
+    ''' Latency of each (name, GraphDef) on the same random inputs. '''
+    results = {}
+    for name, graph_def in graph_defs:
+        values = random_inputs(graph_def, batch_size)
+        sess, inputs, outputs = graph_session(graph_def)
+        feed_dict = dict(zip(inputs, values))
+        sess.run(outputs, feed_dict=feed_dict)
+        times = []
+        for _ in range(num_calls):
+            start = time.time()
+            sess.run(outputs, feed_dict=feed_dict)
+            times.append(time.time() - start)
+        sess.close()
+        results[name] = profile_util.summarize_times(times)
+        log_fn('%-10s p50 %8.2f ms  p99 %8.2f ms' % (name, results[name]['p50'] * 1000,
+                                                     results[name]['p99'] * 1000))
+    return results
+
+
+def load_graph_def(path):
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+def main():
+    original = load_graph_def(FLAGS.input)
+    optimized = optimize(original, fold_all=FLAGS.check)
+    before, after = op_counts(original), op_counts(optimized)
+    for op in sorted(set(before) | set(after)):
+        if before[op] != after[op]:
+            print('%-20s %5d -> %5d' % (op, before[op], after[op]))
+    output_dir = os.path.dirname(os.path.abspath(FLAGS.output))
+    tf.train.write_graph(optimized, output_dir, os.path.basename(FLAGS.output), as_text=False)
+    print('Written to %s' % FLAGS.output)
+    if FLAGS.check and not check_equivalence(original, optimized, FLAGS.batch_size):
+        print('The optimized graph does not match the original one')
+        sys.exit(1)
+    if FLAGS.benchmark > 0:
+        benchmark_graphs([('original', original), ('optimized', optimized)],
+                         FLAGS.benchmark, FLAGS.batch_size)
+
+
+if __name__ == '__main__':
+    FLAGS = parser.parse_args()
+    main()
@@ -0,0 +1,575 @@
+''' Timing and memory helpers shared by the benchmarks and the
+training/evaluation instrumentation.
+
+Results are plain dicts so they can be dumped to JSON and compared
+between runs.
+'''
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import platform
+import collections
+import numpy as np
+
+try:
+    import tracemalloc  # Python 3.4+
+except ImportError:
+    tracemalloc = None
+
+
+def summarize_times(times):
+    ''' Summary statistics of a list of durations.
+
+    Input:
+        times: list of float, durations in seconds
+    Output:
+        summary: dict with count, total, mean, std, min, max, p50, p90, p99
+    '''
+    times = np.asarray(times, dtype=np.float64)
+    if times.size == 0:
+        return {'count': 0}
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    return {'count': int(times.size),
+            'total': float(np.sum(times)),
+            'mean': float(np.mean(times)),
+            'std': float(np.std(times)),
+            'min': float(np.min(times)),
+            'max': float(np.max(times)),
+            'p50': float(p50),
+            'p90': float(p90),
+            'p99': float(p99)}
+
+
+def peak_rss_bytes():
+    ''' Peak resident set size of the current process in bytes. '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(fn, repeats=5, warmup=1, items=1, trace_memory=True):
+    ''' Time a callable and record its peak Python heap usage.
+
+    Input:
+        fn: callable without arguments, one call is one timed run
+        repeats: int, number of timed runs
+        warmup: int, number of untimed runs before timing
+        items: int, number of items processed by one call of fn,
+            used to report throughput
+        trace_memory: bool, if True do one extra untimed run under
+            tracemalloc to get the peak allocation of a single call
+    Output:
+        result: dict with 'time' (see summarize_times), 'items',
+            'items_per_sec' and 'peak_mem_bytes'
+    '''
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    summary = summarize_times(times)
+    result = {'time': summary,
+              'items': items,
+              'items_per_sec': items / summary['mean'] if summary['mean'] > 0 else None,
+              'peak_mem_bytes': None}
+
+    # Memory is traced in a separate run, tracemalloc slows down allocation
+    if trace_memory and tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        try:
+            fn()
+            result['peak_mem_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def environment_info():
+    ''' Describe the machine so results from different hosts are not mixed up. '''
+    info = {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+            'numpy': np.__version__,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    return info
+
+
+def write_results(path, results, config=None):
+    ''' Dump benchmark results to a JSON file.
+
+    Input:
+        path: string, output file
+        results: dict mapping stage name to the dict returned by measure
+        config: dict, parameters of the run (frame count, points, ...)
+    '''
+    out = {'env': environment_info(),
+           'config': config or {},
+           'results': results}
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(path, 'w') as f:
+        json.dump(out, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def compare_results(baseline, current, stat='p50', tolerance=0.1):
+    ''' Compare two result files written by write_results.
+
+    Input:
+        baseline, current: dicts as written by write_results
+        stat: string, timing statistic to compare
+        tolerance: float, relative slowdown that counts as a regression
+    Output:
+        rows: list of (stage, baseline_value, current_value, ratio, regressed)
+            for the stages present in both runs
+    '''
+    rows = []
+    base_res = baseline['results']
+    cur_res = current['results']
+    for stage in sorted(cur_res):
+        if stage not in base_res:
+            continue
+        base_t = base_res[stage].get('time', {}).get(stat)
+        cur_t = cur_res[stage].get('time', {}).get(stat)
+        if not base_t or cur_t is None:
+            continue
+        ratio = cur_t / base_t
+        rows.append((stage, base_t, cur_t, ratio, ratio > 1.0 + tolerance))
+    return rows
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = None
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, *args):
+        self.timer.add(self.name, time.time() - self.start)
+        return False
+
+
+class StepTimer(object):
+    ''' Wall time breakdown of the steps of a training loop.
+
+    Phases are timed with `with timer.phase('get_batch'): ...` between
+    start_step() and end_step(). Functions running inside a phase, such as
+    the tf.py_func metrics running inside sess.run, can be timed with
+    timer.wrap(name, fn); their time is part of the enclosing phase.
+    Statistics are computed over the last `window` steps.
+
+    When disabled every method returns immediately, so the timer can stay
+    in the loop at negligible cost.
+    '''
+    def __init__(self, enabled=True, window=100):
+        self.enabled = enabled
+        self.window = window
+        self.phase_times = collections.OrderedDict()
+        self.step_times = collections.deque(maxlen=window)
+        self.step_samples = collections.deque(maxlen=window)
+        self._phases = {}
+        self._step_start = None
+        self._in_step = False
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        if name not in self._phases:
+            self._phases[name] = _Phase(self, name)
+            self.phase_times[name] = collections.deque(maxlen=self.window)
+        return self._phases[name]
+
+    def add(self, name, seconds):
+        ''' Record time for a phase, ignored outside of a step (e.g. the
+        py_func metrics also run during evaluation). '''
+        if not self._in_step:
+            return
+        if name not in self.phase_times:
+            self.phase_times[name] = collections.deque(maxlen=self.window)
+        self.phase_times[name].append(seconds)
+
+    def wrap(self, name, fn):
+        if not self.enabled:
+            return fn
+        def timed_fn(*args):
+            start = time.time()
+            out = fn(*args)
+            self.add(name, time.time() - start)
+            return out
+        return timed_fn
+
+    def start_step(self):
+        if not self.enabled:
+            return
+        self._in_step = True
+        self._step_start = time.time()
+
+    def end_step(self, num_samples):
+        if not self.enabled:
+            return
+        self.step_times.append(time.time() - self._step_start)
+        self.step_samples.append(num_samples)
+        self._in_step = False
+
+    def stats(self):
+        ''' Output: dict with 'step' and per phase time summaries (see
+        summarize_times), 'samples_per_sec' and 'data_wait_fraction'
+        (share of the step time spent assembling batches). '''
+        out = {'step': summarize_times(list(self.step_times)), 'phases': {}}
+        for name, times in self.phase_times.items():
+            out['phases'][name] = summarize_times(list(times))
+        total_time = float(np.sum(self.step_times)) if self.step_times else 0.0
+        out['samples_per_sec'] = np.sum(self.step_samples) / total_time if total_time > 0 else 0.0
+        data_time = out['phases'].get('get_batch', {}).get('total', 0.0)
+        out['data_wait_fraction'] = data_time / total_time if total_time > 0 else 0.0
+        return out
+
+    def summary_lines(self):
+        stats = self.stats()
+        lines = ['step time: mean %.1f ms, p50 %.1f ms, p90 %.1f ms, %.1f samples/sec, data wait %.1f%%' % \
+            (stats['step'].get('mean', 0)*1000, stats['step'].get('p50', 0)*1000,
+             stats['step'].get('p90', 0)*1000, stats['samples_per_sec'],
+             stats['data_wait_fraction']*100)]
+        for name, summary in stats['phases'].items():
+            if summary['count'] == 0:
+                continue
+            lines.append('  %s: mean %.1f ms, p50 %.1f ms, p90 %.1f ms' % \
+                (name, summary['mean']*1000, summary['p50']*1000, summary['p90']*1000))
+        return lines
+
+    def tf_summary(self, prefix='timing'):
+        ''' The statistics as a tf.Summary protobuf for a FileWriter. '''
+        import tensorflow as tf
+        stats = self.stats()
+        values = [tf.Summary.Value(tag=prefix + '/samples_per_sec', simple_value=stats['samples_per_sec']),
+                  tf.Summary.Value(tag=prefix + '/data_wait_fraction', simple_value=stats['data_wait_fraction'])]
+        for name, summary in [('step', stats['step'])] + list(stats['phases'].items()):
+            if summary['count'] == 0:
+                continue
+            for key in ['mean', 'p50', 'p90']:
+                values.append(tf.Summary.Value(tag='%s/%s_%s_ms' % (prefix, name, key),
+                                               simple_value=summary[key]*1000))
+        return tf.Summary(value=values)
+
+
+# Op types of the custom ops in models/tf_ops (pointnet++ layers of v2)
+CUSTOM_OP_TYPES = set(['FarthestPointSample', 'GatherPoint', 'GatherPointGrad',
+                       'GroupPoint', 'GroupPointGrad', 'ProbSample', 'QueryBallPoint',
+                       'SelectionSort', 'ThreeInterpolate', 'ThreeInterpolateGrad', 'ThreeNN'])
+
+
+def parse_step_window(value):
+    ''' Parse a 'start:end' step window (end exclusive), None if empty. '''
+    if not value:
+        return None
+    start, end = value.split(':')
+    return int(start), int(end)
+
+
+def op_category(op_type, node_name):
+    ''' Coarse category of a traced op, used to group the trace summary. '''
+    if op_type in ('PyFunc', 'PyFuncStateless', 'EagerPyFunc'):
+        return 'py_func'
+    if op_type in CUSTOM_OP_TYPES:
+        return 'custom_op'
+    if op_type.startswith('Conv2D') or op_type.startswith('Conv1D'):
+        return 'conv'
+    if 'BatchNorm' in op_type or '/bn/' in node_name:
+        return 'batch_norm'
+    if op_type.startswith('MatMul'):
+        return 'matmul'
+    return 'other'
+
+
+class TraceCapture(object):
+    ''' Capture full TF traces (RunMetadata) of a window of session steps.
+
+    Usage:
+        tracer = TraceCapture(parse_step_window('10:13'), trace_dir)
+        run_kwargs = tracer.begin_step()
+        sess.run(fetches, feed_dict=feed_dict, **run_kwargs)
+        tracer.end_step(writer)
+
+    Steps are counted by begin_step() calls. For every traced step a Chrome
+    trace (chrome://tracing) is written to output_dir, the run metadata is
+    added to the summary writer, and op time/memory is accumulated. Once
+    the window is over, summary_lines() reports the top ops by time and by
+    memory, grouped by op type, name scope and category (custom ops,
+    py_func, conv, ...). Outside of the window begin_step() returns no
+    run arguments, so untraced steps run as usual.
+    '''
+    def __init__(self, window, output_dir, prefix='step', top_k=15):
+        self.window = window
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.top_k = top_k
+        self.step = -1
+        self.traced_steps = 0
+        self.op_stats = {}
+        self._run_metadata = None
+
+    @property
+    def enabled(self):
+        return self.window is not None
+
+    def active(self):
+        return self.enabled and self.window[0] <= self.step < self.window[1]
+
+    def finished(self):
+        ''' True right after the last step of the window was traced. '''
+        return self.enabled and self.step == self.window[1] - 1 and self.traced_steps > 0
+
+    def begin_step(self):
+        self.step += 1
+        if not self.active():
+            self._run_metadata = None
+            return {}
+        import tensorflow as tf
+        self._run_metadata = tf.RunMetadata()
+        return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                'run_metadata': self._run_metadata}
+
+    def end_step(self, writer=None, global_step=None):
+        if self._run_metadata is None:
+            return
+        from tensorflow.python.client import timeline
+        run_metadata = self._run_metadata
+        self._run_metadata = None
+        self.traced_steps += 1
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        trace = timeline.Timeline(run_metadata.step_stats)
+        path = os.path.join(self.output_dir, 'timeline_%s_%d.json' % (self.prefix, self.step))
+        with open(path, 'w') as f:
+            f.write(trace.generate_chrome_trace_format(show_memory=True))
+        if writer is not None:
+            writer.add_run_metadata(run_metadata, '%s_%d' % (self.prefix, self.step),
+                                    global_step)
+        self._accumulate(run_metadata.step_stats)
+
+    def _accumulate(self, step_stats):
+        for dev_stats in step_stats.dev_stats:
+            # GPU kernels are reported both per stream and in stream:all
+            if dev_stats.device.endswith('stream:all'):
+                continue
+            for node in dev_stats.node_stats:
+                # timeline_label looks like 'name = OpType(inputs)'
+                label = node.timeline_label
+                if ' = ' in label:
+                    op_type = label.split(' = ', 1)[1].split('(', 1)[0]
+                else:
+                    op_type = node.node_name.split(':')[0]
+                name = node.node_name.split(':')[0]
+                mem = 0
+                for output in node.output:
+                    mem += output.tensor_description.allocation_description.requested_bytes
+                key = (name, op_type)
+                if key not in self.op_stats:
+                    self.op_stats[key] = [0, 0, 0]
+                stats = self.op_stats[key]
+                stats[0] += node.all_end_rel_micros
+                stats[1] = max(stats[1], mem)
+                stats[2] += 1
+
+    def grouped(self, by):
+        ''' Total time (us), max output bytes and op count grouped by
+        'op', 'type', 'scope' or 'category'. '''
+        groups = {}
+        for (name, op_type), (micros, mem, count) in self.op_stats.items():
+            if by == 'op':
+                key = name
+            elif by == 'type':
+                key = op_type
+            elif by == 'scope':
+                key = name.rsplit('/', 1)[0] if '/' in name else name
+            else:
+                key = op_category(op_type, name)
+            if key not in groups:
+                groups[key] = [0, 0, 0]
+            groups[key][0] += micros
+            groups[key][1] += mem
+            groups[key][2] += count
+        return groups
+
+    def summary_lines(self):
+        if not self.op_stats:
+            return ['trace: no steps traced']
+        total = float(sum(v[0] for v in self.op_stats.values())) or 1.0
+        lines = ['trace: %d steps traced, timelines in %s' % (self.traced_steps, self.output_dir)]
+        for by in ['category', 'type', 'scope', 'op']:
+            groups = self.grouped(by)
+            lines.append('top %s by time (ms per step, share, output bytes):' % by)
+            for key, (micros, mem, count) in sorted(groups.items(), key=lambda x: -x[1][0])[:self.top_k]:
+                lines.append('  %-60s %9.3f %5.1f%% %10s' % (key, micros / 1000.0 / self.traced_steps,
+                                                           100.0 * micros / total, format_bytes(mem)))
+        lines.append('top op by output memory:')
+        for (name, op_type), (micros, mem, count) in sorted(self.op_stats.items(), key=lambda x: -x[1][1])[:self.top_k]:
+            lines.append('  %-60s %-20s %10s' % (name, op_type, format_bytes(mem)))
+        return lines
+
+
+def current_rss_bytes():
+    ''' Current resident set size of the process in bytes (Linux only). '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def deep_nbytes(obj, seen=None):
+    ''' Approximate memory held by nested lists/tuples/dicts of numpy
+    arrays and python scalars. Objects referenced twice count once. '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        # getsizeof includes the data of arrays owning it, views count
+        # the array they point into
+        size = sys.getsizeof(obj)
+        if isinstance(obj.base, np.ndarray):
+            size += deep_nbytes(obj.base, seen)
+        if obj.dtype == object:
+            size += sum(deep_nbytes(x, seen) for x in obj.flat)
+        return size
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_nbytes(k, seen) + deep_nbytes(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_nbytes(x, seen) for x in obj)
+    elif hasattr(obj, 'deep_nbytes_fields'):
+        # list-like classes, e.g. provider.FrustumViews
+        size += sum(deep_nbytes(getattr(obj, f), seen) for f in obj.deep_nbytes_fields)
+    return size
+
+
+def dataset_memory(dataset):
+    ''' Bytes held by each list/array attribute of a dataset object.
+
+    Output:
+        fields: list of (attribute name, bytes), largest first
+    '''
+    fields = []
+    seen = set()
+    for name, value in sorted(vars(dataset).items()):
+        if isinstance(value, (list, tuple, dict, np.ndarray)) or hasattr(value, 'deep_nbytes_fields'):
+            fields.append((name, deep_nbytes(value, seen)))
+    return sorted(fields, key=lambda x: -x[1])
+
+
+class _MemoryStage(object):
+    def __init__(self, tracker, name):
+        self.tracker = tracker
+        self.name = name
+    def __enter__(self):
+        self.rss_start = current_rss_bytes()
+        self.tracing = self.tracker.trace and tracemalloc is not None
+        if self.tracing:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            tracemalloc.start()
+        return self
+    def __exit__(self, *args):
+        stage = {'rss_start': self.rss_start,
+                 'rss_end': current_rss_bytes(),
+                 'peak_rss': peak_rss_bytes()}
+        if self.tracing:
+            snapshot = tracemalloc.take_snapshot()
+            stage['py_peak'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            stage['top'] = [(str(stat.traceback), stat.size, stat.count)
+                            for stat in snapshot.statistics('lineno')[:self.tracker.top_k]]
+        self.tracker.stages[self.name] = stage
+        return False
+
+
+class MemoryTracker(object):
+    ''' Memory accounting of named stages and objects.
+
+    Stages (`with tracker.stage('build val'): ...`) record the RSS before
+    and after and the process peak RSS, and with trace=True the peak python
+    heap and the top allocating source lines (tracemalloc, slow).
+    Datasets and buffers registered with add_dataset/add_buffers are
+    reported per field. When disabled, stages are no-ops.
+    '''
+    def __init__(self, enabled=True, trace=False, top_k=10):
+        self.enabled = enabled
+        self.trace = trace
+        self.top_k = top_k
+        self.stages = collections.OrderedDict()
+        self.objects = collections.OrderedDict()
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return _MemoryStage(self, name)
+
+    def add_dataset(self, name, dataset):
+        if self.enabled:
+            self.objects[name] = dataset_memory(dataset)
+
+    def add_buffers(self, name, buffers):
+        ''' buffers: dict mapping buffer name to a list/array '''
+        if self.enabled:
+            seen = set()
+            fields = [(k, deep_nbytes(v, seen)) for k, v in buffers.items()]
+            self.objects[name] = sorted(fields, key=lambda x: -x[1])
+
+    def report_lines(self):
+        lines = ['memory: rss %s, peak rss %s' % (format_bytes(current_rss_bytes()),
+                                                  format_bytes(peak_rss_bytes()))]
+        for name, stage in self.stages.items():
+            delta = None
+            if stage['rss_start'] is not None and stage['rss_end'] is not None:
+                delta = stage['rss_end'] - stage['rss_start']
+            line = '  stage %-30s rss %10s -> %10s, peak rss %10s' % (name, format_bytes(delta),
+                format_bytes(stage['rss_end']), format_bytes(stage['peak_rss']))
+            if 'py_peak' in stage:
+                line += ', python heap peak %s' % format_bytes(stage['py_peak'])
+            lines.append(line)
+            for where, size, count in stage.get('top', []):
+                lines.append('    %10s %8d blocks  %s' % (format_bytes(size), count, where))
+        for name, fields in self.objects.items():
+            lines.append('  %s: %s total' % (name, format_bytes(sum(f[1] for f in fields))))
+            for field, size in fields:
+                lines.append('    %-25s %10s' % (field, format_bytes(size)))
+        return lines
+
+
+def format_bytes(num_bytes):
+    if num_bytes is None:
+        return 'n/a'
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(num_bytes) < 1024.0:
+            return '%.1f%s' % (num_bytes, unit)
+        num_bytes /= 1024.0
+    return '%.1fTB' % num_bytes
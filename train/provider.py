@@ -8,6 +8,8 @@ from __future__ import print_function
 #import cPickle as pickle
 import sys
 import os
+import copy
+import itertools
 import numpy as np
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.dirname(BASE_DIR)
@@ -28,7 +30,8 @@ except NameError:
     raw_input = input  # Python 3
 
 from dataset import KittiDataset
-from collections import Counter
+from frame_cache import FRAME_CACHE
+from collections import Counter, OrderedDict
 import kitti_utils
 
 def rotate_pc_along_y(pc, rot_angle):
@@ -136,18 +139,42 @@ def extract_pc_in_box2d(pc,pixels, box2d):
     box2d_corners[1,:] = [box2d[2],box2d[1]]
     box2d_corners[2,:] = [box2d[2],box2d[3]]
     box2d_corners[3,:] = [box2d[0],box2d[3]]
-    print("box2d_corners",box2d_corners)
     box2d_roi_inds = in_hull(pixels, box2d_corners)
     #box2D_mask= np.zeros((pc.shape[0]),dtype=np.float32)
     #box2D_mask[box2d_roi_inds]=1
     return pc[box2d_roi_inds], box2d_roi_inds
-def get_pixels(index,split):
-    if split=="val" or split=="train":
-        pixel_dir = "/root/frustum-pointnets_RSC/dataset/KITTI/object/training/pc_to_pixels/"
-    else:
-        pixel_dir = "/root/frustum-pointnets_RSC/dataset/KITTI_2/object/testing/pc_to_pixels/"
+def box2d_roi_mask(pixels, box2d, img_width=1280.0, img_height=720.0):
+    ''' Points whose image projection is inside a 2D box clipped to the image.
+    Vectorized version of the in_hull test of extract_pc_in_box2d, the box
+    is not modified.
+    Input:
+        pixels: numpy array (N,2), image projection of the points
+        box2d: (xmin,ymin,xmax,ymax)
+    Output:
+        mask: numpy array (N,) bool
+    '''
+    xmin, xmax = np.clip(sorted([box2d[0], box2d[2]]), 0.0, img_width)
+    ymin, ymax = np.clip([box2d[1], box2d[3]], 0.0, img_height)
+    return (pixels[:,0] >= xmin) & (pixels[:,0] <= xmax) & \
+        (pixels[:,1] >= ymin) & (pixels[:,1] <= ymax)
+
+def extract_pc_in_rect(pc, pixels, box2d):
+    ''' Fast extract_pc_in_box2d, see box2d_roi_mask. '''
+    mask = box2d_roi_mask(pixels, box2d)
+    return pc[mask], mask
+
+def get_pixels(index,split,pixel_dir=None):
+    ''' Load the image projection (N,2) of the lidar points of a frame,
+    through frame_cache.FRAME_CACHE. pixel_dir overrides the default
+    location of the split. '''
+    if pixel_dir is None:
+        if split=="val" or split=="train":
+            pixel_dir = "/root/frustum-pointnets_RSC/dataset/KITTI/object/training/pc_to_pixels/"
+        else:
+            pixel_dir = "/root/frustum-pointnets_RSC/dataset/KITTI_2/object/testing/pc_to_pixels/"
     pixel_file = os.path.join(pixel_dir, '%06d.txt' % index)
-    print(pixel_file)
+    return FRAME_CACHE.get((pixel_dir, split, index, 'pixels'), lambda: load_pixels(pixel_file))
+def load_pixels(pixel_file):
     assert os.path.exists(pixel_file)
     pixels = np.loadtxt(pixel_file,delimiter=",")
     return pixels
@@ -165,6 +192,37 @@ def random_shift_box2d(box2d, shift_ratio=0.2):
     h2 = h*(1+np.random.random()*2*r-r) # 0.9 to 1.1
     w2 = w*(1+np.random.random()*2*r-r) # 0.9 to 1.1
     return np.array([cx2-w2/2.0, cy2-h2/2.0, cx2+w2/2.0, cy2+h2/2.0])
+def frustum_center_mask(pixels, box2d, shift_ratio=0.2):
+    ''' Points that can be the point closest to the center_box2d (see
+    train_frustum) of a random_shift_box2d perturbation of box2d, the other
+    points of the frame can be dropped without changing the frustum angles.
+    The centers are in a rectangle R; the distance of a center to its
+    closest point varies at most as much as the center, so the closest
+    points are within (closest distance of a corner of R + half the
+    diagonal of R) of R.
+    Input:
+        pixels: numpy array (N,2), image projection of the points
+        box2d: (xmin,ymin,xmax,ymax)
+    Output:
+        mask: numpy array (N,) bool
+    '''
+    r = shift_ratio
+    xmin,ymin,xmax,ymax = box2d
+    h = ymax-ymin
+    w = xmax-xmin
+    cx = (xmin+xmax)/2.0
+    cy = (ymin+ymax)/2.0
+    # the center of a perturbation is (cx2, (cy2-h2/2 + cx2+w2/2)/2), linear
+    # in each of the perturbed values, its extremes are at their bounds
+    centers = np.array([[cx2, (cy2 - h2/2.0 + cx2 + w2/2.0) / 2.0] for cx2, cy2, h2, w2 in
+                        itertools.product([cx - w*r, cx + w*r], [cy - h*r, cy + h*r],
+                                          [h*(1-r), h*(1+r)], [w*(1-r), w*(1+r)])])
+    low, high = centers.min(axis=0), centers.max(axis=0)
+    corners = np.array([[low[0], low[1]], [low[0], high[1]], [high[0], low[1]], [high[0], high[1]]])
+    closest = max(np.min(np.linalg.norm(pixels - corner, axis=1)) for corner in corners)
+    bound = closest + np.linalg.norm(high - low) / 2.0
+    outside = np.maximum(np.maximum(low - pixels, pixels - high), 0.0)
+    return np.linalg.norm(outside, axis=1) <= bound
 def get_closest_pc_to_center(pc,pixels,center_box2d):
     idx = np.argmin(np.linalg.norm(pixels-center_box2d,axis=1))
     center3d = pc[idx,:]
@@ -184,58 +242,334 @@ def get_2Dboxes_detected(idx,res,split):
                 label = line.strip().split(' ')
                 label_=[]
                 for k in range(len(label)):
-                    print(label[k])
                     label_.append(int(label[k]))
                 labels.append(label_)
     return labels
 
+def train_frustum(pc_lidar, pixels, box2d, gt_obj_list, gt_corners):
+    ''' Frustum of a (perturbed) GT 2D box of a train frame, labelled with
+    the GT box with most points in it.
+    Output:
+        frustum: dict with pc, pc_ind (point mask in the frame), seg,
+            frustum_angle, corners, heading and size; None if the box is
+            lower than 25 pixels or has no foreground point
+    '''
+    frus_pc, frus_pc_ind = extract_pc_in_box2d(pc_lidar,pixels,box2d)
+    #get frus angle
+    center_box2d = np.array([(box2d[0]+box2d[2])/2.0, (box2d[1]+box2d[2])/2.0])
+    pc_center_frus = get_closest_pc_to_center(pc_lidar,pixels,center_box2d)
+    frustum_angle =  - np.arctan2(pc_center_frus[2],pc_center_frus[0])
+
+    cls_label = np.zeros((frus_pc.shape[0]), dtype=np.int32 )
+    for k in range(gt_corners.shape[0]):
+        box_corners = gt_corners[k]
+        fg_pt_flag = kitti_utils.in_hull(frus_pc[:, 0:3], box_corners)
+        cls_label[fg_pt_flag] = k+1
+    max = 0
+    corners_max = 0
+    for k in range(gt_corners.shape[0]):
+        count = np.count_nonzero(cls_label == k + 1)
+        if count > max:
+            max = count
+            corners_max = k
+    seg = np.where(cls_label == corners_max + 1, 1.0, 0.0)
+    if box2d[3] - box2d[1] < 25 or np.sum(seg) == 0:
+        return None
+    obj = gt_obj_list[corners_max]
+    return {'pc': frus_pc, 'pc_ind': frus_pc_ind, 'seg': seg, 'frustum_angle': frustum_angle,
+            'corners': gt_corners[corners_max], 'heading': obj.ry,
+            'size': np.array([obj.h, obj.w, obj.l])}
+
+def valid_detection_box(box2d):
+    ''' False for the 2D detections lower than 25 pixels or outside the image. '''
+    if (box2d[3] - box2d[1]) < 25 or ((box2d[3]>720 and box2d[1]>720)) or ((box2d[0]>1280 and box2d[2]>1280)) or ((box2d[3]<=0 and box2d[1]<=0)) or (box2d[0]<=0 and box2d[2]<=0) :
+        return False
+    return True
+
+def detection_frustum(pc_lidar, pixels, box2d, gt_boxes3d, gt_corners):
+    ''' Frustum of a 2D detection of a val/test frame, labelled with the GT
+    box with most points in it (if it has at least 20 of them).
+    Output:
+        frustum: dict with pc, pc_ind (point mask in the frame), seg,
+            frustum_angle, corners, heading, size and indice_box (1-based
+            row of the GT box, 0 if none); None if the frustum has less
+            than 20 points
+    '''
+    frus_pc, frus_pc_ind = extract_pc_in_box2d(pc_lidar, pixels, box2d)
+    # get frus angle
+    center_box2d = np.array([(box2d[0] + box2d[2]) / 2.0, (box2d[1] + box2d[2]) / 2.0])
+    pc_center_frus = get_closest_pc_to_center(pc_lidar, pixels, center_box2d)
+    frustum_angle = -1 * np.arctan2(pc_center_frus[2], pc_center_frus[0])
+
+    if len(frus_pc) < 20:
+        return None
+
+    cls_label = np.zeros((frus_pc.shape[0]), dtype=np.int32)
+    for k in range(gt_boxes3d.shape[0]):
+        box_corners = gt_corners[k]
+        fg_pt_flag = kitti_utils.in_hull(frus_pc[:, 0:3], box_corners)
+        cls_label[fg_pt_flag] = k + 1
+    if (np.count_nonzero(cls_label > 0) < 20):
+        center = np.ones((3))*(-10.0)
+        heading = 0.0
+        size = np.ones((3))
+        cls_label[cls_label > 0] = 0
+        seg=cls_label
+        rot_angle = 0.0
+        box3d_center = np.ones((3))*(-1.0)
+        box3d = np.array([[box3d_center[0],box3d_center[1],box3d_center[2],size[0],size[1],size[2],rot_angle]])
+        corners_empty =  kitti_utils.boxes3d_to_corners3d(box3d, transform=False)
+        bb_corners = corners_empty[0]
+        indice_box = 0
+    else :
+        max = 0
+        corners_max = 0
+        for k in range(gt_boxes3d.shape[0]):
+            count = np.count_nonzero(cls_label == k + 1)
+            if count > max:
+                max = count
+                corners_max = k
+        seg = np.where(cls_label==corners_max+1,1,0)
+        indice_box = corners_max+1
+        bb_corners = gt_corners[corners_max]
+        obj = gt_boxes3d[corners_max]
+        center = np.array([obj[0],obj[1],obj[2]])
+        size = np.array([obj[3],obj[4],obj[5]])
+        rot_angle = obj[6]
+    return {'pc': frus_pc, 'pc_ind': frus_pc_ind, 'seg': seg, 'frustum_angle': frustum_angle,
+            'corners': bb_corners, 'heading': rot_angle, 'size': size, 'indice_box': indice_box}
+
+def voxel_downsample(pc, voxel_size, labels=None, reduction='centroid'):
+    ''' Keep one point per occupied voxel of a point cloud.
+    The voxels are found by hashing the quantized coordinates of the points
+    (no python loop over the points).
+    Input:
+        pc: numpy array (N,C), XYZ in the first 3 channels
+        voxel_size: float, voxel edge length in meters
+        labels: optional numpy array (N,) of 0/1 segmentation labels
+        reduction: 'centroid' (mean of all channels over the points of the
+            voxel) or 'first' (first point of the voxel)
+    Output:
+        pc: numpy array (M,C), M <= N, one point per voxel, ordered by the
+            first point of each voxel
+        labels: numpy array (M,), majority label of the points of each voxel
+            (ties are foreground), None if no labels are given
+    '''
+    if len(pc) == 0:
+        return pc, labels
+    first, inverse, counts = voxel_groups(pc, voxel_size)
+    num_voxels = len(first)
+
+    if reduction == 'centroid':
+        out = np.empty((num_voxels, pc.shape[1]), dtype=pc.dtype)
+        for c in range(pc.shape[1]):
+            out[:, c] = np.bincount(inverse, weights=pc[:, c], minlength=num_voxels) / counts
+    elif reduction == 'first':
+        out = pc[first]
+    else:
+        raise ValueError('Unknown voxel reduction %s' % reduction)
+    if labels is not None:
+        labels = voxel_labels(labels, inverse, counts)
+    return out, labels
+
+def voxel_groups(pc, voxel_size):
+    ''' Occupied voxels of a (non empty) point cloud, see voxel_downsample.
+    Output:
+        first: numpy array (M,), index of the first point of each voxel,
+            increasing
+        inverse: numpy array (N,), voxel of each point
+        counts: numpy array (M,), number of points of each voxel
+    '''
+    coords = np.floor(pc[:, 0:3] / voxel_size).astype(np.int64)
+    coords -= coords.min(axis=0)
+    dims = coords.max(axis=0) + 1
+    keys = (coords[:, 0] * dims[1] + coords[:, 1]) * dims[2] + coords[:, 2]
+    _, first, inverse, counts = np.unique(keys, return_index=True,
+                                          return_inverse=True, return_counts=True)
+    # renumber the voxels in order of appearance
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    inverse = rank[inverse.reshape(-1)]
+    return first[order], inverse, counts[order]
+
+def voxel_labels(labels, inverse, counts):
+    ''' Majority 0/1 label of the points of each voxel of voxel_groups,
+    ties are foreground. '''
+    foreground = np.bincount(inverse, weights=labels, minlength=len(counts))
+    return (2 * foreground >= counts).astype(labels.dtype)
+
+def downsampling_stats(before, after, voxel_size, reduction):
+    ''' Effect of voxel_downsample on the frustums.
+    Input:
+        before, after: numpy arrays (N,), points per frustum
+    Output:
+        stats: dict with the mean and max number of points per frustum
+            before and after, and the ratio of the means
+    '''
+    stats = {'voxel_size': voxel_size, 'reduction': reduction,
+             'mean_points_before': float(np.mean(before)) if len(before) else 0.0,
+             'mean_points_after': float(np.mean(after)) if len(after) else 0.0,
+             'max_points_before': int(np.max(before)) if len(before) else 0,
+             'max_points_after': int(np.max(after)) if len(after) else 0}
+    stats['ratio'] = stats['mean_points_after'] / max(stats['mean_points_before'], 1e-6)
+    return stats
+
+def format_downsampling_stats(stats):
+    ''' One line summary of the downsampling_stats dict, for the logs. '''
+    return 'voxel downsampling (%.3f m, %s): %.1f -> %.1f mean points per frustum (x%.3f), max %d -> %d' % (
+        stats['voxel_size'], stats['reduction'], stats['mean_points_before'],
+        stats['mean_points_after'], stats['ratio'], stats['max_points_before'],
+        stats['max_points_after'])
+
+class FrameBuffers(object):
+    ''' Point clouds of whole frames, stored once and shared by the frustums
+    (FrustumViews) extracted from them, e.g. the augmented copies of a train
+    object, or the 224 and 704 detections of a split built in one pass (see
+    FrustumDataset.for_resolutions). Each build has its own FrameBuffers,
+    held by its datasets (frame_buffers), so the frames are freed with them.
+    Frames are keyed by (lidar directory, frame id).
+    '''
+    def __init__(self):
+        self.frames = {}
+
+    def add(self, key, pc):
+        ''' Store the point cloud of a frame, unless the frame is already
+        stored. Output: the stored point cloud, to index into. '''
+        return self.frames.setdefault(key, pc)
+
+
+class FrustumViews(object):
+    ''' List of frustum point clouds stored as the indices of their points
+    in a frame of FrameBuffers; the points are gathered when an item is read.
+    Items assigned a point cloud keep it, see select to keep a view.
+    '''
+    # the shared frames are not counted in the memory of the dataset
+    deep_nbytes_fields = ('views',)
+
+    def __init__(self, buffers):
+        self.buffers = buffers
+        self.views = []
+
+    def append_view(self, key, indices):
+        self.views.append((key, np.asarray(indices, dtype=np.int32)))
+
+    def append(self, pc):
+        self.views.append(pc)
+
+    def num_points(self, index):
+        view = self.views[index]
+        return len(view[1]) if isinstance(view, tuple) else len(view)
+
+    def __len__(self):
+        return len(self.views)
+
+    def __getitem__(self, index):
+        view = self.views[index]
+        if isinstance(view, tuple):
+            return self.buffers.frames[view[0]][view[1]]
+        return view
+
+    def __setitem__(self, index, pc):
+        self.views[index] = pc
+
+    def select(self, index, rows):
+        ''' Keep the points `rows` of a view (e.g. the first point of each
+        voxel), still as indices into its frame. '''
+        key, indices = self.views[index]
+        self.views[index] = (key, indices[rows])
+
+
+class PackedLabels(object):
+    ''' List of 0/1 segmentation labels stored as bit masks (np.packbits),
+    unpacked with the dtype of the first appended labels when read. '''
+    deep_nbytes_fields = ('bits', 'sizes')
+
+    def __init__(self):
+        self.bits = []
+        self.sizes = []
+        self.dtype = None
+
+    def append(self, labels):
+        if self.dtype is None:
+            self.dtype = labels.dtype
+        self.bits.append(np.packbits(labels > 0))
+        self.sizes.append(len(labels))
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __getitem__(self, index):
+        return np.unpackbits(self.bits[index])[:self.sizes[index]].astype(self.dtype)
+
+    def __setitem__(self, index, labels):
+        self.bits[index] = np.packbits(labels > 0)
+        self.sizes[index] = len(labels)
+
+class GTStore(object):
+    ''' Ground truth 3D boxes of a split, read once and kept as flat arrays.
+
+    The objects of frame `id` are the rows slices[id] of corners, boxes3d,
+    centers, levels, distances, angle/size classes and residuals.
+    frame_ids keeps the order of the split file.
+    '''
+    def __init__(self, database, split, root_dir='/root/frustum-pointnets_RSC/dataset/'):
+        data = KittiDataset(root_dir=root_dir, dataset=database, mode='TRAIN', split=split)
+        self.frame_ids = np.array(data.sample_id_list, dtype=np.int64)
+        self.slices = {}
+        boxes_list = []
+        levels = []
+        start = 0
+        for frame_id in data.sample_id_list:
+            gt_obj_list = data.filtrate_objects(data.get_label(frame_id))
+            boxes_list.append(kitti_utils.objs_to_boxes3d(gt_obj_list))
+            levels.extend([obj.level for obj in gt_obj_list])
+            self.slices[frame_id] = slice(start, start + len(gt_obj_list))
+            start += len(gt_obj_list)
+
+        self.boxes3d = np.concatenate(boxes_list, 0) if boxes_list else np.zeros((0, 7), dtype=np.float32)
+        self.corners = kitti_utils.boxes3d_to_corners3d(self.boxes3d, transform=False)
+        self.centers = (self.corners[:, 0, :] + self.corners[:, 6, :]) / 2.0
+        self.levels = np.array(levels, dtype=np.int32)
+        self.distances = np.linalg.norm(self.boxes3d[:, 0:3], axis=1)
+        self.angle_class = np.zeros(len(self.boxes3d), dtype=np.int32)
+        self.angle_residual = np.zeros(len(self.boxes3d), dtype=np.float32)
+        self.size_class = np.zeros(len(self.boxes3d), dtype=np.int32)
+        self.size_residual = np.zeros((len(self.boxes3d), 3), dtype=np.float32)
+        for j in range(len(self.boxes3d)):
+            self.angle_class[j], self.angle_residual[j] = angle2class(self.boxes3d[j, 6], NUM_HEADING_BIN)
+            self.size_class[j], self.size_residual[j] = size2class(self.boxes3d[j, 3:6], "Pedestrian")
+
+    def num_objects(self, frame_id):
+        s = self.slices[frame_id]
+        return s.stop - s.start
+
+    def get_corners(self, frame_id):
+        ''' (N,8,3) GT corners of a frame, a view into the store. '''
+        return self.corners[self.slices[frame_id]]
+
+    def frames_up_to(self, indice):
+        ''' Ids of the frames with id <= indice, in split order. '''
+        return self.frame_ids[self.frame_ids < indice + 1]
+
+_GT_STORES = {}
+
+def get_gt_store(database, split):
+    ''' GTStore of a split, built on first use and cached. '''
+    key = (database, split)
+    if key not in _GT_STORES:
+        _GT_STORES[key] = GTStore(database, split)
+    return _GT_STORES[key]
+
 def load_GT_eval(indice,database,split):
     ''' Load GT value for the respective "split" dataset for evaluation purposes
+    Output:
+        corners_frame: list of (N,8,3) GT corners of the frames with id <= indice
+        id_list_new: list of the ids of these frames
     '''
-    data_val=KittiDataset( root_dir='/root/frustum-pointnets_RSC/dataset/', dataset=database, mode='TRAIN', split=split)
-    id_list = data_val.sample_id_list
-    obj_frame=[]
-    corners_frame=[]
-    size_class_frame=[]
-    size_residual_frame=[]
-    angle_class_frame=[]
-    angle_residual_frame=[]
-    center_frame=[]
-    id_list_new=[]
-    for i in range(len(id_list)):
-        if(id_list[i]<indice+1):
-            gt_obj_list = data_val.filtrate_objects(
-                data_val.get_label(id_list[i]))
-            #print("GT objs per frame", id_list[i],len(gt_obj_list))
-            gt_boxes3d = kitti_utils.objs_to_boxes3d(gt_obj_list)
-            gt_corners = kitti_utils.boxes3d_to_corners3d(gt_boxes3d, transform=False)
-            obj_frame.append(gt_obj_list)
-            corners_frame.append(gt_corners)
-            angle_class_list=[]
-            angle_residual_list=[]
-            size_class_list=[]
-            size_residual_list=[]
-            center_list=[]
-            for j in range(len(gt_obj_list)):
-
-                angle_class, angle_residual = angle2class(gt_boxes3d[j][6],
-                                                      NUM_HEADING_BIN)
-                angle_class_list.append(angle_class)
-                angle_residual_list.append(angle_residual)
-
-                size_class, size_residual = size2class(np.array([gt_boxes3d[j][3], gt_boxes3d[j][4], gt_boxes3d[j][5]]),
-                                                   "Pedestrian")
-                size_class_list.append(size_class)
-                size_residual_list.append(size_residual)
-
-                center_list.append( (gt_corners[j][0, :] + gt_corners[j][6, :]) / 2.0)
-            size_class_frame.append(size_class_list)
-            size_residual_frame.append(size_residual_list)
-            angle_class_frame.append(angle_class_list)
-            angle_residual_frame.append(angle_residual_list)
-            center_frame.append(center_list)
-            id_list_new.append(id_list[i])
-
+    gt_store = get_gt_store(database, split)
+    id_list_new = [int(frame_id) for frame_id in gt_store.frames_up_to(indice)]
+    corners_frame = [gt_store.get_corners(frame_id) for frame_id in id_list_new]
     return corners_frame,id_list_new
 
 class FrustumDataset(object):
@@ -245,7 +579,10 @@ class FrustumDataset(object):
     '''
     def __init__(self, npoints, database,  split, res,
                  random_flip=False, random_shift=False, rotate_to_center=False,
-                 overwritten_data_path=None, from_rgb_detection=False, one_hot=False):
+                 overwritten_data_path=None, from_rgb_detection=False, one_hot=False,
+                 voxel_size=None, voxel_reduction='centroid', lazy_augment=False,
+                 frame_views=False, extra_res=(), lazy_extract=False, memo_size=1024,
+                 frustums=None, root_dir='/root/frustum-pointnets_RSC/dataset/', pixel_dir=None):
         '''
         Input:
             npoints: int scalar, number of points for frustum point cloud.
@@ -260,21 +597,63 @@ class FrustumDataset(object):
             from_rgb_detection: bool, if True we assume we do not have
                 groundtruth, just return data elements.
             one_hot: bool, if True, return one hot vector
+            voxel_size: float, if set the frustum point clouds are
+                downsampled to one point per voxel of this size (in meters)
+                when the dataset is built, see voxel_downsample
+            voxel_reduction: 'centroid' or 'first', point kept per voxel
+            lazy_augment: bool, train split only. Instead of storing augmentX
+                perturbed frustums per object, keep the points of every frame
+                once and draw a new 2D box perturbation each time a frustum
+                is read, see load_train_frames
+            frame_views: bool, store the point cloud of every frame once in
+                self.frame_buffers (shared with the extra_res datasets) and
+                the frustums as indices into it (FrustumViews), with bit
+                packed labels (PackedLabels). Ignored with lazy_augment
+                and with centroid voxel downsampling (the 'first' points of
+                the voxels are kept as views).
+            extra_res: val/test only, other 2D detection resolutions to
+                extract in the same pass over the frames, the datasets are
+                in self.res_datasets (see for_resolutions)
+            lazy_extract: bool, only index the (frame, 2D box) pairs of the
+                frustums and their point counts at construction and extract
+                and label a frustum on its first read, see build_index and
+                load_entry. Ignored with lazy_augment and from_rgb_detection.
+            memo_size: int, lazy_extract only, number of extracted frustums
+                kept in memory (least recently read ones are dropped)
+            frustums: list of already extracted frustums, used instead of
+                the files of database/split, see from_frustums
+            root_dir: string, KittiDataset root of database
+            pixel_dir: string, directory of the point projections, if None
+                the default one of the split (see get_pixels)
         '''
-        self.dataset_kitti = KittiDataset(root_dir='/root/frustum-pointnets_RSC/dataset/',dataset=database, mode='TRAIN', split=split)
+        self.dataset_kitti = None
+        if frustums is None:
+            self.dataset_kitti = KittiDataset(root_dir=root_dir,dataset=database, mode='TRAIN', split=split)
+        self.pixel_dir = pixel_dir
         self.npoints = npoints
         self.random_flip = random_flip
         self.random_shift = random_shift
         self.rotate_to_center = rotate_to_center
         self.res_det = res
         self.one_hot = one_hot
+        self.frame_buffers = None
 
         if overwritten_data_path is None:
             overwritten_data_path = os.path.join(ROOT_DIR,
                 'kitti/frustum_carpedcyc_%s.pickle'%(split))
 
         self.from_rgb_detection = from_rgb_detection
-        if from_rgb_detection:
+        self.voxel_size = voxel_size
+        self.voxel_reduction = voxel_reduction
+        self.lazy_augment = lazy_augment and split == 'train' and not from_rgb_detection and frustums is None
+        # centroid downsampling makes new points, they cannot be views
+        frame_views = frame_views and not self.lazy_augment and \
+            not (voxel_size and voxel_reduction == 'centroid')
+        self.lazy_extract = lazy_extract and not self.lazy_augment and not from_rgb_detection and frustums is None
+        self.memo_size = memo_size
+        if frustums is not None:
+            self.load_frustums(frustums)
+        elif from_rgb_detection:
             with open(overwritten_data_path,'rb') as fp:
                 self.id_list = pickle.load(fp)
                 self.box2d_list = pickle.load(fp)
@@ -283,14 +662,29 @@ class FrustumDataset(object):
                 # frustum_angle is clockwise angle from positive x-axis
                 self.frustum_angle_list = pickle.load(fp) 
                 self.prob_list = pickle.load(fp)
+        elif self.lazy_augment:
+            self.load_train_frames(augment_x=5)
+        elif self.lazy_extract:
+            datasets = [self]
+            for res_det in (extra_res if split != 'train' else ()):
+                sibling = copy.copy(self)
+                sibling.res_det = res_det
+                datasets.append(sibling)
+            for dataset in datasets:
+                dataset.build_index(split, augment_x=5)
+            self.res_datasets = dict((dataset.res_det, dataset) for dataset in datasets)
+            for sibling in datasets[1:]:
+                sibling.finish_build(voxel_size, voxel_reduction)
         elif(split=='train'):
 
             self.id_list = self.dataset_kitti.sample_id_list
             self.idx_batch = self.id_list
             batch_list = []
             self.frustum_angle_list=[]
-            self.input_list=[]
-            self.label_list=[]
+            if frame_views:
+                self.frame_buffers = FrameBuffers()
+            self.input_list = FrustumViews(self.frame_buffers) if frame_views else []
+            self.label_list = PackedLabels() if frame_views else []
             self.box3d_list = []
             self.box2d_list = []
             self.type_list = []
@@ -301,149 +695,53 @@ class FrustumDataset(object):
             augmentX = 5
             for i in range(len(self.id_list)):
                 #load pc
-                print(self.id_list[i])
                 pc_lidar = self.dataset_kitti.get_lidar(self.id_list[i])
+                frame_key = (self.dataset_kitti.lidar_dir, self.id_list[i])
+                if frame_views:
+                    pc_lidar = self.frame_buffers.add(frame_key, pc_lidar)
                 #load_labels
                 gt_obj_list_2D = self.dataset_kitti.get_label_2D(self.id_list[i])
                 ps = pc_lidar
                 #load pixels
-                pixels = get_pixels(self.id_list[i],split)
+                pixels = get_pixels(self.id_list[i],split,self.pixel_dir)
+                #get label list
+                gt_obj_list=self.dataset_kitti.get_label(self.id_list[i])
+                gt_corners = kitti_utils.boxes3d_to_corners3d(kitti_utils.objs_to_boxes3d(gt_obj_list),
+                                                              transform=False)
                 for j in range(len(gt_obj_list_2D)):
                     for _ in range(augmentX):
                         # Augment data by box2d perturbation
                         if perturb_box2d:
                             box2d = random_shift_box2d(gt_obj_list_2D[j].box2d)
-                        frus_pc, frus_pc_ind = extract_pc_in_box2d(pc_lidar,pixels,box2d)
-                        #get frus angle
-                        center_box2d = np.array([(box2d[0]+box2d[2])/2.0, (box2d[1]+box2d[2])/2.0])
-                        pc_center_frus = get_closest_pc_to_center(pc_lidar,pixels,center_box2d)
-                        frustum_angle =  - np.arctan2(pc_center_frus[2],pc_center_frus[0])
-
-
-
-                        #get label list
-                        gt_obj_list=self.dataset_kitti.get_label(self.id_list[i])
-
-                        cls_label = np.zeros((frus_pc.shape[0]), dtype=np.int32 )
-                        gt_boxes3d = kitti_utils.objs_to_boxes3d(gt_obj_list)
-                        gt_corners = kitti_utils.boxes3d_to_corners3d(gt_boxes3d, transform=False)
-                        for k in range(gt_boxes3d.shape[0]):
-                            box_corners = gt_corners[k]
-                            fg_pt_flag = kitti_utils.in_hull(frus_pc[:, 0:3], box_corners)
-                            cls_label[fg_pt_flag] = k+1
-                        max = 0
-                        corners_max = 0
-                        for k in range(gt_boxes3d.shape[0]):
-                            count = np.count_nonzero(cls_label == k + 1)
-                            if count > max:
-                                max = count
-                                corners_max = k
-                        seg = np.where(cls_label == corners_max + 1, 1.0, 0.0)
-
-                        cls_label=seg
-                        print("train", np.count_nonzero(cls_label==1))
-                        if box2d[3] - box2d[1] < 25 or np.sum(cls_label) == 0:
+                        frustum = train_frustum(pc_lidar, pixels, box2d, gt_obj_list, gt_corners)
+                        if frustum is None:
                             continue
-                        self.input_list.append(frus_pc)
-                        self.frustum_angle_list.append(frustum_angle)
-                        self.label_list.append(cls_label)
-                        self.box3d_list.append(gt_corners[corners_max])
+                        if frame_views:
+                            self.input_list.append_view(frame_key, np.flatnonzero(frustum['pc_ind']))
+                        else:
+                            self.input_list.append(frustum['pc'])
+                        self.frustum_angle_list.append(frustum['frustum_angle'])
+                        self.label_list.append(frustum['seg'])
+                        self.box3d_list.append(frustum['corners'])
                         self.box2d_list.append(box2d)
                         self.type_list.append("Pedestrian")
-                        self.heading_list.append(gt_obj_list[corners_max].ry)
-                        self.size_list.append(np.array([gt_obj_list[corners_max].h, gt_obj_list[corners_max].w, gt_obj_list[corners_max].l]))
+                        self.heading_list.append(frustum['heading'])
+                        self.size_list.append(frustum['size'])
                         batch_list.append(self.id_list[i])
             self.id_list = batch_list
         elif(split=='val' or split=='test'):
+            datasets = [self]
+            for res_det in extra_res:
+                sibling = copy.copy(self)
+                sibling.res_det = res_det
+                datasets.append(sibling)
+            self.load_detection_frames(split, datasets, frame_views)
+            self.res_datasets = dict((dataset.res_det, dataset) for dataset in datasets)
+            for sibling in datasets[1:]:
+                sibling.finish_build(voxel_size, voxel_reduction)
 
-            self.indice_box = []
-            self.dataset_kitti.sample_id_list = self.dataset_kitti.sample_id_list
-            self.id_list = self.dataset_kitti.sample_id_list
-            self.idx_batch = self.id_list
-            batch_list = []
-            self.frustum_angle_list = []
-            self.input_list = []
-            self.label_list = []
-            self.box3d_list = []
-            self.box2d_list = []
-            self.type_list = []
-            self.heading_list = []
-            self.size_list = []
-            for i in range(len(self.id_list)):
-                pc_lidar = self.dataset_kitti.get_lidar(self.id_list[i])
-                gt_obj_list = self.dataset_kitti.get_label(self.id_list[i])
-                print(self.id_list[i])
-                #get val 2D boxes:
-                box2ds = get_2Dboxes_detected(self.id_list[i],self.res_det,split)
-                if box2ds == None:
-                    continue
-                print("number detection", len(box2ds))
-                pixels = get_pixels(self.id_list[i],split)
-                for j in range(len(box2ds)):
-                    box2d = box2ds[j]
-
-                    if (box2d[3] - box2d[1]) < 25 or ((box2d[3]>720 and box2d[1]>720)) or ((box2d[0]>1280 and box2d[2]>1280)) or ((box2d[3]<=0 and box2d[1]<=0)) or (box2d[0]<=0 and box2d[2]<=0) :
-                        continue
-                    print(box2d)
-                    print("box_height", box2d[3] - box2d[1])
-                    frus_pc, frus_pc_ind = extract_pc_in_box2d(pc_lidar, pixels, box2d)
-                    # get frus angle
-                    center_box2d = np.array([(box2d[0] + box2d[2]) / 2.0, (box2d[1] + box2d[2]) / 2.0])
-                    pc_center_frus = get_closest_pc_to_center(pc_lidar, pixels, center_box2d)
-                    frustum_angle = -1 * np.arctan2(pc_center_frus[2], pc_center_frus[0])
-
-                    if len(frus_pc) < 20:
-                        continue
+        self.finish_build(voxel_size, voxel_reduction)
 
-                    # get_labels
-                    gt_obj_list = self.dataset_kitti.filtrate_objects(self.dataset_kitti.get_label(self.id_list[i]))
-                    gt_boxes3d = kitti_utils.objs_to_boxes3d(gt_obj_list)
-                    # gt_boxes3d = gt_boxes3d[self.box_present[index] - 1].reshape(-1, 7)
-
-                    cls_label = np.zeros((frus_pc.shape[0]), dtype=np.int32)
-                    gt_corners = kitti_utils.boxes3d_to_corners3d(gt_boxes3d, transform=False)
-                    for k in range(gt_boxes3d.shape[0]):
-                        box_corners = gt_corners[k]
-                        fg_pt_flag = kitti_utils.in_hull(frus_pc[:, 0:3], box_corners)
-                        cls_label[fg_pt_flag] = k + 1
-                    if (np.count_nonzero(cls_label > 0) < 20):
-                        center = np.ones((3))*(-10.0)
-                        heading = 0.0
-                        size = np.ones((3))
-                        cls_label[cls_label > 0] = 0
-                        seg=cls_label
-                        rot_angle = 0.0
-                        box3d_center = np.ones((3))*(-1.0)
-                        box3d = np.array([[box3d_center[0],box3d_center[1],box3d_center[2],size[0],size[1],size[2],rot_angle]])
-                        corners_empty =  kitti_utils.boxes3d_to_corners3d(box3d, transform=False)
-                        bb_corners = corners_empty[0]
-                        self.indice_box.append(0)
-                    else :
-                        max = 0
-                        corners_max = 0
-                        for k in range(gt_boxes3d.shape[0]):
-                            count = np.count_nonzero(cls_label == k + 1)
-                            if count > max:
-                                max = count
-                                corners_max = k
-                        seg = np.where(cls_label==corners_max+1,1,0)
-                        self.indice_box.append(corners_max+1)
-                        bb_corners = gt_corners[corners_max]
-                        obj = gt_boxes3d[corners_max]
-                        center = np.array([obj[0],obj[1],obj[2]])
-                        size = np.array([obj[3],obj[4],obj[5]])
-                        rot_angle = obj[6]
-                    self.input_list.append(frus_pc)
-                    self.frustum_angle_list.append(frustum_angle)
-                    self.label_list.append(seg)
-                    self.box3d_list.append(bb_corners)
-                    self.box2d_list.append(box2d)
-                    self.type_list.append("Pedestrian")
-                    self.heading_list.append(rot_angle)
-                    self.size_list.append(size)
-                    batch_list.append(self.id_list[i])
-            self.id_list = batch_list
-            print("batch_list",batch_list)
 
 
 
@@ -455,12 +753,419 @@ class FrustumDataset(object):
 
 
 
+    @classmethod
+    def from_frustums(cls, npoints, frustums, **kwargs):
+        ''' Dataset of already extracted frustums (e.g. generated data),
+        without reading the KITTI files.
+        Input:
+            frustums: list of dicts with pc, seg, corners, heading, size,
+                frustum_angle and id (frame id), optionally box2d and
+                indice_box, as returned by train_frustum/detection_frustum
+            kwargs: other FrustumDataset options
+        '''
+        return cls(npoints, None, None, None, frustums=frustums, **kwargs)
+
+    def load_frustums(self, frustums):
+        self.id_list = [f['id'] for f in frustums]
+        self.input_list = [f['pc'] for f in frustums]
+        self.label_list = [f['seg'] for f in frustums]
+        self.frustum_angle_list = [f['frustum_angle'] for f in frustums]
+        self.box3d_list = [f['corners'] for f in frustums]
+        self.box2d_list = [f.get('box2d') for f in frustums]
+        self.heading_list = [f['heading'] for f in frustums]
+        self.size_list = [f['size'] for f in frustums]
+        self.indice_box = [f.get('indice_box', 0) for f in frustums]
+        self.type_list = ["Pedestrian"] * len(frustums)
+
+    @classmethod
+    def for_resolutions(cls, npoints, database, split, res_list, **kwargs):
+        ''' Datasets of the 2D detections of several resolutions of a val or
+        test split, built in a single pass over the frames.
+        Output:
+            datasets: list of FrustumDataset, in the order of res_list
+        '''
+        first = cls(npoints, database, split, res_list[0], extra_res=res_list[1:], **kwargs)
+        return [first.res_datasets[res] for res in res_list]
+
+    def load_detection_frames(self, split, datasets, frame_views):
+        ''' Frustums of the 2D detections of the val/test frames. Every frame
+        is read once for all the datasets, each with its own res_det. '''
+        buffers = FrameBuffers() if frame_views else None
+        for dataset in datasets:
+            dataset.frame_buffers = buffers
+            dataset.indice_box = []
+            dataset.idx_batch = self.dataset_kitti.sample_id_list
+            dataset.batch_list = []
+            dataset.frustum_angle_list = []
+            dataset.input_list = FrustumViews(buffers) if frame_views else []
+            dataset.label_list = PackedLabels() if frame_views else []
+            dataset.box3d_list = []
+            dataset.box2d_list = []
+            dataset.type_list = []
+            dataset.heading_list = []
+            dataset.size_list = []
+        for frame_id in self.dataset_kitti.sample_id_list:
+            #get val 2D boxes:
+            detections = [(dataset, get_2Dboxes_detected(frame_id, dataset.res_det, split))
+                          for dataset in datasets]
+            detections = [(dataset, box2ds) for dataset, box2ds in detections if box2ds is not None]
+            if not detections:
+                continue
+            pc_lidar = self.dataset_kitti.get_lidar(frame_id)
+            frame_key = (self.dataset_kitti.lidar_dir, frame_id)
+            if frame_views:
+                pc_lidar = buffers.add(frame_key, pc_lidar)
+            pixels = get_pixels(frame_id, split, self.pixel_dir)
+            # get_labels
+            gt_obj_list = self.dataset_kitti.filtrate_objects(self.dataset_kitti.get_label(frame_id))
+            gt_boxes3d = kitti_utils.objs_to_boxes3d(gt_obj_list)
+            gt_corners = kitti_utils.boxes3d_to_corners3d(gt_boxes3d, transform=False)
+            for dataset, box2ds in detections:
+                for j in range(len(box2ds)):
+                    box2d = box2ds[j]
+                    if not valid_detection_box(box2d):
+                        continue
+                    frustum = detection_frustum(pc_lidar, pixels, box2d, gt_boxes3d, gt_corners)
+                    if frustum is None:
+                        continue
+                    dataset.indice_box.append(frustum['indice_box'])
+                    if frame_views:
+                        dataset.input_list.append_view(frame_key, np.flatnonzero(frustum['pc_ind']))
+                    else:
+                        dataset.input_list.append(frustum['pc'])
+                    dataset.frustum_angle_list.append(frustum['frustum_angle'])
+                    dataset.label_list.append(frustum['seg'])
+                    dataset.box3d_list.append(frustum['corners'])
+                    dataset.box2d_list.append(box2d)
+                    dataset.type_list.append("Pedestrian")
+                    dataset.heading_list.append(frustum['heading'])
+                    dataset.size_list.append(frustum['size'])
+                    dataset.batch_list.append(frame_id)
+        for dataset in datasets:
+            dataset.id_list = dataset.batch_list
+            del dataset.batch_list
+
+    def finish_build(self, voxel_size, voxel_reduction):
+        ''' Voxel downsampling of the frustums once they are extracted. '''
+        self.voxel_stats = None
+        if self.lazy_extract:
+            # the frustums are downsampled by load_entry when extracted,
+            # the index only counts the points before downsampling
+            return
+        if voxel_size and self.lazy_augment:
+            # the drawn frustums are downsampled by extract_frustum
+            self.voxel_stats = downsampling_stats(np.array(self.raw_point_count_list),
+                self.get_point_counts(), voxel_size, voxel_reduction)
+        elif voxel_size:
+            self.voxel_stats = self.voxel_downsample(voxel_size, voxel_reduction)
 
     def __len__(self):
             return len(self.input_list)
 
     def __getitem__(self, index):
         ''' Get index-th element from the picked file dataset. '''
+        return self.get_item(index)
+
+    def get_point_counts(self):
+        ''' Number of points of each frustum before resampling (of the
+        unperturbed 2D box of the train entries with lazy_augment or
+        lazy_extract). The lazy_extract counts are those of build_index,
+        before voxel downsampling. '''
+        if self.lazy_augment or self.lazy_extract:
+            return np.array(self.point_count_list, dtype=np.int64)
+        if isinstance(self.input_list, FrustumViews):
+            return np.array([self.input_list.num_points(i) for i in range(len(self.input_list))],
+                            dtype=np.int64)
+        return np.array([len(pc) for pc in self.input_list], dtype=np.int64)
+
+    def load_train_frames(self, augment_x, shift_ratio=0.2):
+        ''' Lazy augmentation of the train split. The points of every frame
+        that a perturbed 2D box can reach (random_shift_box2d with
+        shift_ratio) are kept once in frame_store, with the index of the GT
+        box containing each point. Each object gets augment_x slots, like the
+        augmentX copies of the eager mode; the frustum of a slot is drawn by
+        draw_frustum when it is read and is not kept.
+        '''
+        self.frame_store = {}
+        self.id_list = []
+        self.gt_box2d_list = []
+        self.point_count_list = []
+        self.raw_point_count_list = []
+        self.frustum_angle_list = []
+        self.input_list = []
+        self.label_list = []
+        self.box3d_list = []
+        self.box2d_list = []
+        self.type_list = []
+        self.heading_list = []
+        self.size_list = []
+        # a perturbed box spans at most its center shift plus half its
+        # enlarged width from the center of the GT box
+        reach = shift_ratio + (1 + shift_ratio) / 2.0
+        for frame_id in self.dataset_kitti.sample_id_list:
+            pc_lidar = self.dataset_kitti.get_lidar(frame_id)
+            pixels = get_pixels(frame_id, 'train', self.pixel_dir)
+            boxes2d = [np.array(obj.box2d) for obj in self.dataset_kitti.get_label_2D(frame_id)]
+            gt_obj_list = self.dataset_kitti.get_label(frame_id)
+            # keep the image columns the perturbed boxes reach, and the
+            # points that can be closest to their centers (frustum angle)
+            band = np.zeros(len(pixels), dtype=bool)
+            for box2d in boxes2d:
+                width = abs(box2d[2] - box2d[0])
+                band |= np.abs(pixels[:,0] - (box2d[0] + box2d[2]) / 2.0) <= width * reach
+                band |= frustum_center_mask(pixels, box2d, shift_ratio)
+            pc_lidar, pixels = pc_lidar[band], pixels[band]
+            gt_corners = kitti_utils.boxes3d_to_corners3d(kitti_utils.objs_to_boxes3d(gt_obj_list),
+                                                          transform=False)
+            cls_label = np.zeros((pc_lidar.shape[0]), dtype=np.int32)
+            for k in range(gt_corners.shape[0]):
+                cls_label[kitti_utils.in_box3d(pc_lidar[:,0:3], gt_corners[k])] = k+1
+            self.frame_store[frame_id] = (pc_lidar, pixels, cls_label, gt_obj_list, gt_corners)
+
+            for box2d in boxes2d:
+                frustum = self.extract_frustum(frame_id, box2d)
+                if frustum is None:
+                    continue
+                for _ in range(augment_x):
+                    self.id_list.append(frame_id)
+                    self.gt_box2d_list.append(box2d)
+                    self.point_count_list.append(len(frustum['pc']))
+                    self.raw_point_count_list.append(frustum['raw_points'])
+                    self.input_list.append(None)
+                    self.label_list.append(None)
+                    self.frustum_angle_list.append(frustum['frustum_angle'])
+                    self.box3d_list.append(frustum['corners'])
+                    self.box2d_list.append(box2d)
+                    self.type_list.append("Pedestrian")
+                    self.heading_list.append(frustum['heading'])
+                    self.size_list.append(frustum['size'])
+
+    def build_index(self, split, augment_x=5):
+        ''' Lazy extraction. Index the frustums of the split from the label
+        files (train: augment_x entries per GT 2D box, each drawing its own
+        perturbation) or the 2D detection files (val/test: one entry per
+        detection). Only the point projections of the frames are read, to
+        count the points of each box with box2d_roi_mask and drop the boxes
+        the eager mode drops for their size or point count (lower than 25
+        pixels, fewer than 20 points for a detection, no point for a GT
+        box). The frustum of an entry is extracted and labelled by
+        load_entry on its first read; until then its input_list,
+        label_list and 3D box fields are None.
+        '''
+        self.split = split
+        self.entry_list = [] # (frame id, source 2D box) of each frustum
+        self.memo = OrderedDict() # extracted entries, least recent first
+        self.dropped = set() # entries without a frustum in the eager mode
+        self.id_list = []
+        self.point_count_list = []
+        for frame_id in self.dataset_kitti.sample_id_list:
+            if split == 'train':
+                boxes2d = [np.array(obj.box2d) for obj in self.dataset_kitti.get_label_2D(frame_id)]
+                boxes2d = [box2d for box2d in boxes2d if box2d[3] - box2d[1] >= 25]
+                copies, min_points = augment_x, 1
+            else:
+                boxes2d = get_2Dboxes_detected(frame_id, self.res_det, split) or []
+                boxes2d = [box2d for box2d in boxes2d if valid_detection_box(box2d)]
+                copies, min_points = 1, 20
+            if not boxes2d:
+                continue
+            pixels = get_pixels(frame_id, split, self.pixel_dir)
+            for box2d in boxes2d:
+                points = np.count_nonzero(box2d_roi_mask(pixels, box2d))
+                if points < min_points:
+                    continue
+                for _ in range(copies):
+                    self.entry_list.append((frame_id, box2d))
+                    self.id_list.append(frame_id)
+                    self.point_count_list.append(points)
+        n = len(self.entry_list)
+        self.box2d_list = [box2d for _, box2d in self.entry_list]
+        self.type_list = ["Pedestrian"] * n
+        self.input_list = [None] * n
+        self.label_list = [None] * n
+        self.frustum_angle_list = [None] * n
+        self.box3d_list = [None] * n
+        self.heading_list = [None] * n
+        self.size_list = [None] * n
+        if split != 'train':
+            self.indice_box = [None] * n
+
+    def load_entry_frame(self, frame_id):
+        ''' Points, projections and GT boxes of a frame, as read by the
+        eager mode of the split. '''
+        pc_lidar = self.dataset_kitti.get_lidar(frame_id)
+        pixels = get_pixels(frame_id, self.split, self.pixel_dir)
+        gt_obj_list = self.dataset_kitti.get_label(frame_id)
+        if self.split != 'train':
+            gt_obj_list = self.dataset_kitti.filtrate_objects(gt_obj_list)
+        gt_boxes3d = kitti_utils.objs_to_boxes3d(gt_obj_list)
+        gt_corners = kitti_utils.boxes3d_to_corners3d(gt_boxes3d, transform=False)
+        return pc_lidar, pixels, gt_obj_list, gt_boxes3d, gt_corners
+
+    def extract_entry(self, frame, box2d):
+        ''' Frustum of a 2D box of a frame of load_entry_frame, as extracted
+        by the eager mode (train_frustum or detection_frustum), None if the
+        eager mode drops it. '''
+        pc_lidar, pixels, gt_obj_list, gt_boxes3d, gt_corners = frame
+        if self.split == 'train':
+            return train_frustum(pc_lidar, pixels, box2d, gt_obj_list, gt_corners)
+        return detection_frustum(pc_lidar, pixels, box2d, gt_boxes3d, gt_corners)
+
+    def extract_entry(self, index, max_tries=10):
+        ''' Frustum of entry `index`, as extracted by the eager mode
+        (train_frustum or detection_frustum) and with its box2d, None if the
+        eager mode drops it. A train entry gets a perturbation of its GT 2D
+        box (the GT box itself if no valid one is drawn in max_tries).
+        '''
+        frame_id, box2d = self.entry_list[index]
+        pc_lidar, pixels, gt_obj_list, gt_boxes3d, gt_corners = self.load_entry_frame(frame_id)
+        if self.split != 'train':
+            frustum = detection_frustum(pc_lidar, pixels, box2d, gt_boxes3d, gt_corners)
+        else:
+            for _ in range(max_tries):
+                shifted = random_shift_box2d(box2d)
+                frustum = train_frustum(pc_lidar, pixels, shifted, gt_obj_list, gt_corners)
+                if frustum is not None:
+                    box2d = shifted
+                    break
+            if frustum is None:
+                box2d = np.copy(box2d)
+                frustum = train_frustum(pc_lidar, pixels, box2d, gt_obj_list, gt_corners)
+        if frustum is not None:
+            frustum['box2d'] = box2d
+        return frustum
+
+    def load_entry(self, index, max_tries=10):
+        ''' Extract and label the frustum of entry `index` of build_index,
+        if it is not memoized. The entries the eager mode drops (GT boxes
+        without foreground point) are only known when extracted: the entry
+        then gets the frustum of the next valid entry, and its frame id.
+        '''
+        if index in self.memo:
+            self.memo[index] = self.memo.pop(index)
+            return
+        source = index
+        frustum = self.extract_entry(source, max_tries)
+        while frustum is None:
+            self.dropped.add(source)
+            if len(self.dropped) == len(self.entry_list):
+                raise ValueError('no frustum of the %s split has a foreground point' % self.split)
+            source = (source + 1) % len(self.entry_list)
+            if source not in self.dropped:
+                frustum = self.extract_entry(source, max_tries)
+        pc, seg = frustum['pc'], frustum['seg']
+        if self.voxel_size:
+            pc, seg = voxel_downsample(pc, self.voxel_size, seg, self.voxel_reduction)
+        self.id_list[index] = self.entry_list[source][0]
+        self.input_list[index] = pc
+        self.label_list[index] = seg
+        self.frustum_angle_list[index] = frustum['frustum_angle']
+        self.box3d_list[index] = frustum['corners']
+        self.box2d_list[index] = frustum['box2d']
+        self.heading_list[index] = frustum['heading']
+        self.size_list[index] = frustum['size']
+        if self.split != 'train':
+            self.indice_box[index] = frustum['indice_box']
+        self.memo[index] = True
+        while len(self.memo) > max(self.memo_size, 1):
+            # the 3D box fields are small, only the points are dropped
+            evicted, _ = self.memo.popitem(last=False)
+            self.input_list[evicted] = None
+            self.label_list[evicted] = None
+
+    def extract_frustum(self, frame_id, box2d):
+        ''' Frustum of a 2D box of a frame of frame_store, labelled with the
+        GT box with most points in it, as in the train split of __init__.
+        Output:
+            frustum: dict with pc, seg, frustum_angle, corners, heading, size
+                and raw_points (points before voxel downsampling), None if
+                the box is lower than 25 pixels or has no foreground point
+        '''
+        pc_lidar, pixels, cls_label, gt_obj_list, gt_corners = self.frame_store[frame_id]
+        if box2d[3] - box2d[1] < 25:
+            return None
+        frus_pc, mask = extract_pc_in_rect(pc_lidar, pixels, box2d)
+        counts = np.bincount(cls_label[mask], minlength=len(gt_corners)+1)[1:]
+        if len(counts) == 0 or counts.max() == 0:
+            return None
+        corners_max = int(np.argmax(counts))
+        seg = np.where(cls_label[mask] == corners_max + 1, 1.0, 0.0)
+        center_box2d = np.array([(box2d[0]+box2d[2])/2.0, (box2d[1]+box2d[2])/2.0])
+        pc_center_frus = get_closest_pc_to_center(pc_lidar, pixels, center_box2d)
+        raw_points = len(frus_pc)
+        if self.voxel_size:
+            frus_pc, seg = voxel_downsample(frus_pc, self.voxel_size, seg, self.voxel_reduction)
+        obj = gt_obj_list[corners_max]
+        return {'pc': frus_pc, 'seg': seg, 'raw_points': raw_points,
+                'frustum_angle': - np.arctan2(pc_center_frus[2], pc_center_frus[0]),
+                'corners': gt_corners[corners_max], 'heading': obj.ry,
+                'size': np.array([obj.h, obj.w, obj.l])}
+
+    def draw_frustum(self, index, max_tries=10):
+        ''' Fill the slot `index` with the frustum of a new perturbation of
+        its GT 2D box (the GT box itself if no valid one is drawn). '''
+        frame_id = self.id_list[index]
+        frustum = None
+        for _ in range(max_tries):
+            box2d = random_shift_box2d(self.gt_box2d_list[index])
+            frustum = self.extract_frustum(frame_id, box2d)
+            if frustum is not None:
+                break
+        if frustum is None:
+            box2d = self.gt_box2d_list[index]
+            frustum = self.extract_frustum(frame_id, box2d)
+        self.input_list[index] = frustum['pc']
+        self.label_list[index] = frustum['seg']
+        self.frustum_angle_list[index] = frustum['frustum_angle']
+        self.box3d_list[index] = frustum['corners']
+        self.box2d_list[index] = box2d
+        self.heading_list[index] = frustum['heading']
+        self.size_list[index] = frustum['size']
+
+    def voxel_downsample(self, voxel_size, reduction='centroid'):
+        ''' Downsample the point cloud (and segmentation label) of every
+        frustum with voxel_downsample.
+        Output:
+            stats: dict, see downsampling_stats
+        '''
+        before = self.get_point_counts()
+        has_labels = hasattr(self, 'label_list')
+        if isinstance(self.input_list, FrustumViews) and reduction == 'first':
+            # the first points of the voxels stay views of the frames
+            for i in range(len(self.input_list)):
+                pc = self.input_list[i]
+                if len(pc) == 0:
+                    continue
+                first, inverse, counts = voxel_groups(pc, voxel_size)
+                self.input_list.select(i, first)
+                self.label_list[i] = voxel_labels(self.label_list[i], inverse, counts)
+            return downsampling_stats(before, self.get_point_counts(), voxel_size, reduction)
+        for i in range(len(self.input_list)):
+            labels = self.label_list[i] if has_labels else None
+            self.input_list[i], labels = voxel_downsample(self.input_list[i], voxel_size,
+                                                          labels, reduction)
+            if has_labels:
+                self.label_list[i] = labels
+        return downsampling_stats(before, self.get_point_counts(), voxel_size, reduction)
+
+    def get_item(self, index, npoints=None):
+        ''' Get index-th element, with its point cloud resampled to npoints
+        points (default self.npoints). '''
+        if self.lazy_extract:
+            self.load_entry(index)
+        if not self.lazy_augment:
+            return self._get_item(index, npoints)
+        self.draw_frustum(index)
+        try:
+            return self._get_item(index, npoints)
+        finally:
+            # the drawn frustum is only kept while it is read
+            self.input_list[index] = None
+            self.label_list[index] = None
+
+    def _get_item(self, index, npoints=None):
+        if npoints is None:
+            npoints = self.npoints
         # ------------------------------ INPUTS ----------------------------
         rot_angle = self.get_center_view_rot_angle(index)
 
@@ -477,7 +1182,7 @@ class FrustumDataset(object):
         else:
             point_set = self.input_list[index]
         # Resample
-        choice = np.random.choice(point_set.shape[0], self.npoints, replace=True)
+        choice = np.random.choice(point_set.shape[0], npoints, replace=True)
         point_set = point_set[choice, :]
         if self.from_rgb_detection:
             if self.one_hot:
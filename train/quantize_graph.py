@@ -0,0 +1,263 @@
+''' Reduced precision versions of the graphs written by export_model.py.
+
+Modes:
+    fp16: the conv/fc weights are stored as float16 and cast back to
+        float32 in the graph, halving the weight memory
+    int8: post-training quantization. The conv/fc weights are stored as
+        int8 with one float32 scale per output channel (symmetric), and
+        the inputs of every conv/fc layer are quantized to 8 bits with
+        ranges calibrated on a sample of frustums (FakeQuant nodes). The
+        calibrated ranges are also written to <output>.ranges.json for
+        runtimes with int8 kernels.
+
+The accuracy of the original and reduced precision graphs is compared on
+the val split with the IoU metrics of provider.compute_box3d_iou.
+
+Usage:
+    python train/export_model.py --model_path log/ckpt --optimize \
+        --output export/fpointnet.pb
+    python train/quantize_graph.py --input export/fpointnet.pb \
+        --output export/fpointnet_int8.pb --mode int8 --benchmark 50
+'''
+from __future__ import print_function
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import tensor_util
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+import provider
+import profile_util
+from train_util import get_batch
+from export_model import OUTPUT_NAMES
+from optimize_graph import GraphNodes, load_graph_def, graph_session, benchmark_graphs
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input', required=True, help='Frozen graph written by export_model.py (preferably with --optimize)')
+parser.add_argument('--output', required=True, help='Reduced precision frozen graph')
+parser.add_argument('--mode', default='fp16', help='fp16 or int8 [default: fp16]')
+parser.add_argument('--calib_batches', type=int, default=10, help='Train batches for the int8 activation ranges [default: 10]')
+parser.add_argument('--eval_res', default='704', help='Detection resolution of the val frustums [default: 704]')
+parser.add_argument('--eval_batches', type=int, default=0, help='Val batches of the accuracy comparison, 0 for all, -1 to skip [default: 0]')
+parser.add_argument('--batch_size', type=int, default=32, help='Batch size if the graph has a variable batch size [default: 32]')
+parser.add_argument('--benchmark', type=int, default=0, help='Time this many calls of both graphs [default: 0]')
+
+LAYER_OPS = ('Conv2D', 'MatMul')
+
+
+def weight_nodes(g):
+    ''' Float32 Const nodes used as weights of conv/matmul layers.
+    Output:
+        list of (layer node, weight Const node)
+    '''
+    layers = []
+    for node in g.nodes.values():
+        if node.op in LAYER_OPS:
+            weight = g.resolve_weight(node.input[1])
+            if weight.op == 'Const' and weight.attr['dtype'].type == tf.float32.as_datatype_enum:
+                layers.append((node, weight))
+    return layers
+
+
+def _const(name, value):
+    node = tf.NodeDef()
+    node.name = name
+    node.op = 'Const'
+    node.attr['dtype'].type = tf.as_dtype(value.dtype).as_datatype_enum
+    node.attr['value'].tensor.CopyFrom(tensor_util.make_tensor_proto(value))
+    return node
+
+
+def _cast(name, inp, src, dst):
+    node = tf.NodeDef()
+    node.name = name
+    node.op = 'Cast'
+    node.input.append(inp)
+    node.attr['SrcT'].type = src.as_datatype_enum
+    node.attr['DstT'].type = dst.as_datatype_enum
+    return node
+
+
+def _replace(g, name, new_nodes):
+    ''' Replace node `name` by new_nodes, the last one taking its name. '''
+    del g.nodes[name]
+    for node in new_nodes:
+        g.nodes[node.name] = node
+
+
+def weights_to_float16(graph_def):
+    ''' Store the conv/fc weights as float16, cast to float32 on use. '''
+    g = GraphNodes(graph_def)
+    for _, weight in weight_nodes(g):
+        value = tensor_util.MakeNdarray(weight.attr['value'].tensor)
+        half = _const(weight.name + '_fp16', value.astype(np.float16))
+        _replace(g, weight.name, [half, _cast(weight.name, half.name, tf.float16, tf.float32)])
+    return g.to_graph_def(graph_def)
+
+
+def quantize_weights(graph_def):
+    ''' Store the conv/fc weights as int8 with a symmetric scale per output
+    channel (last axis), dequantized in the graph. '''
+    g = GraphNodes(graph_def)
+    for _, weight in weight_nodes(g):
+        value = tensor_util.MakeNdarray(weight.attr['value'].tensor)
+        axes = tuple(range(value.ndim - 1))
+        scale = np.max(np.abs(value), axis=axes) / 127.0
+        scale[scale == 0] = 1.0
+        quantized = np.clip(np.round(value / scale), -127, 127).astype(np.int8)
+        q_node = _const(weight.name + '_int8', quantized)
+        s_node = _const(weight.name + '_scale', scale.astype(np.float32))
+        cast = _cast(weight.name + '_dequant', q_node.name, tf.int8, tf.float32)
+        mul = tf.NodeDef()
+        mul.name = weight.name
+        mul.op = 'Mul'
+        mul.input.extend([cast.name, s_node.name])
+        mul.attr['T'].type = tf.float32.as_datatype_enum
+        _replace(g, weight.name, [q_node, s_node, cast, mul])
+    return g.to_graph_def(graph_def)
+
+
+def node_input_tensor(inp):
+    return inp if ':' in inp else inp + ':0'
+
+
+def calibrate(graph_def, batches):
+    ''' Ranges of the inputs of the conv/fc layers over calibration batches.
+    Input:
+        batches: list of (pointclouds, one_hot_vec) arrays
+    Output:
+        ranges: dict layer node name -> [min, max]
+    '''
+    g = GraphNodes(graph_def)
+    layers = [node.name for node, _ in weight_nodes(g)]
+    sess, inputs, _ = graph_session(graph_def, seed=1)
+    fetches = [sess.graph.get_tensor_by_name(node_input_tensor(g.nodes[name].input[0]))
+               for name in layers]
+    ranges = {}
+    for values in batches:
+        results = sess.run(fetches, feed_dict=dict(zip(inputs, values)))
+        for name, value in zip(layers, results):
+            low, high = float(np.min(value)), float(np.max(value))
+            if name in ranges:
+                low, high = min(low, ranges[name][0]), max(high, ranges[name][1])
+            ranges[name] = [low, high]
+    sess.close()
+    return ranges
+
+
+def quantize_activations(graph_def, ranges, num_bits=8):
+    ''' Quantize the inputs of the calibrated layers with FakeQuant nodes. '''
+    g = GraphNodes(graph_def)
+    for name, (low, high) in ranges.items():
+        layer = g.nodes[name]
+        quant = tf.NodeDef()
+        quant.name = name + '/input_quant'
+        quant.op = 'FakeQuantWithMinMaxArgs'
+        quant.input.append(layer.input[0])
+        # the quantized range must contain 0
+        quant.attr['min'].f = min(low, 0.0)
+        quant.attr['max'].f = max(high, 0.0)
+        quant.attr['num_bits'].i = num_bits
+        quant.attr['narrow_range'].b = False
+        g.nodes[quant.name] = quant
+        layer.input[0] = quant.name
+    return g.to_graph_def(graph_def)
+
+
+def graph_batch_size(graph_def, default):
+    for node in graph_def.node:
+        if node.name == 'pointclouds':
+            dims = [d.size for d in node.attr['shape'].shape.dim]
+            return (dims[0] if dims[0] > 0 else default), dims[1]
+    raise ValueError('No pointclouds input in the graph')
+
+
+def dataset_batches(dataset, batch_size, num_point, num_batches, seed=None):
+    ''' Batches of a FrustumDataset: (pointclouds, one_hot_vec) and labels.
+    With seed, the frustums are drawn in random order. '''
+    idxs = np.arange(len(dataset))
+    if seed is not None:
+        idxs = np.random.RandomState(seed).permutation(idxs)
+    total = len(dataset) // batch_size
+    if num_batches > 0:
+        total = min(total, num_batches)
+    for i in range(total):
+        batch = get_batch(dataset, idxs, i * batch_size, (i + 1) * batch_size, num_point, 4)
+        yield (batch[0], batch[8]), batch
+
+
+def evaluate_graph(graph_def, dataset, batch_size, num_point, num_batches):
+    ''' Segmentation accuracy and 3D box IoUs of a graph on a dataset. '''
+    sess, inputs, outputs = graph_session(graph_def, seed=1)
+    correct, seen = 0, 0
+    iou2ds, iou3ds = [], []
+    for values, batch in dataset_batches(dataset, batch_size, num_point, num_batches):
+        res = dict(zip(OUTPUT_NAMES, sess.run(outputs, feed_dict=dict(zip(inputs, values)))))
+        batch_label, batch_center, batch_hclass, batch_hres, batch_sclass, batch_sres = batch[1:7]
+        correct += np.sum(np.argmax(res['seg_logits'], 2) == batch_label)
+        seen += batch_label.size
+        iou2d, iou3d = provider.compute_box3d_iou(res['center'],
+            res['heading_scores'], res['heading_residuals'],
+            res['size_scores'], res['size_residuals'],
+            batch_center, batch_hclass, batch_hres, batch_sclass, batch_sres)
+        iou2ds.append(iou2d)
+        iou3ds.append(iou3d)
+    sess.close()
+    iou2ds = np.concatenate(iou2ds) if iou2ds else np.zeros(0)
+    iou3ds = np.concatenate(iou3ds) if iou3ds else np.zeros(0)
+    return {'seg_accuracy': correct / float(max(seen, 1)),
+            'iou2d': float(np.mean(iou2ds)) if len(iou2ds) else 0.0,
+            'iou3d': float(np.mean(iou3ds)) if len(iou3ds) else 0.0,
+            'box_accuracy': float(np.mean(iou3ds >= 0.5)) if len(iou3ds) else 0.0,
+            'num_frustums': len(iou3ds)}
+
+
+def const_bytes(graph_def):
+    return sum(len(n.attr['value'].tensor.tensor_content) for n in graph_def.node if n.op == 'Const')
+
+
+def main():
+    original = load_graph_def(FLAGS.input)
+    batch_size, num_point = graph_batch_size(original, FLAGS.batch_size)
+    if FLAGS.mode == 'fp16':
+        reduced = weights_to_float16(original)
+    elif FLAGS.mode == 'int8':
+        calib = provider.FrustumDataset(npoints=num_point, database='KITTI', split='train', res=0,
+                                        rotate_to_center=True, one_hot=True)
+        batches = [values for values, _ in dataset_batches(calib, batch_size, num_point,
+                                                           FLAGS.calib_batches, seed=0)]
+        ranges = calibrate(original, batches)
+        print('Calibrated %d layer inputs on %d frustums' % (len(ranges), len(batches) * batch_size))
+        reduced = quantize_activations(quantize_weights(original), ranges)
+        with open(FLAGS.output + '.ranges.json', 'w') as f:
+            json.dump(ranges, f, indent=1, sort_keys=True)
+    else:
+        raise ValueError('Unknown mode %s' % FLAGS.mode)
+
+    output_dir = os.path.dirname(os.path.abspath(FLAGS.output))
+    tf.train.write_graph(reduced, output_dir, os.path.basename(FLAGS.output), as_text=False)
+    print('Written to %s' % FLAGS.output)
+    print('constants: %s -> %s' % (profile_util.format_bytes(const_bytes(original)),
+                                   profile_util.format_bytes(const_bytes(reduced))))
+
+    if FLAGS.eval_batches >= 0:
+        val = provider.FrustumDataset(npoints=num_point, database='KITTI', split='val',
+                                      res=FLAGS.eval_res, rotate_to_center=True, one_hot=True)
+        base = evaluate_graph(original, val, batch_size, num_point, FLAGS.eval_batches)
+        new = evaluate_graph(reduced, val, batch_size, num_point, FLAGS.eval_batches)
+        print('val %s, %d frustums' % (FLAGS.eval_res, base['num_frustums']))
+        print('%-14s %10s %10s %10s' % ('', 'float32', FLAGS.mode, 'delta'))
+        for key in ['seg_accuracy', 'iou2d', 'iou3d', 'box_accuracy']:
+            print('%-14s %10.4f %10.4f %+10.4f' % (key, base[key], new[key], new[key] - base[key]))
+    if FLAGS.benchmark > 0:
+        benchmark_graphs([('float32', original), (FLAGS.mode, reduced)],
+                         FLAGS.benchmark, batch_size)
+
+
+if __name__ == '__main__':
+    FLAGS = parser.parse_args()
+    main()
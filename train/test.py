@@ -20,6 +20,8 @@ sys.path.append(BASE_DIR)
 sys.path.append(os.path.join(ROOT_DIR, 'models'))
 from model_util import NUM_HEADING_BIN, NUM_SIZE_CLUSTER
 import provider
+import frame_cache
+import tf_util
 from train_util import get_batch,get_batch_test
 import time
 
@@ -34,6 +36,18 @@ parser.add_argument('--data_path', default=None, help='frustum dataset pickle fi
 parser.add_argument('--from_rgb_detection', action='store_true', help='test from dataset files from rgb detection.')
 parser.add_argument('--idx_path', default=None, help='filename of txt where each line is a data idx, used for rgb detection -- write <id>.txt for all frames. [default: None]')
 parser.add_argument('--dump_result', action='store_true', help='If true, also dump results to .pickle file')
+parser.add_argument('--frozen_graph', default=None, help='Use a graph exported by export_model.py instead of --model/--model_path [default: None]')
+parser.add_argument('--layout_config', default=None, help='Layouts recorded by benchmark_model.py --autotune, default NHWC with fused batch norm [default: None]')
+parser.add_argument('--layout_device', default='gpu', help='Device whose layout is loaded from --layout_config, cpu or gpu [default: gpu]')
+parser.add_argument('--min_mask_points', type=int, default=0, help='Skip the box estimation of the frustums with fewer mask points (zero boxes), v1 only [default: 0]')
+parser.add_argument('--xla', action='store_true', help='Compile the model and loss with XLA (JIT)')
+parser.add_argument('--pointwise', action='store_true', help='Run the 1x1 conv stacks of the model as tf_util.shared_mlp layers (same variables)')
+parser.add_argument('--voxel_size', type=float, default=0, help='Downsample the frustums to one point per voxel of this size in meters, 0 to disable [default: 0]')
+parser.add_argument('--voxel_reduction', default='centroid', help='Point kept per voxel: centroid or first [default: centroid]')
+parser.add_argument('--frame_views', action='store_true', help='Store every frame once and the frustums as point indices into it, see provider.FrustumViews')
+parser.add_argument('--frame_cache_mb', type=int, default=1024, help='Size of the cache of frame files shared by the datasets, 0 to disable [default: 1024]')
+parser.add_argument('--lazy_extract', action='store_true', help='Index the detections at startup and extract each frustum on its first read')
+parser.add_argument('--memo_size', type=int, default=1024, help='Extracted frustums kept in memory with --lazy_extract [default: 1024]')
 FLAGS = parser.parse_args()
 
 # Set training configurations
@@ -42,17 +56,27 @@ MODEL_PATH = FLAGS.model_path
 GPU_INDEX = FLAGS.gpu
 NUM_POINT = FLAGS.num_point
 MODEL = importlib.import_module(FLAGS.model)
+if FLAGS.layout_config is not None:
+    tf_util.load_layout(FLAGS.layout_config, FLAGS.layout_device, 'forward')
 NUM_CLASSES = 2
 NUM_CHANNEL = 4
 
 # Load Frustum Datasets.
+frame_cache.FRAME_CACHE.set_max_bytes(FLAGS.frame_cache_mb * 1024**2)
 TEST_DATASET = provider.FrustumDataset(npoints=NUM_POINT, database='KITTI', split='val', res="704",
-                                           rotate_to_center=True, one_hot=True)
+                                           rotate_to_center=True, one_hot=True,
+                                           voxel_size=FLAGS.voxel_size, voxel_reduction=FLAGS.voxel_reduction,
+                                           frame_views=FLAGS.frame_views,
+                                           lazy_extract=FLAGS.lazy_extract, memo_size=FLAGS.memo_size)
+if TEST_DATASET.voxel_stats is not None:
+    print(provider.format_downsampling_stats(TEST_DATASET.voxel_stats))
 
 def get_session_and_ops(batch_size, num_point):
     ''' Define model graph, load model parameters,
     create session and return session handle and tensors
     '''
+    if FLAGS.frozen_graph is not None:
+        return get_frozen_session_and_ops()
     with tf.Graph().as_default():
         with tf.device('/gpu:'+str(GPU_INDEX)):
             pointclouds_pl, one_hot_vec_pl, labels_pl, centers_pl, \
@@ -60,11 +84,13 @@ def get_session_and_ops(batch_size, num_point):
             size_class_label_pl, size_residual_label_pl = \
                 MODEL.placeholder_inputs(batch_size, num_point)
             is_training_pl = tf.placeholder(tf.bool, shape=())
-            end_points = MODEL.get_model(pointclouds_pl, one_hot_vec_pl,
-                is_training_pl)
-            loss = MODEL.get_loss(labels_pl, centers_pl,
-                heading_class_label_pl, heading_residual_label_pl,
-                size_class_label_pl, size_residual_label_pl, end_points)
+            with tf_util.xla_scope(FLAGS.xla):
+                kwargs = {'min_mask_points': FLAGS.min_mask_points} if FLAGS.min_mask_points > 0 else {}
+                end_points = MODEL.get_model(pointclouds_pl, one_hot_vec_pl,
+                    is_training_pl, pointwise=FLAGS.pointwise, **kwargs)
+                loss = MODEL.get_loss(labels_pl, centers_pl,
+                    heading_class_label_pl, heading_residual_label_pl,
+                    size_class_label_pl, size_residual_label_pl, end_points)
             saver = tf.train.Saver()
 
         # Create a session
@@ -90,6 +116,20 @@ def get_session_and_ops(batch_size, num_point):
                'loss': loss}
         return sess, ops
 
+def get_frozen_session_and_ops():
+    ''' Session and tensors of a graph exported by export_model.py,
+    with the same keys as get_session_and_ops. The detection score is
+    computed in the graph. '''
+    from export_model import load_frozen_graph
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    config.allow_soft_placement = True
+    sess, ops = load_frozen_graph(FLAGS.frozen_graph, config)
+    ops['logits'] = ops['seg_logits']
+    ops['end_points'] = dict((k, ops[k]) for k in ['heading_scores',
+        'heading_residuals', 'size_scores', 'size_residuals', 'box_valid'])
+    return sess, ops
+
 def softmax(x):
     ''' Numpy function for softmax'''
     shape = x.shape
@@ -98,7 +138,9 @@ def softmax(x):
     return probs
 
 def inference(sess, ops, pc, one_hot_vec, batch_size):
-    ''' Run inference for frustum pointnets in batch mode '''
+    ''' Run inference for frustum pointnets in batch mode.
+    box_valid is False for the frustums whose box estimation was skipped
+    (--min_mask_points), their box outputs are zeros. '''
     assert pc.shape[0]%batch_size == 0
     num_batches = pc.shape[0]/batch_size
     logits = np.zeros((pc.shape[0], pc.shape[1], NUM_CLASSES))
@@ -108,21 +150,28 @@ def inference(sess, ops, pc, one_hot_vec, batch_size):
     size_logits = np.zeros((pc.shape[0], NUM_SIZE_CLUSTER))
     size_residuals = np.zeros((pc.shape[0], NUM_SIZE_CLUSTER, 3))
     scores = np.zeros((pc.shape[0],)) # 3D box score 
+    box_valid = np.ones((pc.shape[0],), dtype=bool)
    
     ep = ops['end_points'] 
     for i in range(num_batches):
         feed_dict = {\
             ops['pointclouds_pl']: pc[i*batch_size:(i+1)*batch_size,...],
-            ops['one_hot_vec_pl']: one_hot_vec[i*batch_size:(i+1)*batch_size,:],
-            ops['is_training_pl']: False}
-
+            ops['one_hot_vec_pl']: one_hot_vec[i*batch_size:(i+1)*batch_size,:]}
+        if 'is_training_pl' in ops:
+            feed_dict[ops['is_training_pl']] = False
+        fetches = [ops['logits'], ops['center'],
+            ep['heading_scores'], ep['heading_residuals'],
+            ep['size_scores'], ep['size_residuals']]
+        if 'score' in ops:
+            # exported graph, the score is computed in the graph
+            fetches.append(ops['score'])
+        if 'box_valid' in ep:
+            fetches.append(ep['box_valid'])
+
+        outputs = sess.run(fetches, feed_dict=feed_dict)
         batch_logits, batch_centers, \
         batch_heading_scores, batch_heading_residuals, \
-        batch_size_scores, batch_size_residuals = \
-            sess.run([ops['logits'], ops['center'],
-                ep['heading_scores'], ep['heading_residuals'],
-                ep['size_scores'], ep['size_residuals']],
-                feed_dict=feed_dict)
+        batch_size_scores, batch_size_residuals = outputs[:6]
 
         logits[i*batch_size:(i+1)*batch_size,...] = batch_logits
         centers[i*batch_size:(i+1)*batch_size,...] = batch_centers
@@ -130,7 +179,12 @@ def inference(sess, ops, pc, one_hot_vec, batch_size):
         heading_residuals[i*batch_size:(i+1)*batch_size,...] = batch_heading_residuals
         size_logits[i*batch_size:(i+1)*batch_size,...] = batch_size_scores
         size_residuals[i*batch_size:(i+1)*batch_size,...] = batch_size_residuals
+        if 'box_valid' in ep:
+            box_valid[i*batch_size:(i+1)*batch_size] = outputs[-1] > 0
 
+        if 'score' in ops:
+            scores[i*batch_size:(i+1)*batch_size] = outputs[6]
+            continue
         # Compute scores
         batch_seg_prob = softmax(batch_logits)[:,:,1] # BxN
         batch_seg_mask = np.argmax(batch_logits, 2) # BxN
@@ -150,16 +204,19 @@ def inference(sess, ops, pc, one_hot_vec, batch_size):
         for i in range(pc.shape[0])])
 
     return np.argmax(logits, 2), centers, heading_cls, heading_res, \
-        size_cls, size_res, scores
+        size_cls, size_res, scores, box_valid
 
 def write_detection_results(result_dir, id_list, type_list, box2d_list, center_list, \
                             heading_cls_list, heading_res_list, \
                             size_cls_list, size_res_list, \
-                            rot_angle_list, score_list):
-    ''' Write frustum pointnets results to KITTI format label files. '''
+                            rot_angle_list, score_list, valid_list=None):
+    ''' Write frustum pointnets results to KITTI format label files.
+    The frustums with a False valid_list entry (no box estimate) are
+    dropped. '''
     if result_dir is None: return
     results = {} # map from idx to list of strings, each string is a line (without \n)
     for i in range(len(center_list)):
+        if valid_list is not None and not valid_list[i]: continue
         idx = id_list[i]
         output_str = type_list[i] + " -1 -1 -10 "
         box2d = box2d_list[i]
@@ -206,6 +263,7 @@ def test_from_rgb_detection(output_filename, result_dir=None):
     rot_angle_list = []
     score_list = []
     onehot_list = []
+    valid_list = []
 
     test_idxs = np.arange(0, len(TEST_DATASET))
     print(len(TEST_DATASET))
@@ -230,7 +288,7 @@ def test_from_rgb_detection(output_filename, result_dir=None):
         # Run one batch inference
     batch_output, batch_center_pred, \
         batch_hclass_pred, batch_hres_pred, \
-        batch_sclass_pred, batch_sres_pred, batch_scores = \
+        batch_sclass_pred, batch_sres_pred, batch_scores, batch_valid = \
             inference(sess, ops, batch_data_to_feed,
                 batch_one_hot_to_feed, batch_size=batch_size)
 
@@ -246,6 +304,7 @@ def test_from_rgb_detection(output_filename, result_dir=None):
         #score_list.append(batch_scores[i])
         score_list.append(batch_rgb_prob[i]) # 2D RGB detection score
         onehot_list.append(batch_one_hot_vec[i])
+        valid_list.append(batch_valid[i])
 
     if FLAGS.dump_result:
         with open(output_filename, 'wp') as fp:
@@ -265,7 +324,7 @@ def test_from_rgb_detection(output_filename, result_dir=None):
     write_detection_results(result_dir, TEST_DATASET.id_list,
         TEST_DATASET.type_list, TEST_DATASET.box2d_list,
         center_list, heading_cls_list, heading_res_list,
-        size_cls_list, size_res_list, rot_angle_list, score_list)
+        size_cls_list, size_res_list, rot_angle_list, score_list, valid_list)
     # Make sure for each frame (no matter if we have measurment for that frame),
     # there is a TXT file
     output_dir = os.path.join(result_dir, 'data')
@@ -289,6 +348,7 @@ def test(output_filename, result_dir=None):
     size_res_list = []
     rot_angle_list = []
     score_list = []
+    valid_list = []
 
     test_idxs = np.arange(0, len(TEST_DATASET))
     batch_size = BATCH_SIZE
@@ -319,7 +379,7 @@ def test(output_filename, result_dir=None):
         start_time = time.time()
         batch_output, batch_center_pred, \
         batch_hclass_pred, batch_hres_pred, \
-        batch_sclass_pred, batch_sres_pred, batch_scores = \
+        batch_sclass_pred, batch_sres_pred, batch_scores, batch_valid = \
             inference(sess, ops, batch_data,
                 batch_one_hot_vec, batch_size=batch_size)
         end_time = time.time()
@@ -338,6 +398,7 @@ def test(output_filename, result_dir=None):
             size_res_list.append(batch_sres_pred[i,:])
             rot_angle_list.append(batch_rot_angle[i])
             score_list.append(batch_scores[i])
+            valid_list.append(batch_valid[i])
 
     print("Segmentation accuracy: %f" % \
         (correct_cnt / float(batch_size*num_batches*NUM_POINT)))
@@ -347,7 +408,7 @@ def test(output_filename, result_dir=None):
     """write_detection_results(result_dir, TEST_DATASET.id_list,
         TEST_DATASET.type_list, TEST_DATASET.box2d_list, center_list,
         heading_cls_list, heading_res_list,
-        size_cls_list, size_res_list, rot_angle_list, score_list)"""
+        size_cls_list, size_res_list, rot_angle_list, score_list, valid_list)"""
 
 
 if __name__=='__main__':
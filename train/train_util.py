@@ -41,11 +41,11 @@ def get_batch(dataset, idxs, start_idx, end_idx,
     for i in range(bsize):
         if dataset.one_hot:
             ps,seg,center,hclass,hres,sclass,sres,rotangle,onehotvec = \
-                dataset[idxs[i+start_idx]]
+                dataset.get_item(idxs[i+start_idx], num_point)
             batch_one_hot_vec[i] = onehotvec
         else:
             ps,seg,center,hclass,hres,sclass,sres,rotangle = \
-                dataset[idxs[i+start_idx]]
+                dataset.get_item(idxs[i+start_idx], num_point)
         batch_data[i,...] = ps[:,0:num_channel]
         batch_label[i,:] = seg
         batch_center[i,:] = center
@@ -64,6 +64,40 @@ def get_batch(dataset, idxs, start_idx, end_idx,
             batch_heading_class, batch_heading_residual, \
             batch_size_class, batch_size_residual, batch_rot_angle
 
+def bucket_batches(point_counts, bucket_sizes, batch_size, shuffle=True):
+    ''' Batches of frustums with similar numbers of points.
+
+    A frustum goes to the smallest bucket with at least its number of
+    points (the largest bucket if none), so it is resampled to fewer
+    duplicated points than with a single fixed point number. Every batch
+    comes from one bucket; the frustums left over by a bucket are moved
+    to the next larger one, those of the largest bucket are dropped.
+
+    Input:
+        point_counts: numpy array (N,), number of points of each frustum
+        bucket_sizes: sorted list of int, point number of each bucket
+        batch_size: int scalar
+        shuffle: bool, shuffle the frustums and the batch order
+    Output:
+        batches: list of (bucket index, numpy array of batch_size indices)
+    '''
+    buckets = np.minimum(np.searchsorted(bucket_sizes, point_counts),
+                         len(bucket_sizes)-1)
+    batches = []
+    left = np.zeros(0, dtype=np.int64)
+    for b in range(len(bucket_sizes)):
+        idxs = np.where(buckets == b)[0]
+        if shuffle:
+            np.random.shuffle(idxs)
+        idxs = np.concatenate([left, idxs])
+        num_batches = len(idxs) // batch_size
+        for i in range(num_batches):
+            batches.append((b, idxs[i*batch_size:(i+1)*batch_size]))
+        left = idxs[num_batches*batch_size:]
+    if shuffle:
+        batches = [batches[i] for i in np.random.permutation(len(batches))]
+    return batches
+
 def get_batch_test(dataset, idxs, start_idx, end_idx,
               num_point, num_channel,
               from_rgb_detection=False):